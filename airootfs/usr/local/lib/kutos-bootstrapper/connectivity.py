@@ -0,0 +1,150 @@
+"""Internet connectivity check that never blocks the UI.
+
+Several probes run concurrently — NetworkManager's own connectivity state,
+DNS resolution of the installer host and an HTTPS HEAD request to it. The
+first definitive answer wins and the remaining probes are cancelled. Each
+probe answers True (online), False (offline) or None (can't tell).
+
+:func:`probe_https` is the bootstrapper's only HTTP in Python (the installer
+itself comes over git). It opens a fresh asyncio connection on purpose: a
+pooled client could answer from a kept-alive connection that no longer
+leads anywhere, and it must be cancellable along with the other probes.
+"""
+
+import asyncio
+import socket
+import ssl
+import threading
+import time
+
+PROBE_TIMEOUT = 4
+CACHE_TTL = 5
+
+# NMConnectivityState
+NM_CONNECTIVITY_NONE = 1
+NM_CONNECTIVITY_PORTAL = 2
+NM_CONNECTIVITY_LIMITED = 3
+NM_CONNECTIVITY_FULL = 4
+
+_lock = threading.Lock()
+_cached = None  # (online, timestamp)
+
+
+def _nm_connectivity():
+    from gi.repository import Gio
+    import nm
+
+    proxy = Gio.DBusProxy.new_for_bus_sync(
+        nm.bus_type(), Gio.DBusProxyFlags.DO_NOT_CONNECT_SIGNALS, None,
+        nm.NM_BUS, nm.NM_PATH, nm.NM_IFACE, None,
+    )
+    value = proxy.get_cached_property("Connectivity")
+    return value.unpack() if value is not None else None
+
+
+async def probe_nm():
+    loop = asyncio.get_running_loop()
+    try:
+        state = await loop.run_in_executor(None, _nm_connectivity)
+    except Exception:
+        return None  # NetworkManager isn't running
+    if state == NM_CONNECTIVITY_FULL:
+        return True
+    if state in (NM_CONNECTIVITY_NONE, NM_CONNECTIVITY_PORTAL):
+        return False
+    # LIMITED may only mean NM's own check host is blocked
+    return None
+
+
+async def probe_dns(host):
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.getaddrinfo(host, 443, type=socket.SOCK_STREAM)
+    except socket.gaierror:
+        return False
+    # Resolving works behind captive portals too; let the others decide
+    return None
+
+
+async def probe_https(host):
+    try:
+        reader, writer = await asyncio.open_connection(
+            host, 443, ssl=ssl.create_default_context()
+        )
+    except (OSError, ssl.SSLError):
+        return None
+    try:
+        writer.write(
+            f"HEAD / HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode()
+        )
+        status = await reader.readline()
+        return status.startswith(b"HTTP/") or None
+    except (OSError, ssl.SSLError):
+        return None
+    finally:
+        writer.close()
+
+
+async def race(host, timeout=PROBE_TIMEOUT):
+    """Return the first definitive probe answer; False if none comes."""
+    tasks = {
+        asyncio.ensure_future(probe)
+        for probe in (probe_nm(), probe_dns(host), probe_https(host))
+    }
+    deadline = time.monotonic() + timeout
+    try:
+        while tasks:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, tasks = await asyncio.wait(
+                tasks, timeout=remaining, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.result() is not None:
+                    return task.result()
+        return False
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def cached(max_age=CACHE_TTL):
+    """Return the last result if it is younger than *max_age*, else None."""
+    with _lock:
+        if _cached and time.monotonic() - _cached[1] < max_age:
+            return _cached[0]
+    return None
+
+
+def invalidate():
+    global _cached
+    with _lock:
+        _cached = None
+
+
+def check(host, callback, max_age=CACHE_TTL):
+    """Find out whether *host* is reachable; calls *callback(online)*.
+
+    The callback runs on a worker thread (or right away for a cached
+    result), so GTK callers should hand it to ``GLib.idle_add``.
+    """
+    result = cached(max_age)
+    if result is not None:
+        callback(result)
+        return
+
+    def run():
+        global _cached
+        loop = asyncio.new_event_loop()
+        try:
+            online = loop.run_until_complete(race(host))
+        finally:
+            # Don't wait for a getaddrinfo() that lost the race
+            loop.close()
+        with _lock:
+            _cached = (online, time.monotonic())
+        callback(online)
+
+    threading.Thread(target=run, daemon=True).start()
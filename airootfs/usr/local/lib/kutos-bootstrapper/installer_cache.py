@@ -0,0 +1,200 @@
+"""Persistent git cache of the installer repository.
+
+The ISO ships a bare repository with a snapshot of the installer (seeded by
+build.sh). At boot only the delta since that snapshot is fetched, and the
+installer is checked out from the cache into a work tree. If the fetch fails
+the cached snapshot is used as is, so installing also works offline.
+
+If a LAN cache server is configured (see lancache.py), its snapshot is
+fetched first into a separate ref, only so that the objects are at hand:
+the upstream fetch then transfers little. Only commits fetched from
+upstream are ever checked out.
+
+    python3 installer_cache.py seed URL CACHE_DIR
+"""
+
+import codecs
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+import lancache
+from progress import GitProgressParser
+
+CACHE_DIR = "/var/cache/kutos/installer.git"
+# Where the fetched installer commit is kept inside the cache
+INSTALLER_REF = "refs/kutos/installer"
+# Where a LAN peer's snapshot is fetched to; never checked out
+PEER_REF = "refs/kutos/peer"
+FETCH_TIMEOUT = 60
+LAN_FETCH_TIMEOUT = 30
+# Same policy as kutos-settings' HTTP client (utils/net.py): a stalled
+# transfer fails on its own, and failed fetches are retried with jittered
+# exponential backoff within the time budget
+GIT_HTTP_CONFIG = ("-c", "http.lowSpeedLimit=1000", "-c", "http.lowSpeedTime=20")
+FETCH_RETRIES = 2
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 10
+
+
+def _git(cache, *args, **kwargs):
+    return subprocess.run(
+        ["git", "--git-dir", cache, *args],
+        check=True, capture_output=True, text=True, **kwargs,
+    )
+
+
+def _git_progress(cache, args, on_progress, timeout=None):
+    """Run a git command with ``--progress``, feeding *on_progress* events."""
+    process = subprocess.Popen(
+        ["git", "--git-dir", cache, *args],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    )
+    timer = threading.Timer(timeout, process.kill) if timeout else None
+    if timer:
+        timer.start()
+
+    parser = GitProgressParser()
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    tail = ""
+    try:
+        while True:
+            data = os.read(process.stderr.fileno(), 4096)
+            text = decoder.decode(data, final=not data)
+            tail = (tail + text)[-2000:]
+            for event in parser.feed(text):
+                on_progress(event)
+            if not data:
+                break
+    finally:
+        if timer:
+            timer.cancel()
+        process.stderr.close()
+
+    returncode = process.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, args, stderr=tail)
+
+
+def ensure_cache(cache=CACHE_DIR):
+    if not os.path.exists(os.path.join(cache, "HEAD")):
+        os.makedirs(cache, exist_ok=True)
+        subprocess.run(["git", "init", "-q", "--bare", cache], check=True)
+
+
+def snapshot(cache=CACHE_DIR):
+    """Return (commit, commit time) of the cached installer, or None."""
+    try:
+        out = _git(cache, "log", "-1", "--format=%H %ct", INSTALLER_REF).stdout.split()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out[0], int(out[1])
+
+
+def _backoff(attempt):
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def fetch(url, cache=CACHE_DIR, timeout=FETCH_TIMEOUT, on_progress=None, ref="HEAD",
+          retries=FETCH_RETRIES, target=INSTALLER_REF):
+    """Shallow-fetch *ref* (the tip) of *url* into the cache, as *target*.
+
+    Objects already in the cache aren't transferred again. *on_progress*
+    receives :class:`progress.Progress` events. A failed fetch is tried
+    again up to *retries* times, all within *timeout* seconds. Raises
+    ``CalledProcessError`` / ``TimeoutExpired`` on failure.
+    """
+    ensure_cache(cache)
+    args = [
+        *GIT_HTTP_CONFIG,
+        "fetch", "--depth", "1", "--no-tags", url, f"+{ref}:{target}",
+    ]
+    deadline = time.monotonic() + timeout
+    attempt = 0
+    while True:
+        remaining = deadline - time.monotonic()
+        try:
+            if on_progress:
+                _git_progress(cache, [*args, "--progress"], on_progress, remaining)
+            else:
+                _git(cache, *args, timeout=remaining)
+            return
+        except subprocess.CalledProcessError:
+            delay = _backoff(attempt)
+            if attempt >= retries or time.monotonic() + delay >= deadline:
+                raise
+            time.sleep(delay)
+            attempt += 1
+
+
+def checkout(dest, cache=CACHE_DIR, on_progress=None):
+    """Make *dest* an exact, clean copy of the cached installer."""
+    os.makedirs(dest, exist_ok=True)
+    work = ("--work-tree", dest)
+    # -f also undoes local edits, e.g. the persistence patch of a previous run
+    args = [*work, "checkout", "-f", "--detach", INSTALLER_REF]
+    if on_progress:
+        _git_progress(cache, [*args, "--progress"], on_progress)
+    else:
+        _git(cache, *args, "-q")
+    _git(cache, *work, "clean", "-q", "-f", "-d", "-x")
+
+
+def update_and_checkout(url, dest, cache=CACHE_DIR, on_progress=None):
+    """Fetch the latest installer if possible and check it out into *dest*.
+
+    Returns (success, message). Without network the cached snapshot is used.
+    """
+    peer = lancache.installer_url()
+    if peer:
+        # Peers keep the installer under INSTALLER_REF, not as HEAD. Their
+        # objects only shorten the upstream fetch below; a peer's commit is
+        # never checked out
+        try:
+            fetch(peer, cache, LAN_FETCH_TIMEOUT, on_progress, ref=INSTALLER_REF,
+                  retries=0, target=PEER_REF)
+        except (OSError, subprocess.SubprocessError):
+            pass
+
+    try:
+        fetch(url, cache, on_progress=on_progress)
+        fetched = True
+    except (OSError, subprocess.SubprocessError):
+        fetched = False
+    finally:
+        if peer:
+            try:
+                _git(cache, "update-ref", "-d", PEER_REF)
+            except (OSError, subprocess.CalledProcessError):
+                pass
+
+    cached = snapshot(cache)
+    if cached is None:
+        return False, "Could not download the installer and no cached copy is available."
+
+    try:
+        checkout(dest, cache, on_progress=on_progress)
+    except (OSError, subprocess.CalledProcessError) as e:
+        return False, f"Could not check out the installer: {e}"
+
+    if fetched:
+        return True, "Installer is up to date."
+    date = time.strftime("%Y-%m-%d", time.localtime(cached[1]))
+    return True, f"Offline: using the installer snapshot from {date}."
+
+
+def main(argv):
+    if len(argv) != 4 or argv[1] != "seed":
+        print(__doc__.strip().splitlines()[-1].strip(), file=sys.stderr)
+        return 2
+    url, cache = argv[2], argv[3]
+    fetch(url, cache)
+    print(" ".join(map(str, snapshot(cache))))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv))
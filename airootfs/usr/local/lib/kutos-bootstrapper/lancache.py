@@ -0,0 +1,68 @@
+"""Find a KutOS LAN cache server (see kutos-settings' utils/lancache.py).
+
+Only the client side, so the bootstrapper can fetch the installer from a
+peer before going to the internet. The protocol constants must match the
+server's.
+
+The client is opt-in: ``KUTOS_LANCACHE`` or ``kutos.lancache=`` on the
+kernel command line names the server, or ``auto`` to discover one by
+broadcast. Anything on the LAN can answer a broadcast, so what a peer sends
+is never trusted on its own (see installer_cache.py).
+"""
+
+import os
+import socket
+import time
+
+PORT = 8091
+QUERY = b"KUTOS-LANCACHE?"
+REPLY = b"KUTOS-LANCACHE "
+TIMEOUT = 0.3
+
+
+def _configured():
+    url = os.environ.get("KUTOS_LANCACHE")
+    if url:
+        return url
+    try:
+        with open("/proc/cmdline") as f:
+            for param in f.read().split():
+                if param.startswith("kutos.lancache="):
+                    return param.split("=", 1)[1]
+    except OSError:
+        pass
+    return None
+
+
+def find(timeout=TIMEOUT):
+    """Return the base URL of the LAN cache, or None if none is configured."""
+    configured = _configured()
+    if not configured or configured == "off":
+        return None
+    if configured != "auto":
+        return configured.rstrip("/")
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.settimeout(timeout)
+        for address in ("<broadcast>", "127.0.0.1"):
+            try:
+                sock.sendto(QUERY, (address, PORT))
+            except OSError:
+                pass
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            data, (host, _port) = sock.recvfrom(64)
+            if data.startswith(REPLY):
+                return f"http://{host}:{int(data[len(REPLY):])}"
+    except (OSError, ValueError):
+        pass
+    finally:
+        sock.close()
+    return None
+
+
+def installer_url():
+    base = find()
+    return f"{base}/installer.git" if base else None
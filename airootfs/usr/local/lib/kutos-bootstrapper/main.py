@@ -4,12 +4,17 @@ from gi.repository import Gtk, GLib, Gdk
 import subprocess
 import threading
 import os
-import shutil
 import time
+from urllib.parse import urlparse
 
+import connectivity
+import installer_cache
+import nm
+from progress import Progress, StageTimer, Throttle, describe
 from network_setup import NetworkSetupPage
 
 REPO_URL = "https://github.com/kutsos/kutos-installer"
+REPO_HOST = urlparse(REPO_URL).hostname
 INSTALLER_PATH = "/tmp/kutos-installer"
 
 class BootstrapperWindow(Gtk.Window):
@@ -28,8 +33,15 @@ class BootstrapperWindow(Gtk.Window):
         self._show_loading("Checking connectivity...")
         self.show_all()
         
+        self._fetching = False
+
+        # Any link coming up (a late wired link, Wi-Fi joined in another
+        # tool, ...) starts the fetch without waiting for the user
+        self._nm_watcher = nm.StateWatcher(self._on_nm_state)
+        self._nm_watcher.start()
+
         # Start initial check
-        GLib.timeout_add(1000, self._initial_check)
+        GLib.idle_add(self._initial_check)
 
     def _load_css(self):
         css_path = os.path.join(os.path.dirname(__file__), "theme/style.css")
@@ -50,6 +62,7 @@ class BootstrapperWindow(Gtk.Window):
         lbl = Gtk.Label(label=message)
         lbl.get_style_context().add_class("subtitle")
         box.pack_start(lbl, False, False, 0)
+        self.status_lbl = lbl
         
         self.progress = Gtk.ProgressBar()
         self.progress.pulse()
@@ -68,6 +81,28 @@ class BootstrapperWindow(Gtk.Window):
             return True
         return False
 
+    def _report(self, event):
+        """Record a progress event; may be called from any thread."""
+        self._timer.on_event(event)
+        self._throttle.push(event)
+
+    def _on_progress(self, event):
+        self.status_lbl.set_text(f"{event.stage}...")
+        if event.fraction is None:
+            self.progress.set_show_text(False)
+            if not self._pulse_id:
+                self._pulse_id = GLib.timeout_add(100, self._do_pulse)
+            return False
+
+        # Real numbers from here on; stop the indeterminate pulse
+        if self._pulse_id:
+            GLib.source_remove(self._pulse_id)
+            self._pulse_id = None
+        self.progress.set_fraction(event.fraction)
+        self.progress.set_show_text(True)
+        self.progress.set_text(describe(event))
+        return False
+
     def _clear_stack(self):
         if hasattr(self, "_pulse_id") and self._pulse_id:
             GLib.source_remove(self._pulse_id)
@@ -76,46 +111,68 @@ class BootstrapperWindow(Gtk.Window):
             self.stack.remove(child)
 
     def _initial_check(self):
-        if self._is_connected():
-            self._start_cloning()
-        else:
-            self._show_network_setup()
+        # Runs off the main loop; the answer comes back through idle_add
+        connectivity.check(
+            REPO_HOST, lambda online: GLib.idle_add(self._on_connectivity, online)
+        )
         return False
 
-    def _is_connected(self):
-        try:
-            # Check if we can reach Google DNS
-            subprocess.run(["ping", "-c", "1", "-W", "2", "8.8.8.8"], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            return True
-        except:
+    def _retry(self):
+        connectivity.invalidate()
+        self._show_loading("Checking connectivity...")
+        self._initial_check()
+
+    def _on_nm_state(self, state):
+        if state >= nm.NM_STATE_CONNECTED_LOCAL and not self._fetching:
+            connectivity.invalidate()
+            self._initial_check()
+
+    def _on_connectivity(self, online):
+        if self._fetching:
             return False
+        if online:
+            self._start_cloning()
+        elif self.stack.get_visible_child_name() != "network":
+            self._show_network_setup()
+        return False
 
     def _show_network_setup(self):
-        page = NetworkSetupPage(on_connected_cb=self._start_cloning)
+        # The ISO ships an installer snapshot, so going on offline is possible
+        offline_cb = self._start_cloning if installer_cache.snapshot() else None
+        page = NetworkSetupPage(on_connected_cb=self._start_cloning, on_offline_cb=offline_cb)
         self._clear_stack()
         self.stack.add_named(page, "network")
         self.stack.set_visible_child_name("network")
         page.show_all()
 
     def _start_cloning(self):
+        if self._fetching:
+            return
+        self._fetching = True
         self._show_loading("Downloading KutOS Installer...")
+        self._timer = StageTimer()
+        self._throttle = Throttle(lambda event: GLib.idle_add(self._on_progress, event))
         threading.Thread(target=self._clone_repo, daemon=True).start()
 
     def _clone_repo(self):
-        try:
-            # Remove existing if any
-            if os.path.exists(INSTALLER_PATH):
-                shutil.rmtree(INSTALLER_PATH)
-            
-            # Clone from GitHub
-            subprocess.run(["git", "clone", "--depth", "1", REPO_URL, INSTALLER_PATH], check=True)
-            
-            # PATCHING: Add persistence logic to the downloaded installer
-            self._patch_installer()
-            
-            GLib.idle_add(self._launch_installer)
-        except Exception as e:
-            GLib.idle_add(self._show_error, f"Download failed: {str(e)}")
+        # Incremental fetch into the persistent cache, then a clean checkout;
+        # falls back to the snapshot shipped on the ISO when offline
+        self._report(Progress("Connecting"))
+        success, message = installer_cache.update_and_checkout(
+            REPO_URL, INSTALLER_PATH, on_progress=self._report
+        )
+        self._throttle.flush()
+        if not success:
+            self._timer.save()
+            GLib.idle_add(self._on_fetch_failed, f"Download failed: {message}")
+            return
+        print(message)
+
+        # PATCHING: Add persistence logic to the downloaded installer
+        self._report(Progress("Preparing installer"))
+        self._patch_installer()
+
+        GLib.idle_add(self._launch_installer)
 
     def _patch_installer(self):
         """Injects code into the cloned installer to ensure KutOS Settings persists."""
@@ -143,10 +200,23 @@ class BootstrapperWindow(Gtk.Window):
         # We need to run the cloned installer
         # It's better to launch it as a separate process and exit the bootstrapper
         try:
+            self._report(Progress("Starting installer"))
             subprocess.Popen(["python3", os.path.join(INSTALLER_PATH, "main.py")])
+            record = self._timer.save()
+            print("Stage timings: " + ", ".join(
+                f"{s['stage']} {s['seconds']:.2f}s" for s in record["stages"]
+            ))
+            self._nm_watcher.stop()
             Gtk.main_quit()
         except Exception as e:
-            self._show_error(f"Failed to launch installer: {str(e)}")
+            self._on_fetch_failed(f"Failed to launch installer: {str(e)}")
+
+    def _on_fetch_failed(self, message):
+        # Cleared here on the main thread, once the error page is up, so an
+        # NM state change can't start another fetch over the failed one
+        self._show_error(message)
+        self._fetching = False
+        return False
 
     def _show_error(self, message):
         box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=20)
@@ -162,7 +232,7 @@ class BootstrapperWindow(Gtk.Window):
         box.pack_start(msg, False, False, 0)
         
         btn = Gtk.Button(label="Try Again")
-        btn.connect("clicked", lambda x: self._initial_check())
+        btn.connect("clicked", lambda x: self._retry())
         box.pack_start(btn, False, False, 0)
         
         self._clear_stack()
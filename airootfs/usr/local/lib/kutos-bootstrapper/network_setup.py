@@ -1,17 +1,38 @@
 import gi
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk, GLib, Gdk
-import subprocess
-import threading
+
+import nm
+
+
+def _bars(strength):
+    # Same thresholds as nmcli's BARS column
+    for limit, bars in ((80, "▂▄▆█"), (55, "▂▄▆_"), (30, "▂▄__"), (5, "▂___")):
+        if strength > limit:
+            return bars
+    return "____"
+
+
+def _compare_rows(a, b):
+    # Strongest first, then by name
+    if a.strength != b.strength:
+        return b.strength - a.strength
+    return (a.ssid.lower() > b.ssid.lower()) - (a.ssid.lower() < b.ssid.lower())
+
 
 class NetworkSetupPage(Gtk.Box):
-    def __init__(self, on_connected_cb):
+    def __init__(self, on_connected_cb, on_offline_cb=None):
         super().__init__(orientation=Gtk.Orientation.VERTICAL, spacing=20)
         self.on_connected_cb = on_connected_cb
+        self.on_offline_cb = on_offline_cb
         self.set_valign(Gtk.Align.CENTER)
         self.set_halign(Gtk.Align.CENTER)
         self.set_margin_top(50)
         
+        self.selected_network = None
+        self._wifi = nm.WifiConnection(self._on_wifi_stage, self._on_wifi_done)
+        self.connect("destroy", lambda w: self._wifi.cancel())
+
         self._build_ui()
         self._start_scan()
 
@@ -32,6 +53,7 @@ class NetworkSetupPage(Gtk.Box):
         
         self.listbox = Gtk.ListBox()
         self.listbox.set_selection_mode(Gtk.SelectionMode.NONE)
+        self.listbox.set_sort_func(_compare_rows)
         scrolled.add(self.listbox)
         self.pack_start(scrolled, True, True, 0)
 
@@ -42,83 +64,101 @@ class NetworkSetupPage(Gtk.Box):
         self.connect_btn.connect("clicked", self._on_connect_clicked)
         self.pack_start(self.connect_btn, False, False, 0)
 
+        # Activation progress and failure reasons
+        status_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=8)
+        status_box.set_halign(Gtk.Align.CENTER)
+        self.spinner = Gtk.Spinner()
+        status_box.pack_start(self.spinner, False, False, 0)
+        self.status_lbl = Gtk.Label()
+        self.status_lbl.set_line_wrap(True)
+        status_box.pack_start(self.status_lbl, False, False, 0)
+        self.pack_start(status_box, False, False, 0)
+
+        if self.on_offline_cb:
+            offline_btn = Gtk.Button(label="Continue Offline")
+            offline_btn.connect("clicked", lambda x: self.on_offline_cb())
+            self.pack_start(offline_btn, False, False, 0)
+
         self.listbox.connect("row-activated", self._on_row_activated)
 
     def _start_scan(self):
-        threading.Thread(target=self._scan_wifi, daemon=True).start()
-
-    def _scan_wifi(self):
-        try:
-            # Simple nmcli scan
-            subprocess.run(["nmcli", "dev", "wifi", "rescan"], check=False)
-            output = subprocess.check_output(
-                ["nmcli", "-t", "-f", "SSID,BARS,SECURITY", "dev", "wifi"],
-                text=True
-            )
-            
-            networks = []
-            for line in output.strip().split("\n"):
-                if line.strip():
-                    parts = line.split(":")
-                    if len(parts) >= 2 and parts[0]:
-                        networks.append({
-                            "ssid": parts[0],
-                            "signal": parts[1],
-                            "security": parts[2] if len(parts) > 2 else ""
-                        })
-
-            GLib.idle_add(self._update_list, networks)
-        except Exception as e:
-            print(f"Scan error: {e}")
+        self._rows = {}
+        self._scanner = nm.WifiScanner(self._update_list)
+        self._scanner.start()
+        self.connect("destroy", lambda w: self._scanner.stop())
 
     def _update_list(self, networks):
-        for child in self.listbox.get_children():
-            self.listbox.remove(child)
-
+        # Update rows in place: rebuilding hundreds of rows per scan would
+        # flicker and lose the selection
+        seen = set()
         for net in networks:
-            row = Gtk.ListBoxRow()
-            box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=12)
-            box.get_style_context().add_class("network-item")
-            
-            lbl = Gtk.Label(label=net["ssid"], xalign=0)
-            box.pack_start(lbl, True, True, 0)
-            
-            sig = Gtk.Label(label=net["signal"])
-            box.pack_end(sig, False, False, 0)
-            
-            row.add(box)
-            row.ssid = net["ssid"]
-            row.security = net["security"]
-            self.listbox.add(row)
-        
-        self.listbox.show_all()
+            seen.add(net.ssid)
+            row = self._rows.get(net.ssid)
+            is_new = row is None
+            if is_new:
+                row = self._make_row(net.ssid)
+            row.strength = net.strength
+            row.security = net.security
+            row.network = net
+            row.signal_lbl.set_text(_bars(net.strength))
+            if is_new:
+                self._rows[net.ssid] = row
+                self.listbox.add(row)
+                row.show_all()
+
+        for ssid in list(self._rows):
+            if ssid not in seen:
+                self.listbox.remove(self._rows.pop(ssid))
+
+        self.listbox.invalidate_sort()
+
+    def _make_row(self, ssid):
+        row = Gtk.ListBoxRow()
+        box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=12)
+        box.get_style_context().add_class("network-item")
+
+        lbl = Gtk.Label(label=ssid, xalign=0)
+        box.pack_start(lbl, True, True, 0)
+
+        row.signal_lbl = Gtk.Label()
+        box.pack_end(row.signal_lbl, False, False, 0)
+
+        row.add(box)
+        row.ssid = ssid
+        return row
 
     def _on_row_activated(self, listbox, row):
-        self.selected_ssid = row.ssid
-        self.selected_security = row.security
+        if self._wifi.running:
+            return
+        self.selected_network = row.network
         self.connect_btn.set_sensitive(True)
 
     def _on_connect_clicked(self, btn):
-        if not self.selected_ssid:
-            return
-
-        if "WPA" in self.selected_security or "WEP" in self.selected_security:
-            self._show_password_dialog()
-        else:
-            self._connect_to_wifi(self.selected_ssid)
-
-    def _show_password_dialog(self):
+        if self.selected_network:
+            # Pick up the latest scan: the strongest access point may differ
+            row = self._rows.get(self.selected_network.ssid)
+            if row:
+                self.selected_network = row.network
+            # A saved profile is tried first; the password is only asked
+            # for when there is none or it turns out to be wrong
+            self._connect_to_wifi(self.selected_network)
+
+    def _show_password_dialog(self, network, message=None):
         dialog = Gtk.MessageDialog(
             transient_for=self.get_toplevel(),
             modal=True,
             message_type=Gtk.MessageType.QUESTION,
             buttons=Gtk.ButtonsType.OK_CANCEL,
-            text=f"Password for {self.selected_ssid}"
+            text=f"Password for {network.ssid}"
         )
+        if message:
+            dialog.format_secondary_text(message)
         
         entry = Gtk.Entry()
         entry.set_visibility(False)
         entry.set_invisible_char("*")
+        entry.set_activates_default(True)
+        dialog.set_default_response(Gtk.ResponseType.OK)
         dialog.get_content_area().add(entry)
         dialog.show_all()
         
@@ -126,19 +166,29 @@ class NetworkSetupPage(Gtk.Box):
         password = entry.get_text()
         dialog.destroy()
         
-        if response == Gtk.ResponseType.OK:
-            self._connect_to_wifi(self.selected_ssid, password)
-
-    def _connect_to_wifi(self, ssid, password=None):
-        def task():
-            try:
-                cmd = ["nmcli", "dev", "wifi", "connect", ssid]
-                if password:
-                    cmd += ["password", password]
-                
-                subprocess.run(cmd, check=True)
-                GLib.idle_add(self.on_connected_cb)
-            except Exception as e:
-                print(f"Connection failed: {e}")
-        
-        threading.Thread(target=task, daemon=True).start()
+        if response == Gtk.ResponseType.OK and password:
+            self._connect_to_wifi(network, password)
+
+    def _connect_to_wifi(self, network, password=None):
+        self.connect_btn.set_sensitive(False)
+        self.listbox.set_sensitive(False)
+        self.status_lbl.get_style_context().remove_class("error")
+        self.spinner.start()
+        self._wifi.connect(network, password)
+
+    def _on_wifi_stage(self, text):
+        self.status_lbl.set_text(f"{text}...")
+
+    def _on_wifi_done(self, success, message):
+        self.spinner.stop()
+        self.listbox.set_sensitive(True)
+        self.connect_btn.set_sensitive(self.selected_network is not None)
+        self.status_lbl.set_text(message)
+        if success:
+            self.on_connected_cb()
+            return
+        self.status_lbl.get_style_context().add_class("error")
+        if self._wifi.needs_password:
+            network = self.selected_network
+            # Not from inside the D-Bus callback: the dialog runs a nested loop
+            GLib.idle_add(self._show_password_dialog, network, message)
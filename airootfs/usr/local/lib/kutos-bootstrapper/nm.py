@@ -0,0 +1,563 @@
+"""NetworkManager over D-Bus.
+
+Everything talks to the system bus, unless ``KUTOS_NM_BUS=session`` is set:
+then the stand-in NetworkManager from bench/fake_nm.py on the session bus is
+used, so the bootstrapper can be exercised without touching the real network.
+"""
+
+import collections
+import os
+
+from gi.repository import Gio, GLib
+
+NM_BUS = "org.freedesktop.NetworkManager"
+NM_PATH = "/org/freedesktop/NetworkManager"
+NM_IFACE = "org.freedesktop.NetworkManager"
+
+# NMState
+NM_STATE_UNKNOWN = 0
+NM_STATE_DISCONNECTED = 20
+NM_STATE_CONNECTING = 40
+NM_STATE_CONNECTED_LOCAL = 50
+NM_STATE_CONNECTED_SITE = 60
+NM_STATE_CONNECTED_GLOBAL = 70
+
+
+def bus_type():
+    if os.environ.get("KUTOS_NM_BUS") == "session":
+        return Gio.BusType.SESSION
+    return Gio.BusType.SYSTEM
+
+
+class StateWatcher:
+    """Calls *callback(state)* on the main loop whenever NM's State changes.
+
+    It is also called once with the current state as soon as it is known,
+    and again if NetworkManager (re)starts. Nothing happens while
+    NetworkManager isn't running.
+    """
+
+    def __init__(self, callback):
+        self._callback = callback
+        self._proxy = None
+        self._handlers = []
+        self._state = None
+
+    def start(self):
+        Gio.DBusProxy.new_for_bus(
+            bus_type(), Gio.DBusProxyFlags.DO_NOT_AUTO_START, None,
+            NM_BUS, NM_PATH, NM_IFACE, None, self._on_proxy,
+        )
+
+    def stop(self):
+        for handler in self._handlers:
+            self._proxy.disconnect(handler)
+        self._handlers = []
+        self._proxy = None
+        self._callback = None
+
+    def _on_proxy(self, _source, result):
+        try:
+            proxy = Gio.DBusProxy.new_for_bus_finish(result)
+        except GLib.Error as e:
+            print(f"NetworkManager unavailable: {e.message}")
+            return
+        if self._callback is None:
+            return  # stopped meanwhile
+        self._proxy = proxy
+        self._handlers = [
+            proxy.connect("g-properties-changed", lambda *args: self._update()),
+            proxy.connect("notify::g-name-owner", lambda *args: self._update()),
+        ]
+        self._update()
+
+    def _update(self):
+        value = self._proxy.get_cached_property("State") if self._proxy else None
+        state = value.unpack() if value is not None else None
+        if state is None or state == self._state:
+            return
+        self._state = state
+        self._callback(state)
+
+
+# ── Wi-Fi scanning ─────────────────────────────────────────────────────────
+
+NM_DEVICE_IFACE = "org.freedesktop.NetworkManager.Device"
+NM_WIRELESS_IFACE = "org.freedesktop.NetworkManager.Device.Wireless"
+NM_AP_IFACE = "org.freedesktop.NetworkManager.AccessPoint"
+NM_DEVICE_TYPE_WIFI = 2
+NM_802_11_AP_FLAGS_PRIVACY = 0x1
+
+# Coalesce bursts of AP signals (a scan can add hundreds) into one update
+SCAN_UPDATE_DELAY = 100
+
+Network = collections.namedtuple("Network", "ssid strength security ap_path device_path")
+Network.__doc__ = """One SSID, represented by its strongest access point."""
+
+
+def _call(proxy, method, params=None, callback=None):
+    """Fire-and-forget (or callback(result | None)) async D-Bus call."""
+    def done(proxy, result):
+        try:
+            value = proxy.call_finish(result)
+        except GLib.Error as e:
+            print(f"{method} failed: {e.message}")
+            value = None
+        if callback:
+            callback(value)
+
+    proxy.call(method, params, Gio.DBusCallFlags.NONE, -1, None, done)
+
+
+def _new_proxy(path, iface, callback):
+    def done(_source, result):
+        try:
+            proxy = Gio.DBusProxy.new_for_bus_finish(result)
+        except GLib.Error as e:
+            print(f"{path}: {e.message}")
+            return
+        callback(proxy)
+
+    Gio.DBusProxy.new_for_bus(
+        bus_type(), Gio.DBusProxyFlags.DO_NOT_AUTO_START, None,
+        NM_BUS, path, iface, None, done,
+    )
+
+
+def _security(ap):
+    def prop(name):
+        value = ap.get_cached_property(name)
+        return value.unpack() if value is not None else 0
+
+    if prop("WpaFlags") or prop("RsnFlags"):
+        return "WPA"
+    if prop("Flags") & NM_802_11_AP_FLAGS_PRIVACY:
+        return "WEP"
+    return ""
+
+
+class WifiScanner:
+    """Keeps a live list of nearby Wi-Fi networks.
+
+    NetworkManager's cached scan results are reported right away; a rescan
+    is requested in the background and AccessPointAdded / Removed and signal
+    strength changes keep the list current. *on_changed(networks)* gets the
+    list of :class:`Network`, one per SSID, strongest first.
+    """
+
+    def __init__(self, on_changed):
+        self._on_changed = on_changed
+        self._nm = None
+        self._devices = {}  # path -> Device.Wireless proxy
+        self._aps = {}  # path -> (AccessPoint proxy, device path)
+        self._handlers = []  # (proxy, handler id)
+        self._update_id = None
+        self._stopped = False
+
+    def start(self):
+        _new_proxy(NM_PATH, NM_IFACE, self._on_nm)
+
+    def rescan(self):
+        for device in self._devices.values():
+            _call(device, "RequestScan", GLib.Variant("(a{sv})", ({},)))
+
+    def stop(self):
+        self._stopped = True
+        for proxy, handler in self._handlers:
+            proxy.disconnect(handler)
+        self._handlers = []
+        self._devices.clear()
+        self._aps.clear()
+        if self._update_id:
+            GLib.source_remove(self._update_id)
+            self._update_id = None
+
+    def _connect(self, proxy, signal, handler):
+        self._handlers.append((proxy, proxy.connect(signal, handler)))
+
+    def _on_nm(self, proxy):
+        if self._stopped:
+            return
+        self._nm = proxy
+        self._connect(proxy, "g-signal", self._on_nm_signal)
+        _call(proxy, "GetDevices", callback=self._on_devices)
+
+    def _on_nm_signal(self, _proxy, _sender, signal, params):
+        if signal == "DeviceAdded":
+            self._probe_device(params.unpack()[0])
+
+    def _on_devices(self, result):
+        for path in result.unpack()[0] if result else []:
+            self._probe_device(path)
+
+    def _probe_device(self, path):
+        def on_device(device):
+            value = device.get_cached_property("DeviceType")
+            if value is not None and value.unpack() == NM_DEVICE_TYPE_WIFI:
+                _new_proxy(path, NM_WIRELESS_IFACE, on_wireless)
+
+        def on_wireless(wireless):
+            if self._stopped or path in self._devices:
+                return
+            self._devices[path] = wireless
+            self._connect(wireless, "g-signal", self._on_wireless_signal)
+            # Cached results first, so the list shows up immediately ...
+            _call(wireless, "GetAllAccessPoints",
+                  callback=lambda result: self._on_access_points(path, result))
+            # ... then ask for fresh ones
+            _call(wireless, "RequestScan", GLib.Variant("(a{sv})", ({},)))
+
+        _new_proxy(path, NM_DEVICE_IFACE, on_device)
+
+    def _on_access_points(self, device_path, result):
+        for ap_path in result.unpack()[0] if result else []:
+            self._add_ap(ap_path, device_path)
+
+    def _on_wireless_signal(self, proxy, _sender, signal, params):
+        if signal == "AccessPointAdded":
+            self._add_ap(params.unpack()[0], proxy.get_object_path())
+        elif signal == "AccessPointRemoved":
+            entry = self._aps.pop(params.unpack()[0], None)
+            if entry:
+                self._schedule_update()
+
+    def _add_ap(self, ap_path, device_path):
+        if ap_path in self._aps:
+            return
+        self._aps[ap_path] = None  # proxy on its way
+
+        def on_ap(ap):
+            if self._stopped or ap_path not in self._aps:
+                return  # removed before we got to it
+            self._aps[ap_path] = (ap, device_path)
+            self._connect(ap, "g-properties-changed", lambda *args: self._schedule_update())
+            self._schedule_update()
+
+        _new_proxy(ap_path, NM_AP_IFACE, on_ap)
+
+    def _schedule_update(self):
+        if self._update_id is None and not self._stopped:
+            self._update_id = GLib.timeout_add(SCAN_UPDATE_DELAY, self._emit)
+
+    def _emit(self):
+        self._update_id = None
+        self._on_changed(self.networks())
+        return False
+
+    def networks(self):
+        best = {}
+        for ap_path, entry in self._aps.items():
+            if entry is None:
+                continue
+            ap, device_path = entry
+            ssid = ap.get_cached_property("Ssid")
+            strength = ap.get_cached_property("Strength")
+            if ssid is None or strength is None:
+                continue
+            name = bytes(ssid.unpack()).decode("utf-8", "replace")
+            if not name.strip("\0"):
+                continue  # hidden network
+            network = Network(name, strength.unpack(), _security(ap), ap_path, device_path)
+            if name not in best or network.strength > best[name].strength:
+                best[name] = network
+        return sorted(best.values(), key=lambda n: (-n.strength, n.ssid.lower()))
+
+
+# ── Wi-Fi connections ──────────────────────────────────────────────────────
+
+NM_SETTINGS_PATH = "/org/freedesktop/NetworkManager/Settings"
+NM_SETTINGS_IFACE = "org.freedesktop.NetworkManager.Settings"
+NM_CONNECTION_IFACE = "org.freedesktop.NetworkManager.Settings.Connection"
+
+# NMDeviceState
+NM_DEVICE_STATE_DISCONNECTED = 30
+NM_DEVICE_STATE_PREPARE = 40
+NM_DEVICE_STATE_CONFIG = 50
+NM_DEVICE_STATE_NEED_AUTH = 60
+NM_DEVICE_STATE_IP_CONFIG = 70
+NM_DEVICE_STATE_IP_CHECK = 80
+NM_DEVICE_STATE_SECONDARIES = 90
+NM_DEVICE_STATE_ACTIVATED = 100
+NM_DEVICE_STATE_DEACTIVATING = 110
+NM_DEVICE_STATE_FAILED = 120
+
+# Activation stages: what to tell the user, and how long (s) the device may
+# sit in it. NEED_AUTH is short: there is no secret agent to answer, so it
+# only ever ends in a failure.
+ACTIVATION_STAGES = {
+    NM_DEVICE_STATE_PREPARE: ("Preparing", 10),
+    NM_DEVICE_STATE_CONFIG: ("Joining the network", 30),
+    NM_DEVICE_STATE_NEED_AUTH: ("Checking the password", 5),
+    NM_DEVICE_STATE_IP_CONFIG: ("Getting an IP address", 30),
+    NM_DEVICE_STATE_IP_CHECK: ("Checking the connection", 15),
+    NM_DEVICE_STATE_SECONDARIES: ("Finishing", 15),
+}
+# Until the device picks up the new activation
+ACTIVATION_START_TIMEOUT = 10
+
+# NMDeviceStateReason
+NM_DEVICE_STATE_REASON_NO_SECRETS = 7
+NM_DEVICE_STATE_REASON_SUPPLICANT_DISCONNECT = 8
+NM_DEVICE_STATE_REASON_SUPPLICANT_TIMEOUT = 11
+
+FAILURE_REASONS = {
+    4: "The connection could not be configured.",
+    5: "No IP address could be obtained.",
+    6: "The IP address lease expired.",
+    NM_DEVICE_STATE_REASON_NO_SECRETS: "The password is missing or wrong.",
+    NM_DEVICE_STATE_REASON_SUPPLICANT_DISCONNECT: "The access point rejected the connection; check the password.",
+    9: "The Wi-Fi settings are invalid.",
+    10: "Authentication failed.",
+    NM_DEVICE_STATE_REASON_SUPPLICANT_TIMEOUT: "The access point did not answer; check the password.",
+    15: "DHCP could not be started.",
+    16: "DHCP failed.",
+    17: "No IP address could be obtained (DHCP timed out).",
+    53: "The network is out of range.",
+}
+# Reasons worth asking for the password again
+PASSWORD_REASONS = {
+    NM_DEVICE_STATE_REASON_NO_SECRETS,
+    NM_DEVICE_STATE_REASON_SUPPLICANT_DISCONNECT,
+    NM_DEVICE_STATE_REASON_SUPPLICANT_TIMEOUT,
+}
+
+
+def _bus_call(path, iface, method, params=None, callback=None):
+    """Async call without a proxy, for objects that are used only once."""
+    def done(bus, result):
+        try:
+            value = bus.call_finish(result)
+        except GLib.Error as e:
+            print(f"{method} failed: {e.message}")
+            value = None
+        if callback:
+            callback(value)
+
+    bus = Gio.bus_get_sync(bus_type(), None)
+    bus.call(NM_BUS, path, iface, method, params, None,
+             Gio.DBusCallFlags.NONE, -1, None, done)
+
+
+def _typed_settings(value):
+    """a{sa{sv}} as {group: {key: GLib.Variant}}, keeping the value types so
+    the settings can be sent back with Update."""
+    settings = {}
+    for i in range(value.n_children()):
+        entry = value.get_child_value(i)
+        props = entry.get_child_value(1)
+        settings[entry.get_child_value(0).get_string()] = {
+            prop.get_child_value(0).get_string(): prop.get_child_value(1).get_variant()
+            for prop in (props.get_child_value(j) for j in range(props.n_children()))
+        }
+    return settings
+
+
+def _security_settings(network, password):
+    if network.security == "WEP":
+        return {"key-mgmt": GLib.Variant("s", "none"),
+                "wep-key0": GLib.Variant("s", password)}
+    return {"key-mgmt": GLib.Variant("s", "wpa-psk"),
+            "psk": GLib.Variant("s", password)}
+
+
+def find_saved_connection(ssid, callback):
+    """Calls *callback(path, settings)* with the most recently used saved
+    profile for *ssid*, or *callback(None, None)*."""
+    def on_list(result):
+        paths = result.unpack()[0] if result else []
+        if not paths:
+            callback(None, None)
+            return
+        pending = [len(paths)]
+        best = [None, None, -1]
+
+        def on_settings(path, result):
+            if result is not None:
+                settings = _typed_settings(result.get_child_value(0))
+                wireless = settings.get("802-11-wireless", {})
+                ssid_value = wireless.get("ssid")
+                if ssid_value is not None and bytes(ssid_value.unpack()) == ssid.encode():
+                    timestamp = settings.get("connection", {}).get("timestamp")
+                    used = timestamp.unpack() if timestamp is not None else 0
+                    if used > best[2]:
+                        best[:] = [path, settings, used]
+            pending[0] -= 1
+            if not pending[0]:
+                callback(best[0], best[1])
+
+        for path in paths:
+            _bus_call(path, NM_CONNECTION_IFACE, "GetSettings",
+                      callback=lambda result, path=path: on_settings(path, result))
+
+    _bus_call(NM_SETTINGS_PATH, NM_SETTINGS_IFACE, "ListConnections", callback=on_list)
+
+
+class WifiConnection:
+    """Joins a Wi-Fi network and follows the activation to its end.
+
+    A saved profile for the SSID is reused, so known networks connect
+    without asking for the password again. Every activation stage has its
+    own timeout; a stuck or failed activation is cancelled and reported
+    at once. *on_stage(text)* gets the current stage for the UI and
+    *on_done(success, message)* the outcome. After a failure,
+    :attr:`needs_password` tells whether asking for the password again
+    makes sense.
+    """
+
+    def __init__(self, on_stage, on_done):
+        self._on_stage = on_stage
+        self._on_done = on_done
+        self._device = None
+        self._handler = None
+        self._timeout_id = None
+        self._active = None
+        self._state = None
+        self._started = False
+        self._finished = True
+        self.needs_password = False
+
+    @property
+    def running(self):
+        return not self._finished
+
+    def connect(self, network, password=None):
+        self.cancel()
+        self._network = network
+        self._finished = False
+        self._started = False
+        self._state = None
+        self.needs_password = False
+        self._on_stage("Looking for a saved profile")
+        find_saved_connection(
+            network.ssid, lambda path, settings: self._on_saved(path, settings, password)
+        )
+
+    def cancel(self):
+        """Abort a running activation; reports nothing."""
+        if self._finished:
+            return
+        self._deactivate()
+        self._cleanup()
+
+    # ── Starting the activation ──
+
+    def _on_saved(self, path, settings, password):
+        if self._finished:
+            return
+        network = self._network
+        if path and password:
+            # Known network with a new password: fix the profile instead of
+            # piling up "SSID 1", "SSID 2", ... duplicates
+            settings["802-11-wireless-security"] = {
+                **settings.get("802-11-wireless-security", {}),
+                **_security_settings(network, password),
+            }
+            _bus_call(path, NM_CONNECTION_IFACE, "Update",
+                      GLib.Variant("(a{sa{sv}})", (settings,)),
+                      lambda result: self._activate(path) if result is not None
+                      else self._fail("Could not save the new password."))
+        elif path:
+            self._activate(path)
+        elif password or not network.security:
+            settings = {}
+            if password:
+                settings["802-11-wireless-security"] = _security_settings(network, password)
+            self._watch_device(lambda: _bus_call(
+                NM_PATH, NM_IFACE, "AddAndActivateConnection",
+                GLib.Variant("(a{sa{sv}}oo)", (settings, network.device_path, network.ap_path)),
+                lambda result: self._on_activation(result.unpack()[1] if result else None),
+            ))
+        else:
+            self.needs_password = True
+            self._fail("This network needs a password.")
+
+    def _activate(self, path):
+        network = self._network
+        self._watch_device(lambda: _bus_call(
+            NM_PATH, NM_IFACE, "ActivateConnection",
+            GLib.Variant("(ooo)", (path, network.device_path, network.ap_path)),
+            lambda result: self._on_activation(result.unpack()[0] if result else None),
+        ))
+
+    def _watch_device(self, then):
+        # Subscribe before activating, so no state change is missed
+        def on_device(device):
+            if self._finished:
+                return
+            self._device = device
+            self._handler = device.connect("g-signal", self._on_device_signal)
+            self._arm_timeout(ACTIVATION_START_TIMEOUT)
+            then()
+
+        _new_proxy(self._network.device_path, NM_DEVICE_IFACE, on_device)
+
+    def _on_activation(self, active_path):
+        if self._finished:
+            return
+        if not active_path:
+            self._fail("NetworkManager refused to start the connection.")
+            return
+        self._active = active_path
+
+    # ── Following it ──
+
+    def _on_device_signal(self, _proxy, _sender, signal, params):
+        if signal != "StateChanged" or self._finished:
+            return
+        state, _old, reason = params.unpack()
+        if not self._started:
+            # The previous connection going down comes first; ours starts
+            # at PREPARE
+            if state != NM_DEVICE_STATE_PREPARE:
+                return
+            self._started = True
+        self._state = state
+
+        if state == NM_DEVICE_STATE_ACTIVATED:
+            self._cleanup()
+            self._on_done(True, f"Connected to {self._network.ssid}.")
+        elif state in ACTIVATION_STAGES:
+            text, timeout = ACTIVATION_STAGES[state]
+            self._arm_timeout(timeout)
+            self._on_stage(text)
+        elif state in (NM_DEVICE_STATE_FAILED, NM_DEVICE_STATE_DEACTIVATING,
+                       NM_DEVICE_STATE_DISCONNECTED):
+            self.needs_password = reason in PASSWORD_REASONS
+            self._active = None  # already going down
+            self._fail(FAILURE_REASONS.get(reason, f"Connection failed (reason {reason})."))
+
+    def _arm_timeout(self, seconds):
+        if self._timeout_id:
+            GLib.source_remove(self._timeout_id)
+        self._timeout_id = GLib.timeout_add_seconds(seconds, self._on_timeout)
+
+    def _on_timeout(self):
+        self._timeout_id = None
+        stage = ACTIVATION_STAGES.get(self._state, ("Starting",))[0]
+        self.needs_password = self._state == NM_DEVICE_STATE_NEED_AUTH
+        self._deactivate()
+        self._fail(f"Timed out: {stage.lower()} took too long.")
+        return False
+
+    # ── Ending ──
+
+    def _deactivate(self):
+        if self._active:
+            _bus_call(NM_PATH, NM_IFACE, "DeactivateConnection",
+                      GLib.Variant("(o)", (self._active,)))
+            self._active = None
+
+    def _cleanup(self):
+        self._finished = True
+        if self._timeout_id:
+            GLib.source_remove(self._timeout_id)
+            self._timeout_id = None
+        if self._handler:
+            self._device.disconnect(self._handler)
+            self._handler = None
+        self._device = None
+        self._active = None
+
+    def _fail(self, message):
+        self._cleanup()
+        self._on_done(False, message)
@@ -0,0 +1,182 @@
+"""Progress events for the bootstrapper's long-running stages.
+
+Every stage — the git fetch and checkout as well as preparing and starting
+the installer — reports :class:`Progress` events, so the loading screen can
+show a real bar and the time spent per stage can be logged.
+"""
+
+import collections
+import json
+import re
+import threading
+import time
+
+Progress = collections.namedtuple(
+    "Progress", "stage fraction done total received rate eta"
+)
+Progress.__new__.__defaults__ = (None,) * 6
+Progress.__doc__ = """*fraction* is the overall progress (0..1) across all
+stages, or None when it isn't known. *done* / *total* count the items of the
+current stage, *received* and *rate* are bytes and bytes/s, *eta* seconds."""
+
+TIMINGS_LOG = "/var/log/kutos-bootstrapper.jsonl"
+
+# git's progress stages in order, with their share of the overall bar
+GIT_STAGES = [
+    ("Counting objects", 0.05),
+    ("Compressing objects", 0.05),
+    ("Receiving objects", 0.70),
+    ("Resolving deltas", 0.10),
+    ("Updating files", 0.10),
+]
+
+_UNITS = {"bytes": 1, "KiB": 1024, "MiB": 1024 ** 2, "GiB": 1024 ** 3}
+_GIT_RE = re.compile(
+    r"^(?:remote: )?([A-Z][a-z ]+):\s+(\d+)% \((\d+)/(\d+)\)"
+    r"(?:, ([\d.]+) (bytes|KiB|MiB|GiB)(?: \| ([\d.]+) (bytes|KiB|MiB|GiB)/s)?)?"
+)
+
+
+def _size(value, unit):
+    return int(float(value) * _UNITS[unit]) if value else None
+
+
+def format_size(nbytes):
+    for unit in ("B", "KiB", "MiB"):
+        if nbytes < 1024:
+            return f"{nbytes:.0f} {unit}" if unit == "B" else f"{nbytes:.1f} {unit}"
+        nbytes /= 1024
+    return f"{nbytes:.1f} GiB"
+
+
+def describe(event):
+    """One-line summary of *event* for a progress bar."""
+    parts = []
+    if event.total:
+        parts.append(f"{event.done}/{event.total}")
+    if event.received is not None:
+        text = format_size(event.received)
+        if event.rate:
+            text += f" at {format_size(event.rate)}/s"
+        parts.append(text)
+    if event.eta is not None:
+        parts.append(f"{int(event.eta) + 1} s left")
+    return " — ".join(parts)
+
+
+class GitProgressParser:
+    """Turns ``git … --progress`` stderr into :class:`Progress` events.
+
+    git redraws its progress lines with carriage returns; every redraw is
+    one event. The overall fraction is weighted by ``GIT_STAGES``.
+    """
+
+    def __init__(self):
+        self._partial = ""
+        self._stage = None
+        self._stage_start = 0.0
+
+    def feed(self, text):
+        events = []
+        *lines, self._partial = re.split(r"\r|\n", self._partial + text)
+        for line in lines:
+            event = self.parse_line(line)
+            if event:
+                events.append(event)
+        return events
+
+    def parse_line(self, line):
+        m = _GIT_RE.match(line.strip())
+        if not m:
+            return None
+        stage = m.group(1)
+        percent, done, total = int(m.group(2)), int(m.group(3)), int(m.group(4))
+        now = time.monotonic()
+        if stage != self._stage:
+            self._stage, self._stage_start = stage, now
+
+        eta = None
+        elapsed = now - self._stage_start
+        if 0 < done < total and elapsed > 0:
+            eta = elapsed * (total - done) / done
+
+        return Progress(
+            stage, self._overall(stage, percent / 100), done, total,
+            _size(m.group(5), m.group(6)), _size(m.group(7), m.group(8)), eta,
+        )
+
+    @staticmethod
+    def _overall(stage, fraction):
+        before = 0.0
+        for name, weight in GIT_STAGES:
+            if name == stage:
+                return before + weight * fraction
+            before += weight
+        return None
+
+
+class Throttle:
+    """Passes events on at most every *interval* seconds.
+
+    The first event of a new stage always goes through, and :meth:`flush`
+    delivers the last held-back one.
+    """
+
+    def __init__(self, callback, interval=0.1):
+        self._callback = callback
+        self._interval = interval
+        self._pending = None
+        self._last = None
+        self._last_time = 0.0
+        self._lock = threading.Lock()
+
+    def push(self, event):
+        with self._lock:
+            now = time.monotonic()
+            new_stage = self._last is None or event.stage != self._last.stage
+            if not new_stage and now - self._last_time < self._interval:
+                self._pending = event
+                return
+            self._pending = None
+            self._last, self._last_time = event, now
+        self._callback(event)
+
+    def flush(self):
+        with self._lock:
+            event, self._pending = self._pending, None
+            if event:
+                self._last, self._last_time = event, time.monotonic()
+        if event:
+            self._callback(event)
+
+
+class StageTimer:
+    """Wall-clock time per stage, from the stream of events."""
+
+    def __init__(self):
+        self.timings = []
+        self._stage = None
+        self._start = 0.0
+
+    def on_event(self, event):
+        if event.stage != self._stage:
+            self._close()
+            self._stage, self._start = event.stage, time.monotonic()
+
+    def _close(self):
+        if self._stage:
+            self.timings.append((self._stage, time.monotonic() - self._start))
+
+    def save(self, path=TIMINGS_LOG):
+        self._close()
+        self._stage = None
+        record = {
+            "time": time.time(),
+            "stages": [{"stage": s, "seconds": round(t, 3)} for s, t in self.timings],
+        }
+        try:
+            with open(path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        except OSError:
+            pass
+        return record
@@ -1,31 +1,76 @@
 #!/usr/bin/env python3
 """KutOS Settings — Central configuration tool for KutOS Linux."""
 
+import ctypes
+import gc
 import sys
 import os
 import gi
 
 gi.require_version("Gtk", "4.0")
-from gi.repository import Gtk, Gdk, Gio
+from gi.repository import Gtk, Gdk, Gio, GLib
 
 APP_ID = "org.kutos.settings"
 APP_DIR = os.path.dirname(os.path.abspath(__file__))
 
+# In service mode, drop the pages after the window has been hidden this long
+RESIDENT_IDLE_TIMEOUT = 10 * 60
+
 
 class KutOSSettingsApp(Gtk.Application):
+    """The settings app.
+
+    Started with ``--gapplication-service`` (see kutos-settings.service) it
+    stays resident: the window is built up front and only hidden when closed,
+    so later launches just present it.
+    """
+
     def __init__(self):
         super().__init__(
             application_id=APP_ID,
             flags=Gio.ApplicationFlags.DEFAULT_FLAGS,
         )
+        self._window = None
+        self._idle_source = None
 
-    def do_activate(self):
+    @property
+    def resident(self):
+        return bool(self.get_flags() & Gio.ApplicationFlags.IS_SERVICE)
+
+    def do_startup(self):
+        Gtk.Application.do_startup(self)
         self._load_css()
+        if self.resident:
+            self.hold()
+            self._get_window().warm()
 
-        from ui.main_window import MainWindow
+    def do_activate(self):
+        self._get_window().present()
 
-        win = MainWindow(application=self)
-        win.present()
+    def _get_window(self):
+        if self._window is None:
+            from ui.main_window import MainWindow
+
+            self._window = MainWindow(application=self)
+            if self.resident:
+                self._window.set_hide_on_close(True)
+                self._window.connect("notify::visible", self._on_visible_changed)
+        return self._window
+
+    def _on_visible_changed(self, window, _pspec):
+        if self._idle_source:
+            GLib.source_remove(self._idle_source)
+            self._idle_source = None
+        if not window.get_visible():
+            self._idle_source = GLib.timeout_add_seconds(
+                RESIDENT_IDLE_TIMEOUT, self._on_idle_timeout
+            )
+
+    def _on_idle_timeout(self):
+        self._idle_source = None
+        self._window.drop_pages()
+        _release_memory()
+        return GLib.SOURCE_REMOVE
 
     def _load_css(self):
         css_path = os.path.join(APP_DIR, "theme", "style.css")
@@ -40,6 +85,15 @@ class KutOSSettingsApp(Gtk.Application):
         )
 
 
+def _release_memory():
+    gc.collect()
+    # Hand freed heap pages back to the kernel; glibc only
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
 def main():
     # Ensure our package is importable
     if APP_DIR not in sys.path:
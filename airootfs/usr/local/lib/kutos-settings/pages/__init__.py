@@ -0,0 +1,12 @@
+"""Settings pages.
+
+``PAGES`` lists them in sidebar order as (name, title, module, class). The
+modules are only imported when a page is first shown, so keep this package
+free of imports.
+"""
+
+PAGES = [
+    ("desktop_env", "Desktop Environment", "pages.desktop_env", "DesktopEnvPage"),
+    ("system_update", "System Update", "pages.system_update", "SystemUpdatePage"),
+    ("about", "About", "pages.about", "AboutPage"),
+]
@@ -7,7 +7,10 @@ import gi
 gi.require_version("Gtk", "4.0")
 from gi.repository import Gtk, GLib
 
-from utils.downloader import download_and_extract
+from utils import settings, snapshots
+from utils.downloader import download_and_extract, is_cached
+from utils.prefetch import Prefetcher
+from utils.units import format_size
 
 DE_CONFIGS = {
     "XFCE": "https://github.com/kutos-linux/configs/raw/main/xfce.tar.gz",
@@ -25,7 +28,7 @@ DE_ICONS = {
 
 
 class DesktopEnvPage(Gtk.Box):
-    def __init__(self):
+    def __init__(self, prefetch=None):
         super().__init__(orientation=Gtk.Orientation.VERTICAL, spacing=0)
         self.set_margin_top(40)
         self.set_margin_bottom(40)
@@ -55,18 +58,71 @@ class DesktopEnvPage(Gtk.Box):
         grid.set_halign(Gtk.Align.FILL)
         grid.set_hexpand(True)
 
+        self._cards = {}
         for i, (name, url) in enumerate(DE_CONFIGS.items()):
             card = self._make_de_card(name, url)
             grid.attach(card, i % 2, i // 2, 1, 1)
+            if is_cached(url):
+                self._mark_ready(name)
 
         self.append(grid)
 
+        # Background download toggle
+        prefetch_row = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=12)
+        prefetch_row.set_margin_top(20)
+
+        prefetch_label = Gtk.Label(label="Download all configurations in the background")
+        prefetch_label.add_css_class("status-text")
+        prefetch_label.set_hexpand(True)
+        prefetch_label.set_halign(Gtk.Align.START)
+        prefetch_row.append(prefetch_label)
+
+        self.prefetch_switch = Gtk.Switch()
+        self.prefetch_switch.set_valign(Gtk.Align.CENTER)
+        prefetch_row.append(self.prefetch_switch)
+
+        self.append(prefetch_row)
+
+        # Undo the last apply from its snapshot of ~/.config
+        revert_row = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=12)
+        revert_row.set_margin_top(12)
+
+        self.revert_label = Gtk.Label()
+        self.revert_label.add_css_class("status-text")
+        self.revert_label.set_hexpand(True)
+        self.revert_label.set_halign(Gtk.Align.START)
+        revert_row.append(self.revert_label)
+
+        self.revert_btn = Gtk.Button(label="Revert")
+        self.revert_btn.set_valign(Gtk.Align.CENTER)
+        self.revert_btn.connect("clicked", self._on_revert_clicked)
+        revert_row.append(self.revert_btn)
+
+        self.append(revert_row)
+
         # Status area
         self.status_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=10)
         self.status_box.set_margin_top(30)
         self.status_box.set_halign(Gtk.Align.CENTER)
         self.append(self.status_box)
 
+        self._prefetcher = None
+        self._applying = 0
+        self._update_revert()
+        # Off unless the user turned it on: it downloads every desktop's config
+        if prefetch is None:
+            prefetch = bool(settings.get("prefetch"))
+        self.prefetch_switch.set_active(prefetch)
+        self.prefetch_switch.connect("notify::active", self._on_prefetch_toggled)
+        self.connect("destroy", lambda _w: self._stop_prefetch())
+        if prefetch:
+            self._start_prefetch()
+
+    @property
+    def busy(self):
+        """True while a configuration is being downloaded or applied."""
+        return self._applying > 0
+
     def _make_de_card(self, name, url):
         card = Gtk.Button()
         card.add_css_class("de-card")
@@ -88,8 +144,40 @@ class DesktopEnvPage(Gtk.Box):
 
         card.set_child(box)
         card.connect("clicked", self._on_de_clicked, name, url)
+        self._cards[name] = (card, desc)
         return card
 
+    def _mark_ready(self, name):
+        card, desc = self._cards[name]
+        card.add_css_class("de-card-ready")
+        desc.set_label(f"{name} configuration ready to apply")
+
+    def _start_prefetch(self):
+        urls = [url for url in DE_CONFIGS.values() if not is_cached(url)]
+        if not urls:
+            return
+        self._prefetcher = Prefetcher(
+            urls, on_ready=lambda url: GLib.idle_add(self._on_prefetch_ready, url)
+        )
+        self._prefetcher.start()
+
+    def _stop_prefetch(self):
+        if self._prefetcher:
+            self._prefetcher.cancel()
+            self._prefetcher = None
+
+    def _on_prefetch_toggled(self, switch, _pspec):
+        settings.put("prefetch", switch.get_active())
+        if switch.get_active():
+            self._start_prefetch()
+        else:
+            self._stop_prefetch()
+
+    def _on_prefetch_ready(self, url):
+        for name, de_url in DE_CONFIGS.items():
+            if de_url == url:
+                self._mark_ready(name)
+
     def _on_de_clicked(self, _button, name, url):
         # Clear previous status
         child = self.status_box.get_first_child()
@@ -98,34 +186,60 @@ class DesktopEnvPage(Gtk.Box):
             self.status_box.remove(child)
             child = next_child
 
-        # Show spinner
-        spinner_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=12)
-        spinner_box.set_halign(Gtk.Align.CENTER)
-
-        spinner = Gtk.Spinner()
-        spinner.start()
-        spinner_box.append(spinner)
-
+        # Show progress
         lbl = Gtk.Label(label=f"Downloading {name} configuration…")
         lbl.add_css_class("status-text")
-        spinner_box.append(lbl)
+        self.status_box.append(lbl)
 
-        self.status_box.append(spinner_box)
+        progress_bar = Gtk.ProgressBar()
+        progress_bar.set_show_text(True)
+        progress_bar.set_text("Connecting…")
+        progress_bar.set_size_request(360, -1)
+        progress_bar.add_css_class("download-progress")
+        self.status_box.append(progress_bar)
 
         # Start download in background
+        self._applying += 1
+        self.revert_btn.set_sensitive(False)
         threading.Thread(
             target=self._download_config,
-            args=(name, url, spinner),
+            args=(name, url, progress_bar),
             daemon=True,
         ).start()
 
-    def _download_config(self, name, url, spinner):
-        success, message = download_and_extract(url)
-        GLib.idle_add(self._on_download_done, name, success, message, spinner)
+    def _download_config(self, name, url, progress_bar):
+        def on_progress(progress):
+            GLib.idle_add(self._on_download_progress, progress_bar, progress)
+
+        job = self._prefetcher.job(url) if self._prefetcher else None
+        if job and job.promote(on_progress):
+            # Already downloading in the background: let it finish at full speed
+            if job.wait():
+                success, message, report = download_and_extract(url, revalidate=False)
+                GLib.idle_add(self._on_download_done, name, success, message, report)
+                return
+        elif job:
+            job.cancel()
+
+        success, message, report = download_and_extract(url, progress_cb=on_progress)
+        GLib.idle_add(self._on_download_done, name, success, message, report)
+
+    def _on_download_progress(self, progress_bar, progress):
+        if progress.total:
+            progress_bar.set_fraction(min(progress.done / progress.total, 1.0))
+            text = f"{format_size(progress.done)} of {format_size(progress.total)}"
+        else:
+            progress_bar.pulse()
+            text = format_size(progress.done)
 
-    def _on_download_done(self, name, success, message, spinner):
-        spinner.stop()
+        if progress.rate:
+            text += f" — {format_size(progress.rate)}/s"
+        if progress.eta is not None and progress.done < progress.total:
+            text += f" — {int(progress.eta) + 1} s left"
+        progress_bar.set_text(text)
 
+    def _on_download_done(self, name, success, message, report):
+        self._applying -= 1
         # Clear status
         child = self.status_box.get_first_child()
         while child:
@@ -133,14 +247,51 @@ class DesktopEnvPage(Gtk.Box):
             self.status_box.remove(child)
             child = next_child
 
+        self._update_revert()
         if success:
+            self._mark_ready(name)
             self._show_dialog(
                 "Success",
-                f"{name} configuration installed successfully!",
+                f"{name} configuration installed successfully!\n{report.summary()}",
             )
         else:
             self._show_dialog("Error", f"Failed to install {name} config:\n{message}")
 
+    def _latest_snapshot(self):
+        try:
+            return snapshots.get_store().latest()
+        except OSError:
+            return None
+
+    def _update_revert(self):
+        latest = self._latest_snapshot()
+        if latest:
+            # Snapshots are labelled with the archive URL
+            name = next((n for n, u in DE_CONFIGS.items() if u == latest.label), latest.label)
+            when = GLib.DateTime.new_from_unix_local(int(latest.created)).format("%b %d, %H:%M")
+            self.revert_label.set_label(f"Revert the last apply ({name}, {when})")
+        else:
+            self.revert_label.set_label("No applied configuration to revert")
+        self.revert_btn.set_sensitive(latest is not None and not self.busy)
+
+    def _on_revert_clicked(self, _button):
+        latest = self._latest_snapshot()
+        if latest is None or self.busy:
+            return
+        self._applying += 1
+        self.revert_btn.set_sensitive(False)
+
+        def work():
+            success, message = snapshots.get_store().restore(latest.id)
+            GLib.idle_add(self._on_revert_done, success, message)
+
+        threading.Thread(target=work, daemon=True).start()
+
+    def _on_revert_done(self, success, message):
+        self._applying -= 1
+        self._update_revert()
+        self._show_dialog("Reverted" if success else "Error", message)
+
     def _show_dialog(self, title, message):
         dialog = Gtk.AlertDialog()
         dialog.set_message(title)
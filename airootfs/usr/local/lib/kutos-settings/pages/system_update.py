@@ -7,7 +7,10 @@ import gi
 gi.require_version("Gtk", "4.0")
 from gi.repository import Gtk, GLib, Pango
 
-from utils.updater import run_system_update
+from ui.terminal_view import TerminalView
+from utils import mirrors, settings, updater
+from utils.updater import check_pending_updates, run_system_update
+from utils.units import format_size
 
 
 class SystemUpdatePage(Gtk.Box):
@@ -42,69 +45,231 @@ class SystemUpdatePage(Gtk.Box):
         self.update_btn.connect("clicked", self._on_update_clicked)
         btn_box.append(self.update_btn)
 
+        self.cancel_btn = Gtk.Button(label="Cancel")
+        self.cancel_btn.add_css_class("destructive-action")
+        self.cancel_btn.connect("clicked", self._on_cancel_clicked)
+        self.cancel_btn.set_visible(False)
+        btn_box.append(self.cancel_btn)
+
         self.spinner = Gtk.Spinner()
         btn_box.append(self.spinner)
 
         self.append(btn_box)
 
+        # Ranking rewrites the mirrorlist, which the user may have curated
+        mirrors_row = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=12)
+        mirrors_row.set_margin_bottom(20)
+
+        mirrors_label = Gtk.Label(
+            label="Rank mirrors by speed before updating (rewrites the mirrorlist)"
+        )
+        mirrors_label.add_css_class("status-text")
+        mirrors_label.set_hexpand(True)
+        mirrors_label.set_halign(Gtk.Align.START)
+        mirrors_row.append(mirrors_label)
+
+        self.mirrors_switch = Gtk.Switch()
+        self.mirrors_switch.set_valign(Gtk.Align.CENTER)
+        self.mirrors_switch.set_active(bool(settings.get("rank_mirrors")))
+        self.mirrors_switch.connect(
+            "notify::active",
+            lambda switch, _pspec: settings.put("rank_mirrors", switch.get_active()),
+        )
+        mirrors_row.append(self.mirrors_switch)
+
+        self.append(mirrors_row)
+
+        # Structured progress, fed by the output parser
+        self.status_label = Gtk.Label()
+        self.status_label.add_css_class("status-text")
+        self.status_label.set_halign(Gtk.Align.START)
+        self.status_label.set_ellipsize(Pango.EllipsizeMode.END)
+        self.append(self.status_label)
+
+        self.progress_bar = Gtk.ProgressBar()
+        self.progress_bar.set_show_text(True)
+        self.progress_bar.add_css_class("download-progress")
+        self.progress_bar.set_margin_top(6)
+        self.progress_bar.set_margin_bottom(20)
+        self.progress_bar.set_visible(False)
+        self.append(self.progress_bar)
+
         # Scrollable output area
-        scrolled = Gtk.ScrolledWindow()
-        scrolled.set_vexpand(True)
-        scrolled.set_hexpand(True)
-        scrolled.set_min_content_height(300)
-        scrolled.add_css_class("output-scroll")
-
-        self.textview = Gtk.TextView()
-        self.textview.set_editable(False)
-        self.textview.set_cursor_visible(False)
-        self.textview.set_monospace(True)
-        self.textview.set_wrap_mode(Gtk.WrapMode.WORD_CHAR)
-        self.textview.set_top_margin(12)
-        self.textview.set_bottom_margin(12)
-        self.textview.set_left_margin(12)
-        self.textview.set_right_margin(12)
-        self.textview.add_css_class("terminal-output")
-
-        self.text_buffer = self.textview.get_buffer()
-
-        scrolled.set_child(self.textview)
-        self.append(scrolled)
+        self.output = TerminalView()
+        self.append(self.output)
 
         self._is_running = False
+        self._runner = None
+        self._cancel_requested = False
+        self._warnings = 0
+        self._errors = 0
+
+        # Find out what's pending before the user asks for anything
+        self.status_label.set_label("Checking for updates…")
+        threading.Thread(target=self._check_updates, daemon=True).start()
+
+    @property
+    def busy(self):
+        """True while an update is running."""
+        return self._is_running
+
+    def _check_updates(self):
+        pending = check_pending_updates()
+        GLib.idle_add(self._on_check_done, pending)
+
+    def _on_check_done(self, pending):
+        if not self._is_running:
+            self.status_label.set_label(_describe_pending(pending))
 
     def _on_update_clicked(self, _button):
         if self._is_running:
             return
 
         self._is_running = True
+        self._cancel_requested = False
         self.update_btn.set_sensitive(False)
+        self.cancel_btn.set_sensitive(True)
+        self.cancel_btn.set_visible(True)
         self.spinner.start()
-        self.text_buffer.set_text("")
+        self.output.clear()
+        self._warnings = 0
+        self._errors = 0
+        self.status_label.set_label("Starting update…")
+        self.progress_bar.set_fraction(0)
+        self.progress_bar.set_text("")
+        self.progress_bar.set_visible(True)
 
         threading.Thread(target=self._run_update, daemon=True).start()
 
     def _run_update(self):
-        def on_output(line):
-            GLib.idle_add(self._append_output, line)
+        if settings.get("rank_mirrors"):
+            # A slow or stale first mirror would dominate the whole update
+            GLib.idle_add(self.status_label.set_label, "Ranking mirrors…")
+            try:
+                _success, message = mirrors.ensure_ranked()
+            except Exception as e:
+                message = f"Mirror ranking failed: {e}"
+            self.output.append(f"{message}\n")
+        if self._cancel_requested:
+            GLib.idle_add(self._start_runner)
+            return
+
+        pending = check_pending_updates()
+        if pending and not pending.repo and not pending.aur:
+            GLib.idle_add(self._on_up_to_date)
+            return
+        if pending:
+            GLib.idle_add(self.status_label.set_label, _describe_pending(pending))
+        GLib.idle_add(self._start_runner)
+
+    def _start_runner(self):
+        if self._cancel_requested:
+            self._on_update_done(False)
+            return
 
         def on_done(success):
             GLib.idle_add(self._on_update_done, success)
 
-        run_system_update(on_output, on_done)
+        def on_event(event):
+            GLib.idle_add(self._on_update_event, event)
 
-    def _append_output(self, line):
-        end_iter = self.text_buffer.get_end_iter()
-        self.text_buffer.insert(end_iter, line)
+        # The runner calls back from its asyncio thread; TerminalView.append
+        # is thread-safe and batches lines per frame
+        self._runner = run_system_update(self.output.append, on_done, on_event)
 
-        # Auto-scroll to bottom
-        mark = self.text_buffer.create_mark(None, self.text_buffer.get_end_iter(), False)
-        self.textview.scroll_mark_onscreen(mark)
-        self.text_buffer.delete_mark(mark)
+    def _on_cancel_clicked(self, _button):
+        if not self._is_running:
+            return
+        self.cancel_btn.set_sensitive(False)
+        self.status_label.set_label("Cancelling…")
+        self._cancel_requested = True
+        if self._runner:
+            self._runner.cancel()
 
-    def _on_update_done(self, success):
+    def _on_update_event(self, event):
+        bar = self.progress_bar
+        if isinstance(event, updater.Phase):
+            self.status_label.set_label(event.title)
+        elif isinstance(event, updater.SyncDb):
+            bar.pulse()
+            bar.set_text(f"Synchronizing {event.repo} ({event.status})")
+        elif isinstance(event, updater.Download):
+            bar.set_fraction(event.percent / 100)
+            bar.set_text(
+                f"Downloading {event.name} — {format_size(event.done)} of "
+                f"{format_size(event.total)} — {format_size(event.rate)}/s"
+            )
+        elif isinstance(event, updater.Step):
+            if event.total:
+                bar.set_fraction(event.current / event.total)
+                bar.set_text(
+                    f"{event.action.capitalize()} {event.name} "
+                    f"({event.current}/{event.total})"
+                )
+            else:
+                bar.pulse()
+                bar.set_text(f"{event.action.capitalize()} {event.name}")
+        elif isinstance(event, updater.Hook):
+            bar.set_fraction(event.current / event.total)
+            bar.set_text(f"{event.description} ({event.current}/{event.total})")
+        elif isinstance(event, updater.Totals):
+            self.status_label.set_label(
+                f"Downloading {format_size(event.download)}, "
+                f"{format_size(event.installed)} installed"
+            )
+        elif isinstance(event, updater.Message):
+            if event.level == "error":
+                self._errors += 1
+            else:
+                self._warnings += 1
+
+    def _finish(self):
         self.spinner.stop()
         self.update_btn.set_sensitive(True)
+        self.cancel_btn.set_visible(False)
         self._is_running = False
+        self._runner = None
 
-        status = "\n✓ Update completed successfully." if success else "\n✗ Update finished with errors."
-        self._append_output(status + "\n")
+    def _on_up_to_date(self):
+        self._finish()
+        self.progress_bar.set_visible(False)
+        self.status_label.set_label("Your system is up to date.")
+        self.output.append("✓ Nothing to do — your system is up to date.\n")
+
+    def _on_update_done(self, success):
+        runner = self._runner
+        self._finish()
+        self.progress_bar.set_visible(False)
+        self.status_label.set_label(
+            f"{self._warnings} warning(s), {self._errors} error(s)"
+            if self._warnings or self._errors else ""
+        )
+
+        if self._cancel_requested:
+            status = "\n✗ Update cancelled."
+        elif runner and runner.stalled:
+            status = "\n✗ Update stopped: no progress for too long."
+        elif success:
+            status = "\n✓ Update completed successfully."
+        else:
+            status = "\n✗ Update finished with errors."
+        if runner and runner.wall_time is not None:
+            status += f" ({runner.wall_time:.0f}s)"
+        self.output.append(status + "\n")
+
+
+def _describe_pending(pending):
+    if pending is None:
+        return "Couldn't check for pending updates."
+    count = len(pending.repo) + len(pending.aur)
+    if not count:
+        return "Your system is up to date."
+    text = f"{count} update(s) pending"
+    if pending.aur:
+        text += f" ({len(pending.repo)} repo, {len(pending.aur)} AUR)"
+    if pending.repo:
+        text += (
+            f" — {format_size(pending.download_size)} to download, "
+            f"{format_size(pending.installed_size)} installed"
+        )
+    return text + "."
@@ -1,13 +1,14 @@
 """Main application window with HeaderBar and StackSidebar navigation."""
 
+import importlib
+import sys
+
 import gi
 
 gi.require_version("Gtk", "4.0")
-from gi.repository import Gtk
+from gi.repository import Gtk, GLib
 
-from pages.desktop_env import DesktopEnvPage
-from pages.system_update import SystemUpdatePage
-from pages.about import AboutPage
+from pages import PAGES
 
 
 class MainWindow(Gtk.ApplicationWindow):
@@ -16,7 +17,12 @@ class MainWindow(Gtk.ApplicationWindow):
         self.set_title("KutOS Settings")
         self.set_default_size(900, 600)
 
+        self._holders = {}
+        self._built = set()
+        self._started = False
+        self._preload = []
         self._build_ui()
+        self.add_tick_callback(self._on_first_frame)
 
     def _build_ui(self):
         # HeaderBar
@@ -47,15 +53,13 @@ class MainWindow(Gtk.ApplicationWindow):
         sidebar.set_size_request(220, -1)
         sidebar.add_css_class("sidebar")
 
-        # Add pages
-        de_page = DesktopEnvPage()
-        self.stack.add_titled(de_page, "desktop_env", "Desktop Environment")
-
-        update_page = SystemUpdatePage()
-        self.stack.add_titled(update_page, "system_update", "System Update")
-
-        about_page = AboutPage()
-        self.stack.add_titled(about_page, "about", "About")
+        # Add a placeholder per page; the real page is built on first visit
+        for name, title, _module, _cls in PAGES:
+            holder = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+            holder.append(_placeholder())
+            self._holders[name] = holder
+            self.stack.add_titled(holder, name, title)
+        self.stack.connect("notify::visible-child-name", self._on_page_changed)
 
         # Assemble
         paned.append(sidebar)
@@ -66,3 +70,81 @@ class MainWindow(Gtk.ApplicationWindow):
         paned.append(self.stack)
 
         self.set_child(paned)
+
+    def warm(self):
+        """Import the page modules in idle time, without showing anything."""
+        self._queue_preload()
+
+    def drop_pages(self):
+        """Destroy the built pages that aren't busy, to give memory back.
+
+        They are rebuilt the next time they're shown, like at startup.
+        """
+        for name, holder in self._holders.items():
+            page = holder.get_first_child()
+            if name not in self._built or getattr(page, "busy", False):
+                continue
+            holder.remove(page)
+            # Emits "destroy", so pages stop their background work
+            page.run_dispose()
+            holder.append(_placeholder())
+            self._built.discard(name)
+
+        if self._started:
+            self._started = False
+            self.add_tick_callback(self._on_first_frame)
+
+    def _on_first_frame(self, _widget, _frame_clock):
+        # Tick callbacks run before the frame is painted; wait for idle time
+        GLib.idle_add(self._after_first_frame, priority=GLib.PRIORITY_LOW)
+        return GLib.SOURCE_REMOVE
+
+    def _after_first_frame(self):
+        self._started = True
+        self._ensure_page(self.stack.get_visible_child_name())
+        self._queue_preload()
+        return GLib.SOURCE_REMOVE
+
+    def _queue_preload(self):
+        # Warm the remaining modules one per idle slot, so the first visit
+        # to those pages doesn't stall on squashfs reads
+        scheduled = bool(self._preload)
+        self._preload = [
+            module for _name, _title, module, _cls in PAGES if module not in sys.modules
+        ]
+        if self._preload and not scheduled:
+            GLib.idle_add(self._preload_next, priority=GLib.PRIORITY_LOW)
+
+    def _preload_next(self):
+        if not self._preload:
+            return GLib.SOURCE_REMOVE
+        importlib.import_module(self._preload.pop(0))
+        return GLib.SOURCE_CONTINUE
+
+    def _on_page_changed(self, stack, _pspec):
+        if self._started:
+            self._ensure_page(stack.get_visible_child_name())
+
+    def _ensure_page(self, name):
+        if name in self._built:
+            return
+        self._built.add(name)
+        for page_name, _title, module, cls in PAGES:
+            if page_name == name:
+                break
+        else:
+            return
+
+        page = getattr(importlib.import_module(module), cls)()
+        page.set_hexpand(True)
+        page.set_vexpand(True)
+        holder = self._holders[name]
+        holder.remove(holder.get_first_child())
+        holder.append(page)
+
+
+def _placeholder():
+    spinner = Gtk.Spinner(spinning=True)
+    spinner.set_vexpand(True)
+    spinner.set_valign(Gtk.Align.CENTER)
+    return spinner
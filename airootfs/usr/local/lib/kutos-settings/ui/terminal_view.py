@@ -0,0 +1,95 @@
+"""Scrolling terminal-style output view fed from worker threads."""
+
+import collections
+import threading
+
+import gi
+
+gi.require_version("Gtk", "4.0")
+from gi.repository import Gtk, GLib
+
+SCROLLBACK_LINES = 5000
+
+
+class TerminalView(Gtk.ScrolledWindow):
+    """Read-only monospace output with bounded scrollback.
+
+    :meth:`append` may be called from any thread, with any amount of text.
+    It is queued line by line in a ring buffer and written to the
+    ``Gtk.TextBuffer`` at most once per frame, with a single insert and a
+    single scroll, so a chatty process can't flood the main loop. Only the
+    last *scrollback* lines are kept.
+    """
+
+    def __init__(self, scrollback=SCROLLBACK_LINES):
+        super().__init__()
+        self.scrollback = scrollback
+        self.set_vexpand(True)
+        self.set_hexpand(True)
+        self.set_min_content_height(300)
+        self.add_css_class("output-scroll")
+
+        self.textview = Gtk.TextView()
+        self.textview.set_editable(False)
+        self.textview.set_cursor_visible(False)
+        self.textview.set_monospace(True)
+        self.textview.set_wrap_mode(Gtk.WrapMode.WORD_CHAR)
+        self.textview.set_top_margin(12)
+        self.textview.set_bottom_margin(12)
+        self.textview.set_left_margin(12)
+        self.textview.set_right_margin(12)
+        self.textview.add_css_class("terminal-output")
+        self.set_child(self.textview)
+
+        self.text_buffer = self.textview.get_buffer()
+        self._end_mark = self.text_buffer.create_mark(
+            "end", self.text_buffer.get_end_iter(), False
+        )
+
+        self._pending = collections.deque(maxlen=scrollback)
+        self._lock = threading.Lock()
+        self._flush_scheduled = False
+
+    def append(self, text):
+        # Buffered per line, so the ring buffer's length bounds lines
+        # rather than calls
+        lines = text.splitlines(keepends=True)
+        if not lines:
+            return
+        with self._lock:
+            if self._pending and not self._pending[-1].endswith("\n"):
+                self._pending[-1] += lines.pop(0)
+            self._pending.extend(lines)
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        GLib.idle_add(self._schedule_flush)
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+        self.text_buffer.set_text("")
+
+    def _schedule_flush(self):
+        # Tick callbacks run once per frame, and only while we're mapped
+        self.textview.add_tick_callback(self._on_tick)
+        return GLib.SOURCE_REMOVE
+
+    def _on_tick(self, _widget, _frame_clock):
+        with self._lock:
+            text = "".join(self._pending)
+            self._pending.clear()
+            self._flush_scheduled = False
+
+        if text:
+            self.text_buffer.insert(self.text_buffer.get_end_iter(), text)
+            self._trim()
+            self.textview.scroll_mark_onscreen(self._end_mark)
+        return GLib.SOURCE_REMOVE
+
+    def _trim(self):
+        excess = self.text_buffer.get_line_count() - self.scrollback
+        if excess <= 0:
+            return
+        _found, cut = self.text_buffer.get_iter_at_line(excess)
+        self.text_buffer.delete(self.text_buffer.get_start_iter(), cut)
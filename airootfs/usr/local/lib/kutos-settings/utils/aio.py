@@ -0,0 +1,37 @@
+"""Shared asyncio event loop for background I/O.
+
+GTK owns the main thread, so coroutines run on a single asyncio loop in one
+background thread instead of a thread per task. Results go back to the UI
+the usual way, through ``GLib.idle_add``.
+"""
+
+import asyncio
+import threading
+
+_loop = None
+_lock = threading.Lock()
+
+
+def get_loop():
+    """Return the shared loop, starting its thread on first use."""
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_loop.run_forever, name="asyncio", daemon=True
+            ).start()
+        return _loop
+
+
+def submit(coro):
+    """Schedule *coro* on the shared loop from any thread.
+
+    Returns a :class:`concurrent.futures.Future` for its result.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+def call_soon(callback, *args):
+    """Run *callback(*args)* on the shared loop's thread."""
+    get_loop().call_soon_threadsafe(callback, *args)
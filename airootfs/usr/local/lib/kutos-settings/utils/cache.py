@@ -0,0 +1,202 @@
+"""On-disk, content-addressed cache for downloaded config archives.
+
+Archives live under ``~/.cache/kutos-settings/blobs/<sha256>``. A small JSON
+index maps each URL to its blob together with the ETag / Last-Modified the
+server sent, so the next download can be revalidated with a conditional
+request. Least-recently-used entries are evicted once the cache grows past
+its size cap.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "kutos-settings",
+)
+MAX_CACHE_BYTES = 128 * 1024 * 1024
+
+
+class CacheWriter:
+    """Spools a download into the cache while it is being consumed.
+
+    Use :meth:`tee` to pass chunks through, then :meth:`commit` once the body
+    is complete. Used as a context manager, an uncommitted file is discarded.
+    """
+
+    def __init__(self, cache, url, etag=None, last_modified=None):
+        self._cache = cache
+        self._url = url
+        self._etag = etag
+        self._last_modified = last_modified
+        self._hash = hashlib.sha256()
+        self.size = 0
+        fd, self.tmp_path = tempfile.mkstemp(dir=cache.blob_dir, suffix=".part")
+        self._file = os.fdopen(fd, "wb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc):
+        self.discard()
+        return False
+
+    def write(self, chunk):
+        self._file.write(chunk)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+
+    def tee(self, chunks):
+        for chunk in chunks:
+            self.write(chunk)
+            yield chunk
+
+    def commit(self):
+        """Move the spooled file into place and return its cached path."""
+        self._file.close()
+        path = self._cache._add(
+            self._url, self.tmp_path, self._hash.hexdigest(), self.size,
+            self._etag, self._last_modified,
+        )
+        self.tmp_path = None
+        return path
+
+    def discard(self):
+        if not self._file.closed:
+            self._file.close()
+        if self.tmp_path and os.path.exists(self.tmp_path):
+            os.unlink(self.tmp_path)
+        self.tmp_path = None
+
+
+class ArchiveCache:
+    def __init__(self, root=None, max_bytes=MAX_CACHE_BYTES):
+        self.root = root or CACHE_DIR
+        self.blob_dir = os.path.join(self.root, "blobs")
+        self.partial_dir = os.path.join(self.root, "partial")
+        self.max_bytes = max_bytes
+        self._index_path = os.path.join(self.root, "index.json")
+        self._lock = threading.Lock()
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.partial_dir, exist_ok=True)
+
+    def lookup(self, url):
+        """Return the index entry for *url* if its blob is still on disk."""
+        with self._lock:
+            entry = self._load().get(url)
+        if entry and os.path.exists(self._blob_path(entry["sha256"])):
+            return entry
+        return None
+
+    def path_for(self, url):
+        entry = self.lookup(url)
+        return self._blob_path(entry["sha256"]) if entry else None
+
+    def conditional_headers(self, url):
+        """Headers that let the server answer ``304 Not Modified``."""
+        entry = self.lookup(url)
+        headers = {}
+        if entry:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def touch(self, url):
+        with self._lock:
+            index = self._load()
+            if url in index:
+                index[url]["used"] = time.time()
+                self._save(index)
+
+    def writer(self, url, etag=None, last_modified=None):
+        return CacheWriter(self, url, etag, last_modified)
+
+    def store(self, url, path, etag=None, last_modified=None):
+        """Move the finished download at *path* into the cache."""
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        return self._add(
+            url, path, digest.hexdigest(), os.path.getsize(path),
+            etag, last_modified,
+        )
+
+    def partial_path(self, url):
+        """Stable location for an in-progress download of *url*."""
+        name = hashlib.sha256(url.encode()).hexdigest()
+        return os.path.join(self.partial_dir, name)
+
+    def total_size(self):
+        with self._lock:
+            return self._total(self._load())
+
+    def _add(self, url, tmp_path, sha256, size, etag, last_modified):
+        path = self._blob_path(sha256)
+        with self._lock:
+            if os.path.exists(path):
+                os.unlink(tmp_path)
+            else:
+                os.replace(tmp_path, path)
+
+            index = self._load()
+            index[url] = {
+                "sha256": sha256,
+                "size": size,
+                "etag": etag,
+                "last_modified": last_modified,
+                "used": time.time(),
+            }
+            self._evict(index, keep=url)
+            self._save(index)
+        return path
+
+    def _evict(self, index, keep=None):
+        by_age = sorted(
+            (u for u in index if u != keep), key=lambda u: index[u]["used"]
+        )
+        while by_age and self._total(index) > self.max_bytes:
+            entry = index.pop(by_age.pop(0))
+            if not any(e["sha256"] == entry["sha256"] for e in index.values()):
+                try:
+                    os.unlink(self._blob_path(entry["sha256"]))
+                except FileNotFoundError:
+                    pass
+
+    @staticmethod
+    def _total(index):
+        # Blobs shared by several URLs are only counted once
+        return sum({e["sha256"]: e["size"] for e in index.values()}.values())
+
+    def _blob_path(self, sha256):
+        return os.path.join(self.blob_dir, sha256)
+
+    def _load(self):
+        try:
+            with open(self._index_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save(self, index):
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self._index_path)
+
+
+_default_cache = None
+
+
+def get_cache():
+    """Return the process-wide archive cache."""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = ArchiveCache()
+    return _default_cache
@@ -0,0 +1,310 @@
+"""Block-level delta downloads of config archives, in the style of zsync.
+
+Next to an archive, the server may publish a block index
+(``<archive>.blocks``): the archive's size and SHA-256, and for every
+fixed-size block a weak rolling checksum and a strong hash. Given the index
+and an older copy of the archive, the old copy is scanned for blocks of the
+new one at any offset; only blocks found nowhere are fetched, with HTTP
+``Range`` requests. The rebuilt file must match the published SHA-256.
+
+Blocks only survive an edit if the compressor resynchronises after it, as
+``gzip --rsyncable`` and ``zstd --rsyncable`` do; in an ordinary compressed
+archive everything after the first changed byte differs.
+
+Generate indexes next to the archives before publishing them::
+
+    python3 -m utils.delta make xfce.tar.zst kde.tar.zst …
+"""
+
+import argparse
+import base64
+import collections
+import hashlib
+import itertools
+import json
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import fetcher, net
+
+INDEX_SUFFIX = ".blocks"
+INDEX_VERSION = 1
+MIN_BLOCK_SIZE = 1024
+MAX_BLOCK_SIZE = 64 * 1024
+STRONG_SIZE = 8
+# Below this share of reusable bytes a plain download is simpler and
+# not much bigger
+MIN_REUSE = 0.2
+# Missing runs closer than this many blocks are fetched as one range
+MERGE_GAP = 2
+MAX_CONNECTIONS = 4
+
+BlockIndex = collections.namedtuple("BlockIndex", "size sha256 block_size weak strong")
+BlockIndex.__doc__ = """A parsed block index: the archive's *size* and *sha256*,
+and per block of *block_size* bytes (the last one zero-padded) its *weak*
+rolling checksum and *strong* hash."""
+
+DeltaStats = collections.namedtuple("DeltaStats", "size reused fetched requests")
+DeltaStats.__doc__ = """Outcome of a delta download: bytes of the new archive
+(*size*), copied from the old copy (*reused*) and downloaded (*fetched*), in
+*requests* range requests."""
+
+
+class DeltaError(Exception):
+    pass
+
+
+# ── Checksums ──────────────────────────────────────────────────────────────
+
+def _weak(block):
+    """rsync's rolling checksum of *block*, as (a, b)."""
+    # b weighs byte i by (len - i), which is the sum of the prefix sums
+    return sum(block) & 0xFFFF, sum(itertools.accumulate(block)) & 0xFFFF
+
+
+def _strong(block):
+    return hashlib.blake2b(block, digest_size=STRONG_SIZE).digest()
+
+
+def block_size_for(size):
+    """Power of two near sqrt(*size*): index size and wasted bytes per
+    changed spot grow in opposite directions."""
+    bits = round(max(size, 1).bit_length() / 2)
+    return min(MAX_BLOCK_SIZE, max(MIN_BLOCK_SIZE, 1 << bits))
+
+
+# ── Index ──────────────────────────────────────────────────────────────────
+
+def make_index(path, block_size=None):
+    """Return the block index of the file at *path* as a JSON-ready dict."""
+    size = os.path.getsize(path)
+    block_size = block_size or block_size_for(size)
+    digest = hashlib.sha256()
+    weak = []
+    strong = []
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+            block = block.ljust(block_size, b"\0")
+            a, b = _weak(block)
+            weak.append(a | b << 16)
+            strong.append(_strong(block))
+    return {
+        "version": INDEX_VERSION,
+        "size": size,
+        "sha256": digest.hexdigest(),
+        "block_size": block_size,
+        "weak": base64.b64encode(struct.pack(f"<{len(weak)}I", *weak)).decode(),
+        "strong": base64.b64encode(b"".join(strong)).decode(),
+    }
+
+
+def parse_index(data):
+    """Parse a block index from its JSON text; raises DeltaError."""
+    try:
+        raw = json.loads(data)
+        if raw["version"] != INDEX_VERSION:
+            raise DeltaError(f"unsupported index version {raw['version']}")
+        block_size = int(raw["block_size"])
+        size = int(raw["size"])
+        if block_size <= 0 or size < 0:
+            raise DeltaError("invalid block size")
+        weak_bytes = base64.b64decode(raw["weak"])
+        strong_bytes = base64.b64decode(raw["strong"])
+        count = -(-size // block_size)
+        weak = list(struct.unpack(f"<{count}I", weak_bytes))
+        strong = [
+            strong_bytes[i:i + STRONG_SIZE]
+            for i in range(0, len(strong_bytes), STRONG_SIZE)
+        ]
+        if len(strong) != count:
+            raise DeltaError("index does not match the archive size")
+        return BlockIndex(size, raw["sha256"], block_size, weak, strong)
+    except (ValueError, KeyError, TypeError, struct.error) as e:
+        raise DeltaError(f"malformed block index: {e}") from e
+
+
+def fetch_index(url):
+    """Download and parse the index at *url*; returns (index, bytes read).
+
+    Raises ``requests.RequestException`` or DeltaError.
+    """
+    response = net.get(url)
+    response.raise_for_status()
+    return parse_index(response.content), len(response.content)
+
+
+# ── Matching ───────────────────────────────────────────────────────────────
+
+def match_blocks(index, data):
+    """Return {block number: offset in *data*} for the blocks of *index*
+    that occur anywhere in *data*."""
+    size = index.block_size
+    by_weak = {}
+    for n, weak in enumerate(index.weak):
+        by_weak.setdefault(weak, []).append(n)
+    strong = index.strong
+
+    # Zero padding lets the padded last block match at the end of the data
+    data = bytes(data) + bytes(size)
+    last = len(data) - size
+    found = {}
+    pos = 0
+    a, b = _weak(data[:size])
+    while pos <= last and len(found) < len(strong):
+        candidates = by_weak.get(a | b << 16)
+        if candidates:
+            digest = _strong(data[pos:pos + size])
+            hit = False
+            for n in candidates:
+                if strong[n] == digest:
+                    hit = True
+                    found.setdefault(n, pos)
+            if hit:
+                # Matched blocks usually come in runs: skip ahead a block
+                pos += size
+                if pos <= last:
+                    a, b = _weak(data[pos:pos + size])
+                continue
+        if pos == last:
+            break
+        old = data[pos]
+        a = (a - old + data[pos + size]) & 0xFFFF
+        b = (b - size * old + a) & 0xFFFF
+        pos += 1
+    return found
+
+
+def _missing_ranges(index, found):
+    """Byte ranges (start, end inclusive) of the blocks not in *found*,
+    with small gaps merged so there are fewer requests."""
+    size = index.block_size
+    runs = []
+    for n in range(len(index.weak)):
+        if n in found:
+            continue
+        if runs and n - runs[-1][1] <= MERGE_GAP:
+            runs[-1][1] = n
+        else:
+            runs.append([n, n])
+    return [
+        (first * size, min((last + 1) * size, index.size) - 1)
+        for first, last in runs
+    ]
+
+
+# ── Download ───────────────────────────────────────────────────────────────
+
+def _fetch_range(url, fd, start, end, validator, tracker, limiter):
+    headers = {"Range": f"bytes={start}-{end}", "Accept-Encoding": "identity"}
+    if validator:
+        # A changed archive comes back as 200 instead of mixing versions
+        headers["If-Range"] = validator
+    with net.get(url, headers=headers, stream=True, limiter=limiter) as response:
+        if response.status_code != 206:
+            response.raise_for_status()
+            raise DeltaError(f"server ignored range request (HTTP {response.status_code})")
+        pos = start
+        for chunk in response.iter_content(chunk_size=fetcher.CHUNK_SIZE):
+            chunk = chunk[: end - pos + 1]
+            os.pwrite(fd, chunk, pos)
+            pos += len(chunk)
+            tracker.add(len(chunk))
+            if pos > end:
+                break
+    if pos != end + 1:
+        raise DeltaError(f"short range response at byte {pos}")
+    return end - start + 1
+
+
+def fetch(
+    url, old_path, out_path, index, validator=None, progress_cb=None, limiter=None,
+    connections=MAX_CONNECTIONS,
+):
+    """Build the archive described by *index* at *out_path*, from the old
+    copy at *old_path* plus ranges of *url*.
+
+    *validator* (the ETag or Last-Modified of the new archive) guards the
+    range requests against the file changing meanwhile; *limiter* is an
+    optional :class:`utils.net.RateLimiter`. At most *connections* ranges
+    are requested at once. Returns DeltaStats.
+    Raises DeltaError (also when too little is shared to be worth it),
+    ``requests.RequestException`` or OSError.
+    """
+    with open(old_path, "rb") as f:
+        data = f.read()
+    found = match_blocks(index, data)
+
+    block_size = index.block_size
+    reused = sum(
+        min(block_size, index.size - n * block_size) for n in found
+    )
+    if reused < index.size * MIN_REUSE:
+        raise DeltaError(f"only {reused} of {index.size} bytes can be reused")
+
+    ranges = _missing_ranges(index, found)
+    tracker = fetcher.ProgressTracker(sum(e - s + 1 for s, e in ranges), 0, progress_cb)
+    with open(out_path, "wb") as out:
+        out.truncate(index.size)
+        fd = out.fileno()
+        for n, offset in found.items():
+            length = min(block_size, index.size - n * block_size)
+            os.pwrite(fd, data[offset:offset + length], n * block_size)
+        del data
+
+        fetched = 0
+        if ranges:
+            with ThreadPoolExecutor(max_workers=min(connections, len(ranges))) as pool:
+                futures = [
+                    pool.submit(_fetch_range, url, fd, start, end, validator, tracker, limiter)
+                    for start, end in ranges
+                ]
+                fetched = sum(future.result() for future in futures)
+    tracker.finish()
+
+    digest = hashlib.sha256()
+    with open(out_path, "rb") as f:
+        for block in iter(lambda: f.read(fetcher.CHUNK_SIZE), b""):
+            digest.update(block)
+    if digest.hexdigest() != index.sha256:
+        raise DeltaError("rebuilt archive does not match the published checksum")
+    return DeltaStats(index.size, reused, fetched, len(ranges))
+
+
+# ── Command line ───────────────────────────────────────────────────────────
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog="delta", description=__doc__.splitlines()[0])
+    sub = ap.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("make", help=f"write <archive>{INDEX_SUFFIX} next to each archive")
+    p.add_argument("archives", nargs="+")
+    p.add_argument("--block-size", type=int, default=None,
+                   help="bytes per block (default: about sqrt of the size)")
+    p = sub.add_parser("compare", help="show how much of NEW could be reused from OLD")
+    p.add_argument("old")
+    p.add_argument("new")
+    args = ap.parse_args(argv)
+
+    if args.command == "make":
+        for archive in args.archives:
+            index = make_index(archive, args.block_size)
+            tmp_path = archive + INDEX_SUFFIX + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp_path, archive + INDEX_SUFFIX)
+            print(f"{archive}{INDEX_SUFFIX}: {index['size']} bytes in blocks of {index['block_size']}")
+        return 0
+
+    index = parse_index(json.dumps(make_index(args.new)))
+    with open(args.old, "rb") as f:
+        found = match_blocks(index, f.read())
+    reused = sum(min(index.block_size, index.size - n * index.block_size) for n in found)
+    print(f"{reused} of {index.size} bytes reusable "
+          f"({100 * reused / max(index.size, 1):.0f}%), "
+          f"{len(_missing_ranges(index, found))} range request(s)")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,41 +1,664 @@
 """Download and extract desktop environment config archives."""
 
+import hashlib
+import io
 import os
 import tarfile
 import tempfile
 import requests
 
+from utils import delta, fetcher, lancache, net, snapshots
+from utils.cache import get_cache
 
-def download_and_extract(url, dest=None):
-    """Download a .tar.gz from *url* and extract to ~/.config.
+try:
+    import zstandard
+except ImportError:  # optional; without it .tar.zst archives are not requested
+    zstandard = None
 
-    Returns (success: bool, message: str).
+CHUNK_SIZE = 64 * 1024
+RANGED_MIN_SIZE = 8 * 1024 * 1024
+
+# Leading bytes of each supported compression format
+_MAGIC = (
+    (b"\x28\xb5\x2f\xfd", "zst"),
+    (b"\xfd7zXZ\x00", "xz"),
+    (b"\x1f\x8b", "gz"),
+)
+_SUFFIXES = (".tar.gz", ".tgz", ".tar.xz", ".tar.zst")
+
+# Format URLs the server answered 404 for; not asked for again this session
+_missing_urls = set()
+
+
+class _ChunkStream(io.RawIOBase):
+    """Read-only file object over an iterator of byte chunks.
+
+    Lets ``tarfile`` consume ``response.iter_content`` directly, holding at
+    most one chunk in memory at a time.
     """
-    if dest is None:
-        dest = os.path.expanduser("~/.config")
 
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._pending = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            try:
+                self._pending = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    def peek(self, size):
+        """Return up to *size* leading bytes without consuming them."""
+        while len(self._pending) < size:
+            try:
+                chunk = next(self._chunks)
+            except StopIteration:
+                break
+            self._pending = memoryview(bytes(self._pending) + chunk)
+        return bytes(self._pending[:size])
+
+
+def detect_format(head):
+    """Return the compression ("zst", "xz", "gz" or "tar") of a tar archive
+    from its first bytes."""
+    for magic, fmt in _MAGIC:
+        if head.startswith(magic):
+            return fmt
+    return "tar"
+
+
+def format_candidates(url):
+    """Return the URLs to try for *url*, best compression first.
+
+    ``xfce.tar.gz`` becomes ``xfce.tar.zst`` (if zstandard is installed),
+    ``xfce.tar.xz`` and finally ``xfce.tar.gz`` itself.
+    """
+    for suffix in _SUFFIXES:
+        if url.endswith(suffix):
+            base = url[: -len(suffix)]
+            break
+    else:
+        return [url]
+
+    suffixes = [".tar.zst"] if zstandard else []
+    suffixes += [".tar.xz", suffix if suffix in (".tar.gz", ".tgz") else ".tar.gz"]
+    return [base + s for s in suffixes]
+
+
+def _open_tar(fileobj, head, stream):
+    """Open *fileobj* as a tar archive, picking the decompressor by *head*."""
+    fmt = detect_format(head)
+    if fmt == "zst":
+        if zstandard is None:
+            raise tarfile.CompressionError("zstandard module is not installed")
+        reader = zstandard.ZstdDecompressor().stream_reader(fileobj)
+        return tarfile.open(fileobj=reader, mode="r|")
+
+    compression = "" if fmt == "tar" else fmt
+    return tarfile.open(fileobj=fileobj, mode=("r|" if stream else "r:") + compression)
+
+
+class ApplyReport:
+    """What applying an archive changed under the destination directory.
+
+    With a *snapshot* (:class:`utils.snapshots.Snapshot`), every path is
+    captured right before it is changed. *delta* holds the
+    :class:`utils.delta.DeltaStats` when only changed blocks were downloaded.
+    *snapshot_error* says why the snapshot could not be saved, if it wasn't.
+    """
+
+    def __init__(self, snapshot=None):
+        self.written = set()
+        self.skipped = set()
+        self.bytes_written = 0
+        self.snapshot = snapshot
+        self.snapshot_error = None
+        self.delta = None
+
+    def before_change(self, path):
+        if self.snapshot:
+            self.snapshot.capture(path)
+
+    def record_write(self, path, nbytes=0):
+        self.written.add(path)
+        self.skipped.discard(path)
+        self.bytes_written += nbytes
+
+    def record_skip(self, path):
+        # A file written earlier in the same apply (e.g. before a seekable
+        # fallback re-read the archive) still counts as written
+        if path not in self.written:
+            self.skipped.add(path)
+
+    def summary(self):
+        text = (
+            f"{len(self.written)} file(s) updated, {len(self.skipped)} unchanged "
+            f"({self.bytes_written / 1024:.1f} KB written)."
+        )
+        if self.delta:
+            text += (
+                f"\nDelta update: {self.delta.fetched / 1024:.1f} of "
+                f"{self.delta.size / 1024:.1f} KB downloaded, "
+                f"{(self.delta.size - self.delta.fetched) / 1024:.1f} KB saved."
+            )
+        if self.snapshot_error:
+            text += "\n" + self.snapshot_error
+        return text
+
+
+def _target_path(dest, name):
+    """Where the member *name* goes in *dest*.
+
+    Its directory is resolved with symlinks followed, so a link written by
+    an earlier member (``x -> /home/user``) can't carry a later one
+    (``x/.bashrc``) outside *dest*. Call it right before writing.
+    """
+    root = os.path.realpath(dest)
+    path = os.path.normpath(os.path.join(root, name))
+    if os.path.commonpath([root, path]) != root:
+        raise tarfile.TarError(f"Refusing to write outside {dest}: {name}")
+    if path == root:
+        return root
+    parent = os.path.realpath(os.path.dirname(path))
+    if os.path.commonpath([root, parent]) != root:
+        raise tarfile.TarError(f"Refusing to write outside {dest} through a symlink: {name}")
+    return os.path.join(parent, os.path.basename(path))
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _apply_file(tar, member, path, report):
     try:
-        response = requests.get(url, stream=True, timeout=60)
-        response.raise_for_status()
+        st = os.lstat(path)
+    except FileNotFoundError:
+        st = None
 
-        with tempfile.NamedTemporaryFile(suffix=".tar.gz", delete=False) as tmp:
-            tmp_path = tmp.name
-            for chunk in response.iter_content(chunk_size=8192):
-                tmp.write(chunk)
+    # Same size and mtime as the archive member: trust it without reading
+    if st and os.path.isfile(path) and not os.path.islink(path):
+        if st.st_size == member.size and int(st.st_mtime) == int(member.mtime):
+            report.record_skip(path)
+            return
+
+    # Spool the member next to its target, hashing as we go; identical
+    # content is dropped, anything else atomically replaces the old file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".kutos-")
+    try:
+        digest = hashlib.sha256()
+        with os.fdopen(fd, "wb") as tmp:
+            src = tar.extractfile(member)
+            for block in iter(lambda: src.read(CHUNK_SIZE), b""):
+                digest.update(block)
+                tmp.write(block)
+
+        if (
+            st and os.path.isfile(path) and not os.path.islink(path)
+            and st.st_size == member.size
+            and _file_digest(path) == digest.hexdigest()
+        ):
+            os.unlink(tmp_path)
+            report.record_skip(path)
+            return
+
+        os.chmod(tmp_path, member.mode & 0o777)
+        os.utime(tmp_path, (member.mtime, member.mtime))
+        report.before_change(path)
+        os.replace(tmp_path, path)
+        report.record_write(path, member.size)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def _apply_link(member, path, dest, report):
+    if member.issym():
+        if os.path.islink(path) and os.readlink(path) == member.linkname:
+            report.record_skip(path)
+            return
+        create = os.symlink
+        target = member.linkname
+    else:
+        target = _target_path(dest, member.linkname)
+        if os.path.exists(path) and os.path.samefile(path, target):
+            report.record_skip(path)
+            return
+        create = os.link
+
+    tmp_path = os.path.join(
+        os.path.dirname(path), f".kutos-{os.getpid()}-{os.path.basename(path)}"
+    )
+    if os.path.lexists(tmp_path):
+        os.unlink(tmp_path)
+    create(target, tmp_path)
+    report.before_change(path)
+    os.replace(tmp_path, path)
+    report.record_write(path)
+
+
+def _makedirs(path, report):
+    missing = []
+    while not os.path.lexists(path):
+        missing.append(path)
+        path = os.path.dirname(path)
+    # Outermost first, so undoing (in reverse) empties them inside out
+    for directory in reversed(missing):
+        report.before_change(directory)
+        os.makedirs(directory, exist_ok=True)
 
-        os.makedirs(dest, exist_ok=True)
 
-        with tarfile.open(tmp_path, "r:gz") as tar:
-            tar.extractall(path=dest)
+def _apply_members(tar, dest, report):
+    """Write only the members of *tar* that differ from what is in *dest*.
 
+    Works on stream-mode archives too, since members are read in order.
+    """
+    for member in tar:
+        path = _target_path(dest, member.name)
+        if member.isdir():
+            _makedirs(path, report)
+            continue
+        if not (member.isfile() or member.issym() or member.islnk()):
+            continue
+
+        _makedirs(os.path.dirname(path), report)
+        if member.isfile():
+            _apply_file(tar, member, path, report)
+        else:
+            _apply_link(member, path, dest, report)
+
+
+def _extract_stream(chunks, dest, report):
+    """Decompress and apply *chunks* as they arrive (no temp file)."""
+    stream = _ChunkStream(chunks)
+    with _open_tar(stream, stream.peek(6), stream=True) as tar:
+        _apply_members(tar, dest, report)
+
+
+def _extract_file(path, dest, report):
+    with open(path, "rb") as f:
+        head = f.read(6)
+        f.seek(0)
+        with _open_tar(f, head, stream=False) as tar:
+            _apply_members(tar, dest, report)
+
+
+def _extract_via_tempfile(response, dest, report):
+    """Spool *response* to a temp file, then extract with random access."""
+    with tempfile.NamedTemporaryFile(suffix=".tar", delete=False) as tmp:
+        tmp_path = tmp.name
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            tmp.write(chunk)
+
+    try:
+        _extract_file(tmp_path, dest, report)
+    finally:
         os.unlink(tmp_path)
-        return True, "Configuration installed successfully."
+
+
+def _tracked(chunks, tracker):
+    for chunk in chunks:
+        tracker.add(len(chunk))
+        yield chunk
+    tracker.finish()
+
+
+def _extract_into_cache(response, url, dest, cache, report, stream=True, progress_cb=None):
+    """Extract *response* while spooling it into *cache* alongside."""
+    tracker = fetcher.ProgressTracker(
+        int(response.headers.get("Content-Length") or 0), 0, progress_cb
+    )
+    with cache.writer(
+        url,
+        etag=response.headers.get("ETag"),
+        last_modified=response.headers.get("Last-Modified"),
+    ) as sink:
+        chunks = sink.tee(
+            _tracked(response.iter_content(chunk_size=CHUNK_SIZE), tracker)
+        )
+        seekable = not stream
+        if stream:
+            try:
+                _extract_stream(chunks, dest, report)
+            except tarfile.StreamError:
+                seekable = True
+
+        # The tar reader stops at the end-of-archive marker; keep the rest too
+        for _ in chunks:
+            pass
+        path = sink.commit()
+
+    if seekable:
+        _extract_file(path, dest, report)
+
+
+def _wants_ranged(response, url, cache):
+    """Large, range-capable archives (or ones already half-fetched) go
+    through the resumable multi-connection fetcher."""
+    if fetcher.has_partial(cache.partial_path(url)):
+        return True
+    info = fetcher.describe(response)
+    return info["ranges"] and info["size"] >= RANGED_MIN_SIZE
+
+
+def _download_ranged(response, url, dest, cache, report, progress_cb=None):
+    info = fetcher.describe(response)
+    response.close()
+
+    part = cache.partial_path(url)
+    fetcher.download(url, part, progress_cb=progress_cb, info=info)
+    path = cache.store(url, part, info["etag"], info["last_modified"])
+    _extract_file(path, dest, report)
+
+
+def _revalidation_headers(url, cache, peer_copy=None):
+    """Conditional headers for the cached copy of *url*.
+
+    If the copy might be patched with a block index, only the first byte is
+    asked for: a changed archive then answers 206 with its validators and
+    size, without its body streaming in while the index is checked.
+
+    A *peer_copy* (see :func:`_peer_copy`) has no validators; it can only
+    be patched.
+    """
+    headers = {} if peer_copy else cache.conditional_headers(url)
+    if (headers or peer_copy) and url + delta.INDEX_SUFFIX not in _missing_urls:
+        headers["Range"] = "bytes=0-0"
+    return headers
+
+
+def _peer_copy(url, cache):
+    """Copy *url* from the LAN cache, if there is one; returns the path.
+
+    The peer is not trusted, so its copy never goes into the cache or gets
+    applied: it is only the old copy for :func:`_fetch_delta`, whose result
+    must match the checksum in the upstream block index. The caller removes
+    the file.
+    """
+    if url + delta.INDEX_SUFFIX in _missing_urls:
+        return None
+    return lancache.fetch_archive(url, cache.partial_path(url) + ".lan")
+
+
+def _fetch_delta(
+    url, response, cache, progress_cb=None, limiter=None, old_path=None,
+    connections=delta.MAX_CONNECTIONS,
+):
+    """Rebuild the changed archive from the cached old one (or *old_path*),
+    downloading only the blocks that differ (see :mod:`utils.delta`).
+    *response* is the 206 answer to the request made with
+    :func:`_revalidation_headers`.
+
+    Returns (cached path, DeltaStats), or None if there is no usable block
+    index and the archive has to be downloaded in full.
+    """
+    old_path = old_path or cache.path_for(url)
+    index_url = url + delta.INDEX_SUFFIX
+    if response.status_code != 206 or not old_path:
+        return None
+    try:
+        index, index_bytes = delta.fetch_index(index_url)
+    except requests.HTTPError as e:
+        if e.response.status_code in (404, 410):
+            _missing_urls.add(index_url)
+        return None
+    except (requests.RequestException, delta.DeltaError):
+        return None
+
+    total = response.headers.get("Content-Range", "").rpartition("/")[2]
+    if total != str(index.size):
+        return None  # index not regenerated for this archive
+
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    part = cache.partial_path(url) + ".delta"
+    try:
+        stats = delta.fetch(
+            url, old_path, part, index,
+            validator=etag or last_modified, progress_cb=progress_cb, limiter=limiter,
+            connections=connections,
+        )
+    except (requests.RequestException, delta.DeltaError, OSError):
+        # Too little in common, a bad checksum, …: download in full instead
+        if os.path.exists(part):
+            os.unlink(part)
+        return None
+
+    path = cache.store(url, part, etag, last_modified)
+    return path, stats._replace(fetched=stats.fetched + index_bytes)
+
+
+def _negotiate(url, cache, attempt):
+    """Call *attempt(candidate_url)* for each format of *url*, best first,
+    moving on when the server doesn't have that format."""
+    candidates = [u for u in format_candidates(url) if u not in _missing_urls]
+    if cache:
+        # A format we already hold wins, so it can be revalidated with a 304
+        cached = [u for u in candidates if cache.lookup(u)]
+        candidates = cached[:1] + [u for u in candidates if u not in cached[:1]]
+    candidates = candidates or [url]
+
+    for candidate in candidates:
+        try:
+            return attempt(candidate)
+        except requests.HTTPError as e:
+            if e.response.status_code not in (404, 410) or candidate == candidates[-1]:
+                raise
+            _missing_urls.add(candidate)
+
+
+def is_cached(url):
+    """True if an archive for *url*, in any format, is in the cache."""
+    cache = get_cache()
+    return any(cache.lookup(u) for u in format_candidates(url))
+
+
+def fetch_to_cache(
+    url, progress_cb=None, cancel=None, limiter=None,
+    connections=fetcher.MAX_CONNECTIONS,
+):
+    """Make sure the archive for *url* is in the cache, without applying it.
+
+    Used for background prefetching; *cancel*, *limiter* and *connections*
+    are passed on to :func:`utils.fetcher.download`. Returns the cached path.
+    Raises ``requests.RequestException`` or ``fetcher.DownloadError``.
+    """
+    cache = get_cache()
+
+    def attempt(candidate):
+        # A peer on the LAN may have an old copy to patch
+        peer_copy = None if cache.lookup(candidate) else _peer_copy(candidate, cache)
+        try:
+            headers = _revalidation_headers(candidate, cache, peer_copy)
+            with net.get(candidate, stream=True, headers=headers) as response:
+                cached_path = cache.path_for(candidate)
+                if response.status_code == 304 and cached_path:
+                    cache.touch(candidate)
+                    return cached_path
+                response.raise_for_status()
+                # After a one-byte probe, download() asks for the real size
+                info = fetcher.describe(response) if response.status_code == 200 else None
+
+            # Closed first: the delta's range requests share the host's connections
+            if response.status_code == 206:
+                updated = _fetch_delta(
+                    candidate, response, cache, progress_cb, limiter, old_path=peer_copy,
+                    connections=connections,
+                )
+                if updated:
+                    return updated[0]
+
+            part = cache.partial_path(candidate)
+            info = fetcher.download(
+                candidate, part, progress_cb=progress_cb, info=info,
+                cancel=cancel, limiter=limiter, connections=connections,
+            )
+            return cache.store(candidate, part, info["etag"], info["last_modified"])
+        finally:
+            if peer_copy:
+                os.unlink(peer_copy)
+
+    return _negotiate(url, cache, attempt)
+
+
+def _apply_url(url, dest, cache, report, stream, progress_cb, revalidate):
+    """Fetch one archive URL and apply it; returns a status message."""
+    cached_path = cache.path_for(url) if cache else None
+    peer_copy = _peer_copy(url, cache) if cache and not cached_path else None
+    headers = _revalidation_headers(url, cache, peer_copy) if cache else {}
+
+    try:
+        if cached_path and not revalidate:
+            _extract_file(cached_path, dest, report)
+            cache.touch(url)
+            return "Configuration installed from cache."
+
+        try:
+            response = net.get(url, stream=True, headers=headers)
+        except requests.ConnectionError:
+            if not cached_path:
+                raise
+            _extract_file(cached_path, dest, report)
+            cache.touch(url)
+            return "Configuration installed from cache (offline)."
+
+        # Closed on every way out, or a failed request would keep its
+        # connection from the pool
+        try:
+            if response.status_code == 304 and cached_path:
+                response.close()
+                _extract_file(cached_path, dest, report)
+                cache.touch(url)
+                return "Configuration installed from cache."
+
+            response.raise_for_status()
+
+            if response.status_code == 206:
+                response.close()
+                updated = _fetch_delta(url, response, cache, progress_cb, old_path=peer_copy)
+                if updated:
+                    path, report.delta = updated
+                    _extract_file(path, dest, report)
+                    return "Configuration updated; only the changed parts were downloaded."
+                response = net.get(url, stream=True)
+                response.raise_for_status()
+
+            if cache and _wants_ranged(response, url, cache):
+                _download_ranged(response, url, dest, cache, report, progress_cb)
+            elif cache:
+                _extract_into_cache(response, url, dest, cache, report, stream, progress_cb)
+            elif not stream:
+                _extract_via_tempfile(response, dest, report)
+            else:
+                try:
+                    _extract_stream(response.iter_content(chunk_size=CHUNK_SIZE), dest, report)
+                except tarfile.StreamError:
+                    response.close()
+                    response = net.get(url, stream=True)
+                    response.raise_for_status()
+                    _extract_via_tempfile(response, dest, report)
+
+            return "Configuration installed successfully."
+        finally:
+            response.close()
+    finally:
+        if peer_copy:
+            os.unlink(peer_copy)
+
+
+def download_and_extract(
+    url, dest=None, stream=True, use_cache=True, progress_cb=None, revalidate=True,
+    snapshot=True,
+):
+    """Download a config archive from *url* and extract to ~/.config.
+
+    The best format the server offers is used (see :func:`format_candidates`);
+    the compression is detected from the archive's magic bytes.
+
+    Only members that differ from the files already in *dest* are written
+    (atomically); unchanged files keep their mtime.
+
+    With *stream* (the default) the archive is extracted while it downloads.
+    Archives that need seeking (e.g. hard links to earlier members) are
+    extracted again from a temp file (or the cached copy) instead.
+
+    With *use_cache*, the archive is kept in the on-disk cache and
+    revalidated on the next call; an unchanged or unreachable archive is
+    applied from the cache. Large archives are then fetched with resumable,
+    parallel range requests (see :mod:`utils.fetcher`).
+
+    *progress_cb(progress: fetcher.Progress)* is called from the download
+    thread as bytes arrive. Pass ``revalidate=False`` to apply a cached
+    archive without asking the server first (e.g. right after a prefetch).
+
+    With *snapshot*, everything the apply changes is recorded first (see
+    :mod:`utils.snapshots`), so it can be reverted. Nothing is applied if
+    the snapshot store can't be used; if the snapshot can't be saved in
+    the end, the message and the report's summary say so.
+
+    Returns (success: bool, message: str, report: ApplyReport).
+    """
+    if dest is None:
+        dest = os.path.expanduser("~/.config")
+
+    cache = None
+    snap = None
+    if snapshot:
+        try:
+            snap = snapshots.get_store().begin(dest, label=url)
+        except OSError as e:
+            # Asked to be revertible: better not to apply at all
+            return (
+                False, f"Could not prepare a snapshot to revert to: {e.strerror or e}",
+                ApplyReport(),
+            )
+    report = ApplyReport(snap)
+
+    try:
+        if use_cache:
+            cache = get_cache()
+        os.makedirs(dest, exist_ok=True)
+        message = _negotiate(
+            url, cache,
+            lambda candidate: _apply_url(
+                candidate, dest, cache, report, stream, progress_cb, revalidate
+            ),
+        )
+        success = True
 
     except requests.ConnectionError:
-        return False, "No internet connection."
+        success, message = False, "No internet connection."
     except requests.HTTPError as e:
-        return False, f"Download failed: HTTP {e.response.status_code}"
+        success, message = False, f"Download failed: HTTP {e.response.status_code}"
+    except fetcher.DownloadError as e:
+        success, message = False, f"Download failed: {e}"
     except tarfile.TarError as e:
-        return False, f"Extraction failed: {e}"
+        success, message = False, f"Extraction failed: {e}"
     except Exception as e:
-        return False, str(e)
+        success, message = False, str(e)
+    finally:
+        # Also after a failure: a half-applied config is worth undoing
+        if snap:
+            try:
+                snap.close()
+            except OSError as e:
+                report.snapshot_error = (
+                    f"The snapshot could not be saved, so this can't be reverted: "
+                    f"{e.strerror or e}"
+                )
+
+    if report.snapshot_error:
+        message += "\n" + report.snapshot_error
+    return success, message, report
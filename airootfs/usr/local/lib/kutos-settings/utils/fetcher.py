@@ -0,0 +1,295 @@
+"""Resumable, multi-connection HTTP downloads with byte-level progress.
+
+Large files are split into byte ranges fetched over several connections and
+written in place with ``os.pwrite``. Progress is checkpointed next to the
+partial file (``<path>.part`` / ``<path>.state``), so a dropped link or an
+app restart picks up where it left off instead of starting from zero.
+Servers without ``Accept-Ranges: bytes`` get a plain single-stream download.
+"""
+
+import collections
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import net
+
+CHUNK_SIZE = 64 * 1024
+MAX_CONNECTIONS = 4
+MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+RETRIES = 3
+PROGRESS_INTERVAL = 0.1
+STATE_INTERVAL = 1.0
+
+Progress = collections.namedtuple("Progress", "done total rate eta")
+Progress.__doc__ = """Bytes *done* of *total* (0 if unknown), *rate* in bytes/s,
+*eta* in seconds (None if unknown)."""
+
+
+class DownloadError(Exception):
+    pass
+
+
+class Cancelled(DownloadError):
+    def __init__(self):
+        super().__init__("Cancelled")
+
+
+class ProgressTracker:
+    """Aggregates byte counts from any number of threads.
+
+    *callback(progress: Progress)* is invoked at most every
+    ``PROGRESS_INTERVAL`` seconds, from whichever thread added the bytes.
+    """
+
+    def __init__(self, total=0, done=0, callback=None):
+        self.total = total
+        self.done = done
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._rate = 0.0
+        self._sample_time = time.monotonic()
+        self._sample_done = done
+        self._last_emit = 0.0
+
+    def add(self, nbytes):
+        with self._lock:
+            self.done += nbytes
+            now = time.monotonic()
+            if now - self._last_emit < PROGRESS_INTERVAL:
+                return
+            self._last_emit = now
+            progress = self._snapshot(now)
+        if self._callback:
+            self._callback(progress)
+
+    def finish(self):
+        with self._lock:
+            progress = self._snapshot(time.monotonic())
+        if self._callback:
+            self._callback(progress)
+
+    def _snapshot(self, now):
+        elapsed = now - self._sample_time
+        if elapsed > 0:
+            current = (self.done - self._sample_done) / elapsed
+            # Smooth the rate so the ETA doesn't jump around on every chunk
+            self._rate = current if not self._rate else 0.7 * self._rate + 0.3 * current
+            self._sample_time = now
+            self._sample_done = self.done
+
+        eta = None
+        if self.total and self._rate > 0:
+            eta = max(self.total - self.done, 0) / self._rate
+        return Progress(self.done, self.total, self._rate, eta)
+
+
+def describe(response):
+    """Return the size / validator info download() needs from *response*."""
+    headers = response.headers
+    identity = headers.get("Content-Encoding", "identity") == "identity"
+    return {
+        "size": int(headers.get("Content-Length") or 0) if identity else 0,
+        "ranges": identity and headers.get("Accept-Ranges", "").lower() == "bytes",
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+    }
+
+
+def has_partial(path):
+    return os.path.exists(path + ".state")
+
+
+def download(
+    url, path, progress_cb=None, connections=MAX_CONNECTIONS, info=None,
+    cancel=None, limiter=None,
+):
+    """Download *url* to *path*, resuming an earlier partial download.
+
+    *info* is the result of :func:`describe` if the caller already has the
+    response headers; otherwise a HEAD request is made. Setting the *cancel*
+    event stops the transfer (keeping the partial file for later) and raises
+    :class:`Cancelled`; *limiter* is an optional :class:`utils.net.RateLimiter`.
+
+    Returns the *info* dict (size, ETag, Last-Modified).
+    Raises ``requests.RequestException`` or :class:`DownloadError`.
+    """
+    if info is None:
+        response = net.head(url, headers={"Accept-Encoding": "identity"})
+        response.raise_for_status()
+        info = describe(response)
+
+    part_path = path + ".part"
+    state_path = path + ".state"
+
+    if info["ranges"] and info["size"]:
+        state = _load_state(state_path, url, info) or _new_state(url, info, connections)
+        _download_ranged(url, part_path, state_path, state, progress_cb, cancel, limiter)
+    else:
+        _download_single(url, part_path, progress_cb, cancel, limiter)
+
+    os.replace(part_path, path)
+    if os.path.exists(state_path):
+        os.unlink(state_path)
+    return info
+
+
+def _download_single(url, part_path, progress_cb, cancel=None, limiter=None):
+    with net.get(url, stream=True, limiter=limiter) as response:
+        response.raise_for_status()
+        tracker = ProgressTracker(
+            int(response.headers.get("Content-Length") or 0), 0, progress_cb
+        )
+        with open(part_path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                if cancel and cancel.is_set():
+                    raise Cancelled()
+                f.write(chunk)
+                tracker.add(len(chunk))
+    tracker.finish()
+
+
+def _new_state(url, info, connections):
+    size = info["size"]
+    count = max(1, min(connections, size // MIN_SEGMENT_SIZE))
+    step = size // count
+    segments = []
+    for i in range(count):
+        start = i * step
+        end = size - 1 if i == count - 1 else start + step - 1
+        segments.append([start, end, 0])
+    return {
+        "url": url,
+        "size": size,
+        "etag": info["etag"],
+        "last_modified": info["last_modified"],
+        "segments": segments,
+    }
+
+
+def _load_state(state_path, url, info):
+    """Return the saved state if it still describes the same remote file."""
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if not os.path.exists(state_path[: -len(".state")] + ".part"):
+        return None
+    if state.get("url") != url or state.get("size") != info["size"]:
+        return None
+    if state.get("etag") != info["etag"]:
+        return None
+    if state.get("last_modified") != info["last_modified"]:
+        return None
+    return state
+
+
+def _save_state(state_path, state):
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+
+def _download_ranged(
+    url, part_path, state_path, state, progress_cb, cancel=None, limiter=None,
+):
+    segments = state["segments"]
+    tracker = ProgressTracker(
+        state["size"], sum(seg[2] for seg in segments), progress_cb
+    )
+    lock = threading.Lock()
+    stop = threading.Event()
+    last_save = [time.monotonic()]
+
+    def checkpoint(force=False):
+        with lock:
+            now = time.monotonic()
+            if force or now - last_save[0] >= STATE_INTERVAL:
+                last_save[0] = now
+                _save_state(state_path, state)
+
+    mode = "r+b" if os.path.exists(part_path) else "wb"
+    with open(part_path, mode) as f:
+        f.truncate(state["size"])
+        fd = f.fileno()
+        _save_state(state_path, state)
+
+        pending = [seg for seg in segments if seg[0] + seg[2] <= seg[1]]
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, len(pending))) as pool:
+                futures = [
+                    pool.submit(
+                        _fetch_segment, url, fd, seg, state["etag"],
+                        tracker, checkpoint, stop, cancel, limiter,
+                    )
+                    for seg in pending
+                ]
+                for future in futures:
+                    try:
+                        future.result()
+                    except BaseException:
+                        stop.set()
+                        raise
+        finally:
+            checkpoint(force=True)
+
+    tracker.finish()
+
+
+def _fetch_segment(
+    url, fd, seg, etag, tracker, checkpoint, stop, cancel=None, limiter=None,
+):
+    attempt = 0
+    while not stop.is_set():
+        pos = seg[0] + seg[2]
+        end = seg[1]
+        if pos > end:
+            return
+
+        headers = {"Range": f"bytes={pos}-{end}", "Accept-Encoding": "identity"}
+        if etag:
+            headers["If-Range"] = etag
+
+        start = pos
+        try:
+            # Retried here rather than in net, to resume where it broke off
+            with net.get(
+                url, headers=headers, stream=True, retries=0, limiter=limiter,
+            ) as response:
+                if response.status_code != 206:
+                    response.raise_for_status()
+                    raise DownloadError(
+                        f"Server ignored range request (HTTP {response.status_code})"
+                    )
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    if stop.is_set():
+                        return
+                    if cancel and cancel.is_set():
+                        raise Cancelled()
+                    chunk = chunk[: end - pos + 1]
+                    os.pwrite(fd, chunk, pos)
+                    pos += len(chunk)
+                    seg[2] += len(chunk)
+                    tracker.add(len(chunk))
+                    checkpoint()
+                    if pos > end:
+                        break
+            if pos > end:
+                return
+            error = DownloadError(f"Response ended early, at byte {pos} of {end + 1}")
+        except net.RETRYABLE as e:
+            error = e
+
+        # Only a break without progress counts towards RETRIES, so a body
+        # that is cut short every time can't loop forever
+        if pos > start:
+            attempt = 0
+        attempt += 1
+        if attempt > RETRIES:
+            raise error
+        time.sleep(net.backoff(attempt))
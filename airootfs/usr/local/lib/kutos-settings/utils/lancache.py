@@ -0,0 +1,500 @@
+"""LAN artifact cache: share downloads between KutOS machines.
+
+One machine runs the (opt-in) cache server; the others ask it first and fall
+back to the internet when it doesn't have something. Served over HTTP:
+
+* ``/pacman/…``        — packages from ``/var/cache/pacman/pkg``; usable
+                         as the first ``Server =`` of the mirrorlist
+* ``/installer.git/…`` — the installer snapshot, via ``git http-backend``
+* ``/archives?url=…``  — desktop config archives from the local archive cache
+
+Files go out with ``sendfile``, so the data never passes through Python.
+Using a LAN cache is opt-in on the client too: ``KUTOS_LANCACHE=URL`` or
+``kutos.lancache=URL`` on the kernel command line names the server, and the
+value ``auto`` looks for one with a UDP broadcast the server answers (the
+bootstrapper has a copy of the client side in its own ``lancache.py``).
+
+    python3 -m utils.lancache serve [--port 8090]
+    python3 -m utils.lancache find
+    python3 -m utils.lancache get URL
+"""
+
+import argparse
+import mimetypes
+import os
+import re
+import socket
+import subprocess
+import threading
+import time
+from email.utils import formatdate
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from utils.cache import ArchiveCache
+
+PORT = 8090
+DISCOVERY_PORT = 8091
+DISCOVERY_QUERY = b"KUTOS-LANCACHE?"
+DISCOVERY_REPLY = b"KUTOS-LANCACHE "
+DISCOVERY_TIMEOUT = 0.3
+# Don't broadcast again for a while after nobody answered
+NEGATIVE_TTL = 5 * 60
+# Peers are on the LAN: give up quickly and go upstream instead
+CONNECT_TIMEOUT = 2
+READ_TIMEOUT = 10
+
+PACMAN_PKG_DIR = "/var/cache/pacman/pkg"
+INSTALLER_CACHE = "/var/cache/kutos/installer.git"
+
+_PACKAGE_RE = re.compile(r"^[\w@.+-]+\.pkg\.tar(\.\w+)?(\.sig)?$")
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+# ── Server ─────────────────────────────────────────────────────────────────
+
+def _etag_matches(header, etag):
+    """Whether *etag* is one of the entity tags listed in the If-None-Match
+    *header* (``*`` matches any). The comparison is weak: ``W/`` is ignored."""
+    if not header:
+        return False
+    opaque = etag.removeprefix("W/")
+    return any(
+        tag == "*" or tag.removeprefix("W/") == opaque
+        for tag in (t.strip() for t in header.split(","))
+    )
+
+
+def _range_applies(if_range, etag, last_modified):
+    """Whether a Range request may be answered with part of the file: only
+    if its If-Range validator, when there is one, still matches exactly."""
+    if not if_range:
+        return True
+    if if_range.startswith(('"', "W/")):
+        return if_range == etag and not etag.startswith("W/")
+    return if_range == last_modified
+
+
+class CacheHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "kutos-lancache"
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            super().log_message(fmt, *args)
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        parts = urlsplit(self.path)
+        path = parts.path
+        if path == "/health":
+            self._send_bytes(b"kutos-lancache\n", head=head)
+        elif path.startswith("/pacman/"):
+            # Mirror layout ($repo/os/$arch/file) over a flat package dir.
+            # Databases aren't cached here: pacman gets a 404 and moves on
+            # to the next mirror for them
+            name = path.rsplit("/", 1)[-1]
+            if not _PACKAGE_RE.match(name) or not self.server.pkg_dir:
+                self.send_error(HTTPStatus.NOT_FOUND)
+                return
+            self._send_file(os.path.join(self.server.pkg_dir, name), head=head)
+        elif path == "/archives":
+            self._send_archive(parse_qs(parts.query).get("url", [""])[0], head)
+        elif path.startswith("/installer.git/"):
+            self._git_backend(parts)
+        else:
+            self.send_error(HTTPStatus.NOT_FOUND)
+
+    def do_POST(self):
+        parts = urlsplit(self.path)
+        if parts.path.startswith("/installer.git/"):
+            self._git_backend(parts)
+        else:
+            self.send_error(HTTPStatus.NOT_FOUND)
+
+    # ── Files ──
+
+    def _send_archive(self, url, head):
+        cache = self.server.archive_cache
+        entry = cache.lookup(url) if cache and url else None
+        if not entry:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        # The upstream validators, so clients can revalidate against the
+        # origin server later
+        self._send_file(
+            cache.path_for(url), head=head, etag=entry.get("etag"),
+            last_modified=entry.get("last_modified"),
+        )
+
+    def _send_bytes(self, body, head=False):
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def _send_file(self, path, head=False, etag=None, last_modified=None):
+        try:
+            f = open(path, "rb")
+        except OSError:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        with f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            etag = etag or f'"{st.st_size:x}-{int(st.st_mtime):x}"'
+            last_modified = last_modified or formatdate(st.st_mtime, usegmt=True)
+            if _etag_matches(self.headers.get("If-None-Match"), etag):
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            start, end = 0, size
+            m = _RANGE_RE.match(self.headers.get("Range", ""))
+            if (
+                m and size and m.group(1) + m.group(2)
+                and _range_applies(self.headers.get("If-Range"), etag, last_modified)
+            ):
+                if m.group(1):
+                    start = int(m.group(1))
+                    end = min(int(m.group(2)) + 1, size) if m.group(2) else size
+                else:
+                    start = max(0, size - int(m.group(2)))
+                if start >= end:
+                    self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(HTTPStatus.PARTIAL_CONTENT)
+                self.send_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+            else:
+                self.send_response(HTTPStatus.OK)
+
+            content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(end - start))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.end_headers()
+            if not head:
+                # Zero-copy: socket.sendfile uses os.sendfile where it can
+                self.wfile.flush()
+                self.connection.sendfile(f, start, end - start)
+                self.server.count(end - start)
+
+    # ── git ──
+
+    def _git_backend(self, parts):
+        """Hand the request to ``git http-backend`` (smart HTTP, so shallow
+        clients work)."""
+        if not self.server.installer_cache:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        root, name = os.path.split(self.server.installer_cache.rstrip("/"))
+        env = {
+            "PATH": os.environ.get("PATH", "/usr/bin:/bin"),
+            "GIT_PROJECT_ROOT": root,
+            "GIT_HTTP_EXPORT_ALL": "1",
+            "PATH_INFO": "/" + name + parts.path[len("/installer.git"):],
+            "QUERY_STRING": parts.query,
+            "REQUEST_METHOD": self.command,
+            "REMOTE_ADDR": self.client_address[0],
+            "CONTENT_TYPE": self.headers.get("Content-Type", ""),
+            # The cache usually belongs to root, not to us
+            "GIT_CONFIG_COUNT": "1",
+            "GIT_CONFIG_KEY_0": "safe.directory",
+            "GIT_CONFIG_VALUE_0": self.server.installer_cache,
+        }
+        for header in ("Git-Protocol", "Content-Encoding"):
+            if header in self.headers:
+                env["HTTP_" + header.upper().replace("-", "_")] = self.headers[header]
+
+        body = self._read_body()
+        if body is not None:
+            env["CONTENT_LENGTH"] = str(len(body))
+        try:
+            process = subprocess.run(
+                ["git", "http-backend"], input=body or b"", env=env,
+                capture_output=True, timeout=120,
+            )
+        except (OSError, subprocess.SubprocessError):
+            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR)
+            return
+
+        head, _, out = process.stdout.partition(b"\r\n\r\n")
+        if not _:
+            head, _, out = process.stdout.partition(b"\n\n")
+        status = HTTPStatus.OK
+        headers = []
+        for line in head.decode("latin-1").splitlines():
+            name, _, value = line.partition(":")
+            if name.lower() == "status":
+                status = int(value.split()[0])
+            elif name:
+                headers.append((name, value.strip()))
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+        self.server.count(len(out))
+
+    def _read_body(self):
+        if self.command != "POST":
+            return None
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    return b"".join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+
+class CacheServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, pkg_dir=PACMAN_PKG_DIR, installer_cache=INSTALLER_CACHE,
+                 archive_cache=None, verbose=False):
+        super().__init__(address, CacheHandler)
+        self.pkg_dir = pkg_dir if pkg_dir and os.path.isdir(pkg_dir) else None
+        self.installer_cache = (
+            installer_cache if installer_cache and os.path.isdir(installer_cache) else None
+        )
+        self.archive_cache = archive_cache
+        self.verbose = verbose
+        self.bytes_served = 0
+        self._lock = threading.Lock()
+
+    def count(self, nbytes):
+        with self._lock:
+            self.bytes_served += nbytes
+
+
+def answer_discovery(port, discovery_port=DISCOVERY_PORT):
+    """Answer discovery broadcasts with our HTTP port, in a daemon thread."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("", discovery_port))
+
+    def run():
+        while True:
+            data, address = sock.recvfrom(64)
+            if data == DISCOVERY_QUERY:
+                sock.sendto(DISCOVERY_REPLY + str(port).encode(), address)
+
+    threading.Thread(target=run, name="lancache-discovery", daemon=True).start()
+    return sock
+
+
+def serve(port=PORT, discovery_port=DISCOVERY_PORT, **kwargs):
+    server = CacheServer(("", port), **kwargs)
+    if discovery_port:
+        answer_discovery(server.server_port, discovery_port)
+    shared = [
+        what for what, there in (
+            ("packages", server.pkg_dir),
+            ("installer", server.installer_cache),
+            ("archives", server.archive_cache),
+        ) if there
+    ]
+    print(f"kutos-lancache: serving {', '.join(shared) or 'nothing'} on port {server.server_port}",
+          flush=True)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+# ── Client ─────────────────────────────────────────────────────────────────
+
+_lock = threading.Lock()
+_found = None  # (url or None, time)
+
+
+def _configured():
+    url = os.environ.get("KUTOS_LANCACHE")
+    if url:
+        return url
+    try:
+        with open("/proc/cmdline") as f:
+            for param in f.read().split():
+                if param.startswith("kutos.lancache="):
+                    return param.split("=", 1)[1]
+    except OSError:
+        pass
+    return None
+
+
+def discover(timeout=DISCOVERY_TIMEOUT, port=DISCOVERY_PORT):
+    """Broadcast for a cache server; return its base URL or None."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.settimeout(timeout)
+        for address in ("<broadcast>", "127.0.0.1"):
+            try:
+                sock.sendto(DISCOVERY_QUERY, (address, port))
+            except OSError:
+                pass
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            data, (host, _port) = sock.recvfrom(64)
+            if data.startswith(DISCOVERY_REPLY):
+                return f"http://{host}:{int(data[len(DISCOVERY_REPLY):])}"
+    except (OSError, ValueError):
+        pass
+    finally:
+        sock.close()
+    return None
+
+
+def find():
+    """Return the base URL of the LAN cache, or None if none is configured
+    (or, with ``auto``, none answered)."""
+    global _found
+    configured = _configured()
+    if not configured or configured == "off":
+        return None
+    if configured != "auto":
+        return configured.rstrip("/")
+    with _lock:
+        if _found and (_found[0] or time.monotonic() - _found[1] < NEGATIVE_TTL):
+            return _found[0]
+        _found = (discover(), time.monotonic())
+        return _found[0]
+
+
+def forget():
+    """Drop a discovered server that stopped answering."""
+    global _found
+    with _lock:
+        _found = None
+
+
+def alive(base, timeout=CONNECT_TIMEOUT):
+    """True if the cache server at *base* answers its health check."""
+    import requests
+
+    from utils import net
+
+    try:
+        with net.get(f"{base}/health", timeout=timeout, retries=0) as response:
+            return response.status_code == 200
+    except requests.RequestException:
+        return False
+
+
+def pacman_server():
+    """``Server =`` template for the mirrorlist, or None.
+
+    The server is asked right now: a stale entry at the top of the
+    mirrorlist would cost every download a timeout.
+    """
+    base = find()
+    if not base:
+        return None
+    if not alive(base):
+        forget()
+        return None
+    return f"{base}/pacman/$repo/os/$arch"
+
+
+def fetch_archive(url, path):
+    """Copy the archive for *url* from the LAN cache to *path*.
+
+    Returns *path*, or None if there is no LAN cache or it doesn't have the
+    archive. Anything on the LAN can answer, so the copy is not trusted: it
+    only serves as the old copy of a delta update from upstream, which is
+    checked against the upstream checksum (see :mod:`utils.downloader`).
+    """
+    import requests
+
+    from utils import net
+
+    base = find()
+    if not base:
+        return None
+    complete = False
+    try:
+        # A peer that fails is forgotten rather than retried
+        with net.get(
+            f"{base}/archives", params={"url": url}, stream=True,
+            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), retries=0,
+        ) as response:
+            if response.status_code != 200:
+                return None
+            size = 0
+            with open(path, "wb") as f:
+                for chunk in response.iter_content(64 * 1024):
+                    f.write(chunk)
+                    size += len(chunk)
+            complete = size == int(response.headers.get("Content-Length") or size)
+    except requests.ConnectionError:
+        forget()
+    except (requests.RequestException, OSError):
+        pass
+    finally:
+        if not complete and os.path.exists(path):
+            os.unlink(path)
+    return path if complete else None
+
+
+# ── Command line ───────────────────────────────────────────────────────────
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog="lancache", description=__doc__.splitlines()[0])
+    sub = ap.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("serve", help="run the cache server")
+    p.add_argument("--port", type=int, default=PORT)
+    p.add_argument("--discovery-port", type=int, default=DISCOVERY_PORT,
+                   help="UDP port to answer discovery on; 0 to disable")
+    p.add_argument("--pkg-dir", default=PACMAN_PKG_DIR)
+    p.add_argument("--installer-cache", default=INSTALLER_CACHE)
+    p.add_argument("--archive-cache", default=None,
+                   help="archive cache directory (default: the user's)")
+    p.add_argument("-v", "--verbose", action="store_true")
+    sub.add_parser("find", help="print the LAN cache URL")
+    p = sub.add_parser("get", help="copy a config archive from the LAN cache")
+    p.add_argument("url")
+    p.add_argument("-o", "--output", default=None,
+                   help="file to write (default: the archive's name)")
+    args = ap.parse_args(argv)
+
+    if args.command == "serve":
+        serve(
+            args.port, args.discovery_port, pkg_dir=args.pkg_dir,
+            installer_cache=args.installer_cache,
+            archive_cache=ArchiveCache(args.archive_cache), verbose=args.verbose,
+        )
+    elif args.command == "find":
+        base = find()
+        print(base or "no LAN cache found")
+        return 0 if base else 1
+    elif args.command == "get":
+        start = time.monotonic()
+        output = args.output or os.path.basename(urlsplit(args.url).path) or "archive"
+        path = fetch_archive(args.url, output)
+        if not path:
+            print("not available from the LAN cache")
+            return 1
+        size = os.path.getsize(path)
+        print(f"{path}: {size} bytes in {time.monotonic() - start:.2f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
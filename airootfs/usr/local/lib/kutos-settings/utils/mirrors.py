@@ -0,0 +1,384 @@
+"""Rank pacman mirrors by latency, throughput and sync freshness.
+
+Every server enabled in the mirrorlist is probed concurrently on the shared
+asyncio loop, all within one global time budget:
+
+* latency — time until ``lastsync`` at the mirror root starts arriving
+* freshness — the timestamp inside ``lastsync``, i.e. how far it lags
+* throughput — sustained rate over a sample file, for the quickest mirrors
+
+Mirrors are ordered by the time a typical package download would take.
+The ranked list is written as pacman's mirrorlist: the best ``KEEP`` first,
+the others commented out below them, so the next ranking still sees every
+server the user had enabled. The results are cached, so updates within
+``RANK_TTL`` don't probe again. Rewriting a mirrorlist the user may have
+curated is opt-in: the System Update page only ranks with the
+``rank_mirrors`` setting on (see :mod:`utils.settings`).
+
+The probes open their own connections instead of going through
+:mod:`utils.net`: a kept-alive connection or a wait for a pooled one would
+skew the latency they measure.
+"""
+
+import asyncio
+import collections
+import json
+import os
+import platform
+import re
+import ssl
+import subprocess
+import tempfile
+import time
+from urllib.parse import urljoin, urlsplit
+
+from utils import aio, lancache
+from utils.cache import CACHE_DIR
+
+MIRRORLIST = "/etc/pacman.d/mirrorlist"
+# Header line of the mirrorlists written here
+RANKED_BY = "# Ranked by kutos-settings"
+LAN_CACHE_MARK = "# LAN cache"
+RANK_CACHE = os.path.join(CACHE_DIR, "mirrors.json")
+RANK_TTL = 6 * 3600
+
+TIME_BUDGET = 15
+# Share of the budget for the latency / freshness round; the rest is for
+# measuring throughput of the best candidates
+LATENCY_SHARE = 0.4
+PROBE_CONCURRENCY = 32
+RATE_CANDIDATES = 8
+SAMPLE_BYTES = 512 * 1024
+# Mirrors lagging further behind are only used as a last resort
+MAX_LAG = 24 * 3600
+# Mirrors are compared by the time a download of this size would take, so
+# both round trips and bandwidth count
+TYPICAL_DOWNLOAD = 2 * 1024 * 1024
+KEEP = 10
+MAX_REDIRECTS = 3
+
+MirrorResult = collections.namedtuple("MirrorResult", "server latency lag rate error")
+MirrorResult.__doc__ = """Probe results for one ``Server =`` template: *latency*
+and *lag* in seconds, *rate* in bytes/s; None where it couldn't be measured.
+*error* says why a mirror is unusable, else None."""
+
+_SERVER_RE = re.compile(r"^\s*Server\s*=\s*(https?://\S+)")
+# Servers an earlier ranking commented out; only read back from our own lists
+_SPARE_RE = re.compile(r"^#Server\s*=\s*(https?://\S+)")
+_LASTSYNC_RE = re.compile(rb"\d{9,}")
+_PROBE_ERRORS = (OSError, ssl.SSLError, ValueError, IndexError, asyncio.IncompleteReadError)
+
+
+class MirrorError(Exception):
+    pass
+
+
+# ── Candidates ─────────────────────────────────────────────────────────────
+
+def candidate_servers(path=MIRRORLIST):
+    """Return the distinct HTTP(S) server templates enabled in the
+    mirrorlist at *path*, plus those an earlier ranking commented out."""
+    try:
+        with open(path) as f:
+            lines = f.readlines()
+    except OSError:
+        return []
+    ours = any(line.startswith(RANKED_BY) for line in lines)
+    servers = []
+    after_lan_mark = False
+    for line in lines:
+        m = _SERVER_RE.match(line) or (ours and _SPARE_RE.match(line))
+        # The LAN cache is added on each write, not ranked
+        if m and not after_lan_mark and m.group(1) not in servers:
+            servers.append(m.group(1))
+        after_lan_mark = ours and line.startswith(LAN_CACHE_MARK)
+    return servers
+
+
+def _root(server):
+    return server.split("$repo")[0]
+
+
+def _sample_url(server):
+    arch = platform.machine() or "x86_64"
+    return server.replace("$repo", "core").replace("$arch", arch).rstrip("/") + "/core.db"
+
+
+# ── Probes ─────────────────────────────────────────────────────────────────
+
+_ssl_context = None
+
+
+def _tls():
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context()
+    return _ssl_context
+
+
+async def _request(url):
+    """GET *url* and read the headers; returns (status, reader, writer)."""
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urlsplit(url)
+        https = parts.scheme == "https"
+        reader, writer = await asyncio.open_connection(
+            parts.hostname, parts.port or (443 if https else 80),
+            ssl=_tls() if https else None,
+        )
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        writer.write(
+            f"GET {path} HTTP/1.1\r\nHost: {parts.netloc}\r\n"
+            f"User-Agent: kutos-settings\r\nConnection: close\r\n\r\n".encode()
+        )
+        try:
+            status = int((await reader.readline()).split()[1])
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+        except BaseException:
+            writer.close()
+            raise
+
+        if status in (301, 302, 303, 307, 308) and "location" in headers:
+            writer.close()
+            url = urljoin(url, headers["location"])
+            continue
+        return status, reader, writer
+    raise MirrorError("too many redirects")
+
+
+async def probe_lastsync(server, now=None):
+    """Return (latency, lag) of *server* from its ``lastsync`` file."""
+    start = time.monotonic()
+    status, reader, writer = await _request(_root(server) + "lastsync")
+    try:
+        latency = time.monotonic() - start
+        if status != 200:
+            raise MirrorError(f"lastsync: HTTP {status}")
+        m = _LASTSYNC_RE.search(await reader.read(256))
+        if not m:
+            raise MirrorError("lastsync: no timestamp")
+        return latency, max(0, (now or time.time()) - int(m.group()))
+    finally:
+        writer.close()
+
+
+async def probe_rate(server, deadline):
+    """Return the download rate of a sample file, measured until
+    ``SAMPLE_BYTES`` arrived or the loop time *deadline* passed."""
+    loop = asyncio.get_running_loop()
+    status, reader, writer = await _request(_sample_url(server))
+    try:
+        if status != 200:
+            raise MirrorError(f"sample: HTTP {status}")
+        start = time.monotonic()
+        received = 0
+        while received < SAMPLE_BYTES:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                chunk = await asyncio.wait_for(reader.read(64 * 1024), remaining)
+            except asyncio.TimeoutError:
+                break
+            if not chunk:
+                break
+            received += len(chunk)
+        elapsed = time.monotonic() - start
+        return received / elapsed if received and elapsed > 0 else None
+    finally:
+        writer.close()
+
+
+async def _gather_until(coros, deadline):
+    """Run *coros* concurrently; results in order, None for any still
+    running at loop time *deadline* (those are cancelled)."""
+    loop = asyncio.get_running_loop()
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    if tasks:
+        await asyncio.wait(tasks, timeout=max(0, deadline - loop.time()))
+    results = []
+    for task in tasks:
+        if task.done() and not task.cancelled():
+            results.append(task.result())
+        else:
+            task.cancel()
+            results.append(None)
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return results
+
+
+async def rank(servers, budget=TIME_BUDGET):
+    """Probe *servers* and return their :class:`MirrorResult`, best first.
+
+    Never takes (much) longer than *budget* seconds: whatever hasn't
+    answered by then is ranked as timed out.
+    """
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    limit = asyncio.Semaphore(PROBE_CONCURRENCY)
+    now = time.time()
+
+    async def latency(server):
+        async with limit:
+            try:
+                return MirrorResult(server, *await probe_lastsync(server, now), None, None)
+            except _PROBE_ERRORS + (MirrorError,) as e:
+                return MirrorResult(server, None, None, None, str(e) or type(e).__name__)
+
+    found = await _gather_until(
+        [latency(s) for s in servers], start + budget * LATENCY_SHARE
+    )
+    results = {
+        server: result or MirrorResult(server, None, None, None, "timed out")
+        for server, result in zip(servers, found)
+    }
+
+    # Throughput only for the quickest up-to-date mirrors
+    fresh = sorted(
+        (r for r in results.values() if r.error is None and r.lag <= MAX_LAG),
+        key=lambda r: r.latency,
+    )[:RATE_CANDIDATES]
+    deadline = start + budget
+
+    async def rate(result):
+        try:
+            return result._replace(rate=await probe_rate(result.server, deadline))
+        except _PROBE_ERRORS + (MirrorError,):
+            return result
+
+    for result in await _gather_until([rate(r) for r in fresh], deadline + 0.5):
+        if result:
+            results[result.server] = result
+
+    return sorted(results.values(), key=_rank_key)
+
+
+def _rank_key(result):
+    if result.rate:
+        cost = result.latency + TYPICAL_DOWNLOAD / result.rate
+    else:
+        # Not measured: behind every mirror whose rate is known
+        cost = float("inf")
+    return (
+        result.error is not None,
+        result.lag is None or result.lag > MAX_LAG,
+        cost,
+        result.latency if result.latency is not None else float("inf"),
+    )
+
+
+# ── Mirrorlist and cache ───────────────────────────────────────────────────
+
+def format_mirrorlist(results, keep=KEEP, lan_server=None):
+    lines = [
+        "#",
+        "# Arch Linux repository mirrorlist",
+        f"{RANKED_BY} on {time.strftime('%Y-%m-%d %H:%M')}",
+        "#",
+        "",
+    ]
+    if lan_server:
+        # Packages a peer already downloaded; anything else 404s there and
+        # pacman moves on to the next server
+        lines += [LAN_CACHE_MARK, f"Server = {lan_server}"]
+    best = [r for r in results if r.error is None][:keep]
+    for r in best:
+        detail = f"latency {r.latency * 1000:.0f} ms, synced {r.lag / 3600:.1f} h ago"
+        if r.rate:
+            detail += f", {r.rate / 1024:.0f} KiB/s"
+        lines += [f"# {detail}", f"Server = {r.server}"]
+    rest = [r for r in results if r not in best]
+    if rest:
+        lines += ["", "# Slower or not answering; ranked again next time"]
+        lines += [f"#Server = {r.server}" for r in rest]
+    return "\n".join(lines) + "\n"
+
+
+def write_mirrorlist(results, path=MIRRORLIST, keep=KEEP, lan_server=None):
+    """Install the ranked list as *path*; returns (success, message)."""
+    if not any(r.error is None for r in results):
+        return False, "No mirror answered; keeping the current mirrorlist."
+
+    # Write next to the target if we may, else stage it for sudo
+    direct = os.access(os.path.dirname(path), os.W_OK)
+    tmp_dir = os.path.dirname(path) if direct else CACHE_DIR
+    os.makedirs(tmp_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, suffix=".mirrorlist")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(format_mirrorlist(results, keep, lan_server))
+        if direct:
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        else:
+            subprocess.run(
+                ["sudo", "-n", "install", "-m644", tmp_path, path],
+                check=True, capture_output=True, timeout=30,
+            )
+    except (OSError, subprocess.SubprocessError) as e:
+        return False, f"Could not write {path}: {e}"
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+    return True, f"Mirrorlist updated: {results[0].server}"
+
+
+def load_cached(max_age=RANK_TTL, path=RANK_CACHE):
+    """Return the cached ranking as (results, LAN server written with them,
+    time checked) if it is younger than *max_age*, else None."""
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        if time.time() - data["checked_at"] >= max_age:
+            return None
+        results = [MirrorResult(**r) for r in data["results"]]
+        return results, data.get("lan_server"), data["checked_at"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_cache(results, lan_server=None, path=RANK_CACHE, checked_at=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({
+            "checked_at": checked_at or time.time(),
+            "results": [r._asdict() for r in results],
+            "lan_server": lan_server,
+        }, f)
+    os.replace(tmp_path, path)
+
+
+def ensure_ranked(max_age=RANK_TTL, budget=TIME_BUDGET):
+    """Rank the mirrors and install the mirrorlist, unless that happened
+    within *max_age* seconds (then the list is only rewritten if the LAN
+    cache came or went). Blocks for up to *budget* seconds; call it from a
+    worker thread. Returns (success, message).
+    """
+    lan_server = lancache.pacman_server()
+    cached = load_cached(max_age)
+    if cached is not None:
+        results, written_lan, checked_at = cached
+        if written_lan == lan_server:
+            return True, "Mirrors were ranked recently."
+    else:
+        checked_at = None
+        servers = candidate_servers()
+        if len(servers) < 2:
+            return True, "Only one mirror configured; nothing to rank."
+        results = aio.submit(rank(servers, budget)).result(budget + 5)
+
+    success, message = write_mirrorlist(results, lan_server=lan_server)
+    if success:
+        try:
+            save_cache(results, lan_server, checked_at=checked_at)
+        except OSError:
+            pass
+    return success, message
@@ -0,0 +1,420 @@
+"""Shared HTTP client: pooled connections, retries, timeouts and metrics.
+
+Every HTTP request of kutos-settings goes through one ``requests.Session``,
+so repeated downloads from the same host reuse kept-alive connections
+instead of paying for DNS, TCP and TLS each time.
+
+* at most ``PER_HOST_CONNECTIONS`` connections per host; further concurrent
+  requests wait up to ``POOL_TIMEOUT`` seconds for a free one
+* connection errors, timeouts and 429 / 5xx answers are retried with
+  exponential backoff and full jitter (idempotent methods only)
+* separate connect and read timeouts
+* an optional :class:`RateLimiter` caps the bandwidth of background jobs
+* each request leaves a :class:`RequestMetric` (connect, TLS, time to
+  first byte, bytes, throughput); :func:`host_stats` sums them up per host
+
+Responses are plain ``requests.Response`` objects and failures raise the
+usual ``requests`` exceptions.
+
+Two kinds of probe deliberately bypass this client, because they measure
+the connection itself and must not reuse a kept-alive one or queue for a
+pooled slot: the mirror probes in :mod:`utils.mirrors` (raw asyncio
+sockets, timed per mirror within one budget) and the bootstrapper's
+``connectivity.probe_https`` (a HEAD request raced against other probes;
+the bootstrapper has no ``requests``).
+
+    python3 -m utils.net get URL [URL …]
+"""
+
+import argparse
+import collections
+import random
+import statistics
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+USER_AGENT = "kutos-settings"
+PER_HOST_CONNECTIONS = 6
+# How long a request waits for one of its host's connections to be free
+POOL_TIMEOUT = 30
+# Hosts with a pool of kept-alive connections
+POOLS = 16
+TIMEOUT = (10, 30)  # connect, read (between bytes)
+RETRIES = 3
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 10
+RETRY_STATUSES = (429, 502, 503, 504)
+IDEMPOTENT = ("GET", "HEAD", "OPTIONS")
+METRICS_KEEP = 500
+
+RETRYABLE = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+RequestMetric = collections.namedtuple(
+    "RequestMetric",
+    "method url status connect tls ttfb elapsed bytes rate retries error",
+)
+RequestMetric.__doc__ = """One finished request. Times are in seconds: *connect*
+(DNS lookup included) and *tls* are None when a kept-alive connection was
+reused, *ttfb*
+runs until the response headers arrived and *elapsed* until the body was
+read or dropped. *rate* is the body throughput in bytes/s, *error* the
+exception name of a failed request."""
+
+HostStats = collections.namedtuple("HostStats", "requests errors reused ttfb rate")
+HostStats.__doc__ = """Per-host summary of the kept metrics: median *ttfb* and
+median *rate* (None without data), *reused* counts requests that needed no
+new connection."""
+
+
+def backoff(attempt):
+    """Seconds to wait before retry number *attempt* (0-based): full jitter
+    over an exponentially growing window, so clients don't retry in step."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class RateLimiter:
+    """Caps combined throughput at *rate* bytes/s (``None`` = unlimited).
+
+    One limiter is shared by every connection of a download. *rate* may be
+    changed while the transfer runs, e.g. to lift the cap on a background
+    download the user is now waiting for.
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def consume(self, nbytes):
+        rate = self.rate
+        if not rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._next = max(self._next, now) + nbytes / rate
+            wake = self._next
+        # Sleep in short slices so lifting the cap takes effect promptly
+        while self.rate and time.monotonic() < wake:
+            time.sleep(min(0.1, wake - time.monotonic()))
+
+
+# ── Connection timing ──────────────────────────────────────────────────────
+
+# Connections are opened on the thread that sends the request, so their
+# timings are handed over per thread
+_local = threading.local()
+
+
+def _timing():
+    if not hasattr(_local, "timing"):
+        _local.timing = {}
+    return _local.timing
+
+
+class _TimedConnectionMixin:
+    def _new_conn(self):
+        # urllib3 resolves the name and tries each address in turn (IPv6,
+        # then IPv4), so this is DNS and TCP together
+        start = time.monotonic()
+        sock = super()._new_conn()
+        _timing()["connect"] = time.monotonic() - start
+        return sock
+
+
+class _TimedHTTPConnection(_TimedConnectionMixin, urllib3.connection.HTTPConnection):
+    pass
+
+
+class _TimedHTTPSConnection(_TimedConnectionMixin, urllib3.connection.HTTPSConnection):
+    def connect(self):
+        start = time.monotonic()
+        super().connect()
+        timing = _timing()
+        if "connect" in timing:
+            timing["tls"] = max(0.0, time.monotonic() - start - timing["connect"])
+
+
+class _PoolTimeoutMixin:
+    def _get_conn(self, timeout=None):
+        # requests never passes a pool timeout; without one a blocking pool
+        # waits forever for a connection that is never given back
+        return super()._get_conn(POOL_TIMEOUT if timeout is None else timeout)
+
+
+class _HTTPPool(_PoolTimeoutMixin, urllib3.HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _HTTPSPool(_PoolTimeoutMixin, urllib3.HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _TimedAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _HTTPPool, "https": _HTTPSPool}
+
+
+# ── Client ─────────────────────────────────────────────────────────────────
+
+class _Meter:
+    """Counts (and throttles) the body of one response; records its metric
+    once the body is read to the end or the response is closed."""
+
+    def __init__(self, client, response, metric, start, limiter):
+        self._client = client
+        self._iter_content = response.iter_content
+        self._close = response.close
+        self._metric = metric
+        self._start = start
+        self._limiter = limiter
+        self._bytes = 0
+        self._done = False
+        response.iter_content = self.iter_content
+        response.close = self.close
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        for chunk in self._iter_content(chunk_size, decode_unicode):
+            if self._limiter:
+                self._limiter.consume(len(chunk))
+            self._bytes += len(chunk)
+            yield chunk
+        self.finish()
+
+    def close(self):
+        self.finish()
+        self._close()
+
+    def finish(self, error=None):
+        if self._done:
+            return
+        self._done = True
+        elapsed = time.monotonic() - self._start
+        transfer = elapsed - self._metric.ttfb
+        self._client._record(self._metric._replace(
+            elapsed=elapsed,
+            bytes=self._bytes,
+            rate=self._bytes / transfer if self._bytes and transfer > 0 else None,
+            error=error,
+        ))
+
+
+class Client:
+    """A pooled session; use the module functions for the shared one."""
+
+    def __init__(self, per_host=PER_HOST_CONNECTIONS, timeout=TIMEOUT, retries=RETRIES):
+        self.timeout = timeout
+        self.retries = retries
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = USER_AGENT
+        # pool_block makes requests beyond *per_host* wait (up to
+        # POOL_TIMEOUT) instead of opening throwaway connections
+        adapter = _TimedAdapter(
+            pool_connections=POOLS, pool_maxsize=per_host, pool_block=True, max_retries=0,
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._metrics = collections.deque(maxlen=METRICS_KEEP)
+        self._lock = threading.Lock()
+
+    def request(self, method, url, stream=False, timeout=None, retries=None,
+                limiter=None, **kwargs):
+        """Send a request; keyword arguments as for ``requests``.
+
+        With *stream*, the body is read by the caller (who must close the
+        response); *limiter* then throttles it. *retries* overrides the
+        client's retry count.
+        """
+        method = method.upper()
+        if retries is None:
+            retries = self.retries
+        if method not in IDEMPOTENT:
+            retries = 0
+        timeout = timeout or self.timeout
+
+        attempt = 0
+        while True:
+            _local.timing = {}
+            start = time.monotonic()
+            delay = None
+            try:
+                response = self.session.request(
+                    method, url, stream=True, timeout=timeout, **kwargs
+                )
+            except urllib3.exceptions.EmptyPoolError as e:
+                # requests passes this one through as is
+                self._record(self._metric(method, url, None, start, attempt, e))
+                raise requests.ConnectionError(
+                    f"no free connection to {urlsplit(url).netloc} "
+                    f"within {POOL_TIMEOUT} s"
+                ) from e
+            except RETRYABLE as e:
+                if attempt >= retries:
+                    self._record(self._metric(method, url, None, start, attempt, e))
+                    raise
+            else:
+                metric = self._metric(method, url, response.status_code, start, attempt)
+                if response.status_code in RETRY_STATUSES and attempt < retries:
+                    delay = _retry_after(response)
+                    _discard(response)
+                else:
+                    meter = _Meter(self, response, metric, start, limiter)
+                    if stream:
+                        return response
+                    try:
+                        response.content  # read it all
+                        return response
+                    except RETRYABLE as e:
+                        meter.finish(type(e).__name__)
+                        response.close()
+                        if attempt >= retries:
+                            raise
+            time.sleep(delay if delay is not None else backoff(attempt))
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault("allow_redirects", True)
+        return self.request("HEAD", url, **kwargs)
+
+    def metrics(self):
+        """The most recent :class:`RequestMetric`, oldest first."""
+        with self._lock:
+            return list(self._metrics)
+
+    def host_stats(self):
+        """Return {host: :class:`HostStats`} over the kept metrics."""
+        by_host = collections.defaultdict(list)
+        for m in self.metrics():
+            by_host[urlsplit(m.url).netloc].append(m)
+        stats = {}
+        for host, items in by_host.items():
+            ttfbs = [m.ttfb for m in items if m.ttfb is not None]
+            rates = [m.rate for m in items if m.rate]
+            stats[host] = HostStats(
+                len(items),
+                sum(1 for m in items if m.error or (m.status or 0) >= 500),
+                sum(1 for m in items if m.connect is None and m.error is None),
+                statistics.median(ttfbs) if ttfbs else None,
+                statistics.median(rates) if rates else None,
+            )
+        return stats
+
+    @staticmethod
+    def _metric(method, url, status, start, retries, error=None):
+        timing = _timing()
+        now = time.monotonic()
+        return RequestMetric(
+            method, url, status,
+            timing.get("connect"), timing.get("tls"),
+            None if error else now - start, now - start, 0, None, retries,
+            type(error).__name__ if error else None,
+        )
+
+    def _record(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+
+def _discard(response):
+    # Error pages are small: reading them keeps the connection for the retry
+    try:
+        if int(response.headers.get("Content-Length") or 0) <= 64 * 1024:
+            response.content
+    except (requests.RequestException, ValueError):
+        pass
+    response.close()
+
+
+def _retry_after(response):
+    value = response.headers.get("Retry-After", "")
+    return min(float(value), BACKOFF_MAX) if value.isdigit() else None
+
+
+_default_client = None
+_default_lock = threading.Lock()
+
+
+def get_client():
+    """Return the process-wide client."""
+    global _default_client
+    with _default_lock:
+        if _default_client is None:
+            _default_client = Client()
+        return _default_client
+
+
+def request(method, url, **kwargs):
+    return get_client().request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return get_client().get(url, **kwargs)
+
+
+def head(url, **kwargs):
+    return get_client().head(url, **kwargs)
+
+
+def metrics():
+    return get_client().metrics()
+
+
+def host_stats():
+    return get_client().host_stats()
+
+
+# ── Command line ───────────────────────────────────────────────────────────
+
+def _ms(seconds):
+    return f"{seconds * 1000:.0f}" if seconds is not None else "-"
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog="net", description=__doc__.splitlines()[0])
+    sub = ap.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("get", help="download URLs and print the request metrics")
+    p.add_argument("urls", nargs="+")
+    p.add_argument("--repeat", type=int, default=2,
+                   help="times to get each URL (later ones reuse connections)")
+    p.add_argument("--limit", type=int, default=None, help="KiB/s")
+    args = ap.parse_args(argv)
+
+    limiter = RateLimiter(args.limit * 1024) if args.limit else None
+    for _ in range(args.repeat):
+        for url in args.urls:
+            try:
+                with get(url, stream=True, limiter=limiter) as response:
+                    for _chunk in response.iter_content(64 * 1024):
+                        pass
+            except requests.RequestException as e:
+                print(f"{url}: {e}")
+
+    print(f"{'status':>15} {'conn':>5} {'tls':>5} {'ttfb':>6} {'total':>7}"
+          f" {'KiB':>8} {'KiB/s':>8} {'retry':>5}  url (times in ms)")
+    for m in metrics():
+        rate = f"{m.rate / 1024:.0f}" if m.rate else "-"
+        print(f"{m.status or m.error:>15} {_ms(m.connect):>5} {_ms(m.tls):>5}"
+              f" {_ms(m.ttfb):>6} {_ms(m.elapsed):>7} {m.bytes / 1024:>8.1f} {rate:>8}"
+              f" {m.retries:>5}  {m.url}")
+    print()
+    for host, s in host_stats().items():
+        rate = f"{s.rate / 1024:.0f} KiB/s" if s.rate else "-"
+        print(f"{host}: {s.requests} request(s), {s.reused} on kept-alive connections, "
+              f"{s.errors} failed, median TTFB {_ms(s.ttfb)} ms, {rate}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,147 @@
+"""Background prefetching of config archives into the on-disk cache."""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from utils import fetcher, net
+from utils.downloader import fetch_to_cache
+
+MAX_WORKERS = 2
+# Combined cap for all background downloads, so they never starve the rest
+# of the system (package updates, the browser, …)
+BACKGROUND_RATE = 512 * 1024
+# Connections per background download. The workers together must leave most
+# of net.PER_HOST_CONNECTIONS free: a foreground download would otherwise
+# queue behind them in the pool (and its segments time out there)
+BACKGROUND_CONNECTIONS = 1
+
+
+class _JobLimiter:
+    """One job's share of the background budget *shared* (a
+    :class:`utils.net.RateLimiter`, or None); unlimited once *promoted*."""
+
+    def __init__(self, shared):
+        self.shared = shared
+        self.promoted = False
+
+    def consume(self, nbytes):
+        if self.shared and not self.promoted:
+            self.shared.consume(nbytes)
+
+
+class PrefetchJob:
+    """One background download. Its state is one of ``queued``, ``running``,
+    ``done``, ``failed`` or ``cancelled``. *limiter* is the budget shared
+    with the other background downloads."""
+
+    def __init__(self, url, limiter=None):
+        self.url = url
+        self.state = "queued"
+        self.error = None
+        self.limiter = _JobLimiter(limiter)
+        self._cancel = threading.Event()
+        self._finished = threading.Event()
+        self._progress_cb = None
+        self._lock = threading.Lock()
+
+    def promote(self, progress_cb=None):
+        """Take the job out of the background budget and forward progress
+        to *progress_cb*.
+
+        Returns False if the job isn't running, in which case the caller
+        should download in the foreground itself.
+        """
+        with self._lock:
+            if self.state != "running":
+                return False
+            self._progress_cb = progress_cb
+            self.limiter.promoted = True
+            return True
+
+    def cancel(self):
+        with self._lock:
+            if self.state in ("queued", "running"):
+                self._cancel.set()
+                if self.state == "queued":
+                    self._finish("cancelled")
+
+    def wait(self, timeout=None):
+        """Block until the job ends; returns True if the archive is cached."""
+        self._finished.wait(timeout)
+        return self.state == "done"
+
+    def _run(self, on_ready):
+        with self._lock:
+            if self.state != "queued":
+                return
+            self.state = "running"
+
+        try:
+            fetch_to_cache(
+                self.url, progress_cb=self._on_progress,
+                cancel=self._cancel, limiter=self.limiter,
+                connections=BACKGROUND_CONNECTIONS,
+            )
+        except fetcher.Cancelled:
+            state = "cancelled"
+        except (requests.RequestException, fetcher.DownloadError, OSError) as e:
+            self.error = str(e)
+            state = "failed"
+        else:
+            state = "done"
+
+        with self._lock:
+            self._finish(state)
+        if state == "done" and on_ready:
+            on_ready(self.url)
+
+    def _finish(self, state):
+        self.state = state
+        self._finished.set()
+
+    def _on_progress(self, progress):
+        callback = self._progress_cb
+        if callback:
+            callback(progress)
+
+
+class Prefetcher:
+    """Warms the archive cache for *urls* using a small worker pool.
+
+    *on_ready(url)* is called from a worker thread each time an archive
+    lands in the cache.
+    """
+
+    def __init__(self, urls, on_ready=None, workers=MAX_WORKERS, rate=BACKGROUND_RATE):
+        self._urls = list(urls)
+        self._on_ready = on_ready
+        self._workers = workers
+        # One bucket for all workers, so together they stay within *rate*
+        self._limiter = net.RateLimiter(rate)
+        self._jobs = {}
+        self._pool = None
+
+    def start(self):
+        if self._pool is not None:
+            return
+        self._pool = ThreadPoolExecutor(
+            max_workers=self._workers, thread_name_prefix="prefetch"
+        )
+        for url in self._urls:
+            job = PrefetchJob(url, self._limiter)
+            self._jobs[url] = job
+            self._pool.submit(job._run, self._on_ready)
+
+    def job(self, url):
+        return self._jobs.get(url)
+
+    def cancel(self):
+        """Cancel all queued and running prefetches."""
+        for job in self._jobs.values():
+            job.cancel()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+        self._jobs = {}
@@ -0,0 +1,55 @@
+"""Persisted preferences of kutos-settings.
+
+A flat JSON object in ``~/.config/kutos-settings/settings.json``. Missing
+keys, and a missing or unreadable file, fall back to ``DEFAULTS``.
+"""
+
+import json
+import os
+import threading
+
+CONFIG_DIR = os.path.join(
+    os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config"),
+    "kutos-settings",
+)
+SETTINGS_PATH = os.path.join(CONFIG_DIR, "settings.json")
+
+DEFAULTS = {
+    # Download every desktop config in the background while the page is open
+    "prefetch": False,
+    # Rank the mirrors and rewrite /etc/pacman.d/mirrorlist before updating
+    "rank_mirrors": False,
+}
+
+_lock = threading.Lock()
+
+
+def _load(path):
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def get(key, path=SETTINGS_PATH):
+    """Return the value of *key*, or its default."""
+    with _lock:
+        return _load(path).get(key, DEFAULTS.get(key))
+
+
+def put(key, value, path=SETTINGS_PATH):
+    """Store *value* for *key*; returns False if it couldn't be saved."""
+    with _lock:
+        data = _load(path)
+        data[key] = value
+        tmp_path = path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump(data, f, indent=2)
+            os.replace(tmp_path, path)
+        except OSError:
+            return False
+    return True
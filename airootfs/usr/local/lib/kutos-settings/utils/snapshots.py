@@ -0,0 +1,371 @@
+"""Snapshots of ~/.config taken while a desktop config is applied.
+
+A full copy of ~/.config before every apply would be slow and mostly
+redundant. Instead the apply engine hands each path to :meth:`Snapshot.capture`
+right before it changes it, so a snapshot holds exactly what the archive
+touched: old file contents, old symlink targets, and the paths that didn't
+exist yet (restoring removes those).
+
+File contents are content-addressed blobs, shared between snapshots. A new
+blob is a reflink of the live file where the filesystem supports it, else a
+hard link (safe because applying replaces files with a new inode; links that
+end up unreplaced are broken up again in :meth:`Snapshot.close`), else a
+copy. Restoring reflinks or renames blobs back into place, so it costs
+metadata operations rather than data copies.
+
+Layout, under ``~/.local/share/kutos-settings/snapshots``::
+
+    blobs/<sha256>
+    <id>/manifest.json
+"""
+
+import collections
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+
+SNAPSHOT_DIR = os.path.join(
+    os.environ.get("XDG_DATA_HOME") or os.path.expanduser("~/.local/share"),
+    "kutos-settings", "snapshots",
+)
+MAX_SNAPSHOTS = 10
+MAX_BYTES = 256 * 1024 * 1024
+
+# ioctl(dest_fd, FICLONE, src_fd): share the extents of src (btrfs, xfs, …)
+FICLONE = 0x40049409
+CHUNK_SIZE = 64 * 1024
+
+SnapshotInfo = collections.namedtuple("SnapshotInfo", "id label dest created paths")
+
+
+def _reflink(src, dst):
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def _clone(src, dst, allow_link=True):
+    """Make *dst* a copy of *src*, as cheaply as the filesystem allows.
+
+    Returns "reflink", "hardlink" or "copy". A hard link shares the inode,
+    so it is only right when *src* is about to be replaced (or dropped).
+    """
+    try:
+        _reflink(src, dst)
+        return "reflink"
+    except OSError:
+        if os.path.exists(dst):
+            os.unlink(dst)
+    if allow_link:
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+    return "copy"
+
+
+def _digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Snapshot:
+    """One snapshot being recorded; see :meth:`SnapshotStore.begin`."""
+
+    def __init__(self, store, snap_id, dest, label):
+        self._store = store
+        self.id = snap_id
+        self.dest = os.path.abspath(dest)
+        self.label = label
+        self.created = time.time()
+        self.entries = {}  # relative path -> entry, in capture order
+        self.methods = collections.Counter()
+        self._linked = []  # (live path, blob) sharing an inode
+        self._lock = threading.Lock()
+
+    def capture(self, path):
+        """Record *path* as it is now, unless it was captured already."""
+        rel = os.path.relpath(path, self.dest)
+        with self._lock:
+            if rel in self.entries:
+                return
+            try:
+                st = os.lstat(path)
+            except FileNotFoundError:
+                entry = {"type": "absent"}
+            else:
+                if stat.S_ISLNK(st.st_mode):
+                    entry = {"type": "symlink", "target": os.readlink(path)}
+                elif stat.S_ISREG(st.st_mode):
+                    blob = self._store._add_blob(path, self)
+                    entry = {
+                        "type": "file", "blob": blob,
+                        "mode": stat.S_IMODE(st.st_mode), "mtime": st.st_mtime,
+                    }
+                else:
+                    return  # directories are never replaced by an apply
+            self.entries[rel] = entry
+
+    def close(self):
+        """Finish recording and store the manifest (if anything changed)."""
+        with self._lock:
+            # Files captured by hard link but in the end not replaced would
+            # otherwise change the blob when edited in place
+            for path, blob in self._linked:
+                try:
+                    if os.path.samefile(path, blob):
+                        self._store._unshare(blob)
+                except OSError:
+                    pass
+            self._linked = []
+            if self.entries:
+                self._store._save(self)
+        self._store.prune()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc):
+        self.close()
+        return False
+
+
+class SnapshotStore:
+    def __init__(self, root=None, max_snapshots=MAX_SNAPSHOTS, max_bytes=MAX_BYTES):
+        self.root = root or SNAPSHOT_DIR
+        self.blob_dir = os.path.join(self.root, "blobs")
+        self.max_snapshots = max_snapshots
+        self.max_bytes = max_bytes
+        self._lock = threading.RLock()
+        os.makedirs(self.blob_dir, exist_ok=True)
+
+    def begin(self, dest, label=""):
+        """Start a snapshot of the paths under *dest* about to change."""
+        snap_id = time.strftime("%Y%m%d-%H%M%S") + f"-{time.time_ns() % 10 ** 6:06d}"
+        return Snapshot(self, snap_id, dest, label)
+
+    def list(self):
+        """Return :class:`SnapshotInfo` for every snapshot, newest first."""
+        infos = []
+        for manifest in self._manifests():
+            infos.append(SnapshotInfo(
+                manifest["id"], manifest["label"], manifest["dest"],
+                manifest["created"], len(manifest["entries"]),
+            ))
+        return sorted(infos, key=lambda i: i.created, reverse=True)
+
+    def latest(self):
+        snapshots = self.list()
+        return snapshots[0] if snapshots else None
+
+    def restore(self, snap_id):
+        """Put every path of the snapshot back as it was, then drop the
+        snapshot. Returns (success, message).
+
+        Paths that can't be restored stay in the snapshot (and only those),
+        so restoring can be tried again once the cause is fixed.
+        """
+        with self._lock:
+            manifest = self._load(snap_id)
+            if manifest is None:
+                return False, "Snapshot not found."
+            refs = self._blob_refs()
+            dest = manifest["dest"]
+            failed = []
+            errors = []
+            # Newest capture first: files go back before their directories
+            for rel, entry in reversed(manifest["entries"]):
+                path = os.path.join(dest, rel)
+                try:
+                    self._restore_entry(path, entry, refs)
+                except OSError as e:
+                    failed.append([rel, entry])
+                    errors.append(f"{rel}: {e.strerror or e}")
+
+            if failed:
+                # The snapshot is the only copy of what failed: keep that
+                manifest["entries"] = failed[::-1]
+                try:
+                    self._write_manifest(manifest)
+                except OSError as e:
+                    errors.append(f"snapshot not updated: {e.strerror or e}")
+                    return False, self._failure_message(errors)
+            else:
+                self._delete(snap_id)
+            self._collect_garbage()
+
+        if failed:
+            return False, self._failure_message(errors)
+        return True, f"Restored {len(manifest['entries'])} path(s) under {dest}."
+
+    @staticmethod
+    def _failure_message(errors):
+        return (
+            f"{len(errors)} path(s) could not be restored; they are kept for "
+            "another try:\n" + "\n".join(errors[:5])
+        )
+
+    def prune(self):
+        """Keep at most *max_snapshots* and *max_bytes* of blobs; the newest
+        snapshot is always kept."""
+        with self._lock:
+            snapshots = self.list()
+            while len(snapshots) > max(1, self.max_snapshots):
+                self._delete(snapshots.pop().id)
+            while len(snapshots) > 1 and self._referenced_size() > self.max_bytes:
+                self._delete(snapshots.pop().id)
+            self._collect_garbage()
+
+    # ── Blobs ──
+
+    def _blob_path(self, sha256):
+        return os.path.join(self.blob_dir, sha256)
+
+    def _add_blob(self, path, snapshot):
+        sha256 = _digest(path)
+        blob = self._blob_path(sha256)
+        with self._lock:
+            if os.path.exists(blob):
+                snapshot.methods["shared"] += 1
+                return sha256
+            fd, tmp_path = tempfile.mkstemp(dir=self.blob_dir, suffix=".tmp")
+            os.close(fd)
+            os.unlink(tmp_path)
+            try:
+                method = _clone(path, tmp_path)
+                os.replace(tmp_path, blob)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+        snapshot.methods[method] += 1
+        if method == "hardlink":
+            snapshot._linked.append((path, blob))
+        return sha256
+
+    def _unshare(self, blob):
+        fd, tmp_path = tempfile.mkstemp(dir=self.blob_dir, suffix=".tmp")
+        os.close(fd)
+        try:
+            shutil.copyfile(blob, tmp_path)
+            os.replace(tmp_path, blob)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def _restore_entry(self, path, entry, refs):
+        kind = entry["type"]
+        if kind == "absent":
+            if os.path.isdir(path) and not os.path.islink(path):
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    pass  # not empty: something else lives there now
+            elif os.path.lexists(path):
+                os.unlink(path)
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = os.path.join(
+            os.path.dirname(path), f".kutos-restore-{os.getpid()}-{os.path.basename(path)}"
+        )
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+        try:
+            if kind == "symlink":
+                os.symlink(entry["target"], tmp_path)
+            else:
+                blob = self._blob_path(entry["blob"])
+                # A blob only this snapshot uses can simply be linked back:
+                # the snapshot is dropped right after
+                _clone(blob, tmp_path, allow_link=refs[entry["blob"]] <= 1)
+                os.chmod(tmp_path, entry["mode"])
+                os.utime(tmp_path, (entry["mtime"], entry["mtime"]))
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.lexists(tmp_path):
+                os.unlink(tmp_path)
+
+    def _blob_refs(self):
+        refs = collections.Counter()
+        for manifest in self._manifests():
+            for _rel, entry in manifest["entries"]:
+                if entry["type"] == "file":
+                    refs[entry["blob"]] += 1
+        return refs
+
+    def _referenced_size(self):
+        total = 0
+        for sha256 in self._blob_refs():
+            try:
+                total += os.path.getsize(self._blob_path(sha256))
+            except OSError:
+                pass
+        return total
+
+    def _collect_garbage(self):
+        refs = self._blob_refs()
+        for name in os.listdir(self.blob_dir):
+            if name not in refs:
+                try:
+                    os.unlink(self._blob_path(name))
+                except OSError:
+                    pass
+
+    # ── Manifests ──
+
+    def _manifest_path(self, snap_id):
+        return os.path.join(self.root, snap_id, "manifest.json")
+
+    def _save(self, snapshot):
+        self._write_manifest({
+            "id": snapshot.id,
+            "label": snapshot.label,
+            "dest": snapshot.dest,
+            "created": snapshot.created,
+            "entries": list(snapshot.entries.items()),
+        })
+
+    def _write_manifest(self, manifest):
+        path = self._manifest_path(manifest["id"])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(path + ".tmp", path)
+
+    def _load(self, snap_id):
+        try:
+            with open(self._manifest_path(snap_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _manifests(self):
+        for name in os.listdir(self.root):
+            if name != "blobs":
+                manifest = self._load(name)
+                if manifest:
+                    yield manifest
+
+    def _delete(self, snap_id):
+        shutil.rmtree(os.path.join(self.root, snap_id), ignore_errors=True)
+
+
+_default_store = None
+
+
+def get_store():
+    """Return the process-wide snapshot store."""
+    global _default_store
+    if _default_store is None:
+        _default_store = SnapshotStore()
+    return _default_store
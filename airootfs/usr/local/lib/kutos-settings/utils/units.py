@@ -0,0 +1,10 @@
+"""Human-readable formatting helpers shared by the pages."""
+
+
+def format_size(nbytes):
+    """Format a byte count as ``512 B``, ``1.5 KB``, ``12.3 MB``…"""
+    for unit in ("B", "KB", "MB"):
+        if nbytes < 1024:
+            return f"{nbytes:.0f} {unit}" if unit == "B" else f"{nbytes:.1f} {unit}"
+        nbytes /= 1024
+    return f"{nbytes:.1f} GB"
@@ -1,56 +1,680 @@
 """System update runner — detects and runs available package managers."""
 
+import asyncio
+import codecs
+import collections
+import fcntl
+import json
+import os
+import pty
+import re
 import shutil
+import signal
+import struct
 import subprocess
+import termios
+import threading
+import time
+from concurrent.futures import Future
 
+from utils import aio
+from utils.cache import CACHE_DIR
 
-PACKAGE_MANAGERS = [
-    ("pacman", ["sudo", "pacman", "-Syu", "--noconfirm"]),
-    ("yay", ["yay", "-Syu", "--noconfirm"]),
-    ("paru", ["paru", "-Syu", "--noconfirm"]),
+PACMAN_UPGRADE = ["sudo", "pacman", "-Syu", "--noconfirm"]
+
+# AUR helpers in order of preference. Each only upgrades foreign (AUR)
+# packages: pacman has already synced and upgraded the repo packages.
+AUR_HELPERS = [
+    ("yay", ["yay", "-Sua", "--noconfirm"]),
+    ("paru", ["paru", "-Sua", "--noconfirm"]),
 ]
 
+TIMINGS_LOG = os.path.join(CACHE_DIR, "update-timings.jsonl")
+TIMINGS_KEEP = 50
 
-def run_system_update(output_callback, done_callback):
-    """Run system update using all available package managers.
+PACMAN_DB = "/var/lib/pacman"
+# Private copy of the sync databases, so checking never locks the real one
+CHECK_DBPATH = os.path.join(CACHE_DIR, "checkup-db")
+CHECK_TTL = 10 * 60
+CHECK_TIMEOUT = 120
 
-    *output_callback(line: str)* — called for each output line (from any thread).
-    *done_callback(success: bool)* — called when all managers finish.
+
+# ── Progress events ────────────────────────────────────────────────────────
+
+Phase = collections.namedtuple("Phase", "title")
+SyncDb = collections.namedtuple("SyncDb", "repo status")
+Download = collections.namedtuple("Download", "name done total rate percent")
+Step = collections.namedtuple("Step", "action name current total")
+Hook = collections.namedtuple("Hook", "description current total")
+Totals = collections.namedtuple("Totals", "download installed")
+Message = collections.namedtuple("Message", "level text")
+Line = collections.namedtuple("Line", "text")
+
+# Events that describe an ongoing operation; only the latest one matters
+PROGRESS_EVENTS = (Download, SyncDb, Step)
+
+_UNITS = {"B": 1, "KiB": 1024, "MiB": 1024 ** 2, "GiB": 1024 ** 3, "TiB": 1024 ** 4}
+_SIZE = r"([\d.]+)\s*(B|KiB|MiB|GiB|TiB)"
+
+_PHASE_RE = re.compile(r"^:: (.+?)\.*$")
+_SYNC_RE = re.compile(r"^\s*(\S+) (downloading|is up to date)\.*$")
+_BAR_RE = re.compile(
+    rf"^\s*(.+?)\s+{_SIZE}\s+{_SIZE}/s\s+[\d:-]+\s*\[[^\]]*\]\s+(\d+)%$"
+)
+_COUNTED_RE = re.compile(r"^\((\d+)/(\d+)\) (.+?)(?:\s+\[[^\]]*\]\s+\d+%)?$")
+_ACTION_RE = re.compile(
+    r"^(installing|upgrading|downgrading|reinstalling|removing) (\S+?)\.*$"
+)
+_TOTAL_RE = re.compile(rf"^Total (Download|Installed) Size:\s+{_SIZE}$")
+_MESSAGE_RE = re.compile(r"^(?:==> )?(warning|error|WARNING|ERROR): ?(.*)$")
+# Colours and cursor movement; helpers colour their output on a terminal
+_ANSI_RE = re.compile(r"\x1b\[[0-9;?]*[A-Za-z]")
+
+
+def parse_size(value, unit):
+    return int(float(value) * _UNITS[unit])
+
+
+class OutputParser:
+    """Turns raw pacman / yay / paru output into typed events.
+
+    Feed it text as it arrives with :meth:`feed`. Progress bars redrawn with
+    carriage returns produce one progress event per redraw but only a single
+    :class:`Line` once the line is finished, so they no longer show up as
+    hundreds of near-duplicate lines.
+    """
+
+    def __init__(self, repos=("core", "extra", "multilib")):
+        self._partial = ""
+        self._held_cr = False
+        self._repos = set(repos)
+        self._hooks = False
+        self._totals = {}
+
+    def feed(self, text):
+        text = _ANSI_RE.sub("", text)
+        # A read can end between the \r and \n of a CRLF (always the case on
+        # a pty); don't mistake that for a redraw
+        if self._held_cr:
+            text = "\r" + text
+        self._held_cr = text.endswith("\r")
+        if self._held_cr:
+            text = text[:-1]
+
+        events = []
+        for piece in re.split(r"(\r\n|\r|\n)", text):
+            if piece in ("\n", "\r\n"):
+                line, self._partial = self._partial, ""
+                events.extend(self.parse_line(line))
+                events.append(Line(line))
+            elif piece == "\r":
+                line, self._partial = self._partial, ""
+                if line.strip():
+                    events.extend(self.parse_line(line))
+            else:
+                self._partial += piece
+        return events
+
+    def close(self):
+        """Flush an unterminated last line."""
+        self._held_cr = False
+        if not self._partial:
+            return []
+        return self.feed("\n")
+
+    def parse_line(self, line):
+        """Return the events (possibly none) described by one line."""
+        stripped = line.strip()
+        if not stripped:
+            return []
+
+        m = _MESSAGE_RE.match(stripped)
+        if m:
+            return [Message(m.group(1).lower(), m.group(2))]
+
+        m = _PHASE_RE.match(stripped)
+        if m:
+            title = m.group(1)
+            self._hooks = "hooks" in title
+            return [Phase(title)]
+
+        m = _BAR_RE.match(line)
+        if m:
+            name = m.group(1).strip()
+            total = parse_size(m.group(2), m.group(3))
+            rate = parse_size(m.group(4), m.group(5))
+            percent = int(m.group(6))
+            if name in self._repos:
+                return [SyncDb(name, "complete" if percent == 100 else "downloading")]
+            if name.startswith("Total "):
+                name = "Total"
+            return [Download(name, total * percent // 100, total, rate, percent)]
+
+        m = _COUNTED_RE.match(stripped)
+        if m:
+            current, total, rest = int(m.group(1)), int(m.group(2)), m.group(3)
+            if self._hooks:
+                return [Hook(rest.rstrip("."), current, total)]
+            action, _, name = rest.partition(" ")
+            return [Step(action, name.rstrip(".").strip(), current, total)]
+
+        m = _ACTION_RE.match(stripped)
+        if m:
+            return [Step(m.group(1), m.group(2), None, None)]
+
+        m = _SYNC_RE.match(line)
+        if m and m.group(1) in self._repos:
+            status = "downloading" if m.group(2) == "downloading" else "up to date"
+            return [SyncDb(m.group(1), status)]
+
+        m = _TOTAL_RE.match(stripped)
+        if m:
+            self._totals[m.group(1).lower()] = parse_size(m.group(2), m.group(3))
+            if len(self._totals) == 2:
+                return [Totals(self._totals["download"], self._totals["installed"])]
+        return []
+
+
+class EventThrottle:
+    """Rate-limits progress events on their way to the UI.
+
+    Progress events (see ``PROGRESS_EVENTS``) are coalesced per item and
+    delivered every *interval* seconds: at most that often, and a flush on
+    the shared asyncio loop makes sure the last ones aren't held back any
+    longer either. Every other event flushes the pending progress first and
+    is delivered right away, so ordering is kept.
+    """
+
+    def __init__(self, callback, interval=0.1):
+        self._callback = callback
+        self._interval = interval
+        self._pending = {}
+        self._last_flush = 0.0
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+    def push(self, event):
+        if isinstance(event, PROGRESS_EVENTS):
+            with self._lock:
+                self._pending[(type(event), event[0])] = event
+                wait = self._interval - (time.monotonic() - self._last_flush)
+                schedule = wait > 0 and not self._scheduled
+                self._scheduled = self._scheduled or schedule
+            if wait <= 0:
+                self.flush()
+            elif schedule:
+                loop = aio.get_loop()
+                loop.call_soon_threadsafe(loop.call_later, wait, self._flush_later)
+            return
+        self.flush()
+        self._callback(event)
+
+    def flush(self):
+        with self._lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+            self._last_flush = time.monotonic()
+        for event in pending:
+            self._callback(event)
+
+    def _flush_later(self):
+        with self._lock:
+            self._scheduled = False
+            if not self._pending:
+                return
+        self.flush()
+
+
+# ── Pending-updates check ──────────────────────────────────────────────────
+
+PendingUpdates = collections.namedtuple(
+    "PendingUpdates", "repo aur download_size installed_size checked_at"
+)
+PendingUpdates.__doc__ = """*repo* / *aur* are lists of (name, old, new);
+sizes are bytes for the repo packages (AUR sizes aren't known up front)."""
+
+_check_lock = threading.Lock()
+_check_result = None
+_check_running = None  # Future of the check in progress
+_check_generation = 0  # bumped by invalidate_pending_updates()
+
+_QU_RE = re.compile(r"^(\S+) (\S+) -> (\S+)")
+_SI_SIZE_RE = re.compile(rf"^(Download|Installed) Size\s*:\s*{_SIZE}$")
+
+
+def _parse_upgrades(output):
+    upgrades = []
+    for line in output.splitlines():
+        m = _QU_RE.match(line)
+        if m and "[ignored]" not in line:
+            upgrades.append(m.groups())
+    return upgrades
+
+
+def _sync_private_db(dbpath):
+    """Sync the repo databases into *dbpath*, like ``checkupdates`` does."""
+    os.makedirs(dbpath, exist_ok=True)
+    local = os.path.join(dbpath, "local")
+    if not os.path.islink(local):
+        if os.path.exists(local):
+            shutil.rmtree(local)
+        os.symlink(os.path.join(PACMAN_DB, "local"), local)
+
+    subprocess.run(
+        ["fakeroot", "--", "pacman", "-Sy", "--dbpath", dbpath, "--logfile", "/dev/null"],
+        check=True, capture_output=True, timeout=CHECK_TIMEOUT,
+        env=dict(os.environ, LC_MESSAGES="C"),
+    )
+
+
+def _repo_sizes(dbpath, names):
+    """Return (download, installed) bytes for the sync packages *names*."""
+    if not names:
+        return 0, 0
+    output = subprocess.run(
+        ["pacman", "-Si", "--dbpath", dbpath, *names],
+        capture_output=True, text=True, timeout=CHECK_TIMEOUT,
+        env=dict(os.environ, LC_MESSAGES="C"),
+    ).stdout
+
+    totals = {"download": 0, "installed": 0}
+    for line in output.splitlines():
+        m = _SI_SIZE_RE.match(line.strip())
+        if m:
+            totals[m.group(1).lower()] += parse_size(m.group(2), m.group(3))
+    return totals["download"], totals["installed"]
+
+
+def _run_check(dbpath):
+    if not shutil.which("fakeroot"):
+        return None
+    try:
+        _sync_private_db(dbpath)
+        output = subprocess.run(
+            ["pacman", "-Qu", "--dbpath", dbpath],
+            capture_output=True, text=True, timeout=CHECK_TIMEOUT,
+        ).stdout
+        repo = _parse_upgrades(output)
+        download, installed = _repo_sizes(dbpath, [name for name, _, _ in repo])
+
+        aur = []
+        helper = detect_aur_helper()
+        if helper:
+            output = subprocess.run(
+                [helper[0], "-Qua"],
+                capture_output=True, text=True, timeout=CHECK_TIMEOUT,
+            ).stdout
+            aur = _parse_upgrades(output)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return PendingUpdates(repo, aur, download, installed, time.time())
+
+
+def check_pending_updates(max_age=CHECK_TTL, dbpath=CHECK_DBPATH):
+    """Return :class:`PendingUpdates`, or None if they can't be determined.
+
+    Repo updates are computed against a private copy of the sync databases
+    (no root, no lock on the live DB); AUR updates come from the AUR helper.
+    A result younger than *max_age* seconds is reused; pass ``max_age=0``
+    to force a fresh check. Callers arriving while a check runs wait for
+    that one instead of starting their own.
     """
-    overall_success = True
+    global _check_result, _check_running
+    with _check_lock:
+        if _check_result and time.time() - _check_result.checked_at < max_age:
+            return _check_result
+        running = _check_running
+        owner = running is None
+        if owner:
+            running = _check_running = Future()
+            generation = _check_generation
+    if not owner:
+        return running.result()
+
+    result = None
+    try:
+        result = _run_check(dbpath)
+    finally:
+        with _check_lock:
+            # Not cached if invalidated meanwhile: it may predate the change
+            if result and generation == _check_generation:
+                _check_result = result
+            if _check_running is running:
+                _check_running = None
+        running.set_result(result)
+    return result
+
+
+def invalidate_pending_updates():
+    """Forget the cached check, e.g. after an update ran. A check still
+    running isn't cached when it ends."""
+    global _check_result, _check_running, _check_generation
+    with _check_lock:
+        _check_result = None
+        _check_running = None
+        _check_generation += 1
 
-    for name, cmd in PACKAGE_MANAGERS:
-        if name != "pacman" and shutil.which(name) is None:
-            continue
 
-        output_callback(f"\n{'='*50}\n")
-        output_callback(f"  Running: {' '.join(cmd)}\n")
-        output_callback(f"{'='*50}\n\n")
+# ── Update plan ────────────────────────────────────────────────────────────
 
+def detect_aur_helper():
+    """Return (name, command) of the preferred installed AUR helper, or None."""
+    for name, cmd in AUR_HELPERS:
+        if shutil.which(name):
+            return name, cmd
+    return None
+
+
+def build_update_plan():
+    """Return the [(name, command)] steps of a full system update.
+
+    pacman syncs the databases and upgrades repo packages exactly once; at
+    most one AUR helper then upgrades only the foreign packages, instead of
+    every helper re-syncing and re-checking the whole repo set.
+    """
+    plan = [("pacman", PACMAN_UPGRADE)]
+    helper = detect_aur_helper()
+    if helper:
+        plan.append(helper)
+    return plan
+
+
+class PhaseTimer:
+    """Wall-clock time per plan step and per ``::`` phase within it."""
+
+    def __init__(self):
+        self.timings = []
+        self._step = None
+        self._step_start = 0.0
+        self._phase = (None, 0.0)
+
+    def start_step(self, name):
+        self._step = name
+        self._phase = (None, time.monotonic())
+        self._step_start = self._phase[1]
+
+    def on_phase(self, title):
+        self._close_phase()
+        self._phase = (title, time.monotonic())
+
+    def end_step(self):
+        self._close_phase()
+        self.timings.append((self._step, None, time.monotonic() - self._step_start))
+
+    def _close_phase(self):
+        title, start = self._phase
+        if title:
+            self.timings.append((self._step, title, time.monotonic() - start))
+
+    def summary(self):
+        lines = []
+        for step, phase, seconds in self.timings:
+            if phase is None:
+                lines.append(f"  {step}: {seconds:.1f}s")
+        for step, phase, seconds in self.timings:
+            if phase is not None:
+                lines.append(f"    {step} / {phase}: {seconds:.1f}s")
+        return "\n".join(lines)
+
+    def save(self, path=TIMINGS_LOG, keep=TIMINGS_KEEP):
+        """Append this run to *path*, keeping the last *keep* runs."""
+        record = {
+            "time": time.time(),
+            "timings": [
+                {"step": step, "phase": phase, "seconds": round(seconds, 3)}
+                for step, phase, seconds in self.timings
+            ],
+        }
         try:
-            process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                bufsize=1,
+            with open(path) as f:
+                runs = f.readlines()[-(keep - 1):]
+        except FileNotFoundError:
+            runs = []
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.writelines(runs)
+            f.write(json.dumps(record) + "\n")
+
+
+# ── Runner ─────────────────────────────────────────────────────────────────
+
+# Give up on a step after this long without output or download progress
+STALL_TIMEOUT = 300
+# How long each signal gets before escalating to the next one
+CANCEL_ESCALATION = ((signal.SIGINT, 10), (signal.SIGTERM, 10), (signal.SIGKILL, None))
+TERMINAL_SIZE = (24, 100)
+
+
+def _open_pty():
+    """Return (master, slave) of a pty for a child's output.
+
+    pacman only draws its progress bars on a terminal; ONLCR is turned off
+    so lines end in a plain ``\\n``.
+    """
+    master, slave = pty.openpty()
+    attrs = termios.tcgetattr(slave)
+    attrs[1] &= ~termios.ONLCR
+    termios.tcsetattr(slave, termios.TCSANOW, attrs)
+    rows, cols = TERMINAL_SIZE
+    fcntl.ioctl(slave, termios.TIOCSWINSZ, struct.pack("HHHH", rows, cols, 0, 0))
+    return master, slave
+
+
+def _progress_key(event):
+    # Redraws that don't move the numbers aren't progress (a stalled download
+    # keeps redrawing with a falling rate)
+    if isinstance(event, Download):
+        return type(event), event.name, event.done
+    return event
+
+
+class UpdateRunner:
+    """Runs the :func:`build_update_plan` steps on the shared asyncio loop.
+
+    Output of every step is read from a pty on the loop, so no thread is
+    tied up per process. :meth:`cancel` stops the current step with SIGINT,
+    then SIGTERM and finally SIGKILL, and skips the rest of the plan. A step
+    that prints nothing and makes no download progress for *stall_timeout*
+    seconds is cancelled the same way.
+
+    Callbacks are called on the loop's thread; see :func:`run_system_update`.
+    """
+
+    def __init__(self, output_callback, done_callback, event_callback=None,
+                 stall_timeout=STALL_TIMEOUT):
+        self._output = output_callback
+        self._done = done_callback
+        self._throttle = EventThrottle(event_callback) if event_callback else None
+        self.stall_timeout = stall_timeout
+        self.cancelled = False
+        self.stalled = False
+        self.wall_time = None
+        self._timer = PhaseTimer()
+        self._process = None
+        self._stopping = None
+        self._future = None
+
+    def start(self):
+        """Start the update; safe to call from any thread."""
+        self._future = aio.submit(self.run())
+        return self
+
+    def wait(self, timeout=None):
+        """Block until the update ends; returns its success."""
+        return self._future.result(timeout)
+
+    def cancel(self):
+        """Stop the update; safe to call from any thread."""
+        aio.call_soon(self._cancel)
+
+    def _cancel(self):
+        self.cancelled = True
+        self._stop()
+
+    def _stop(self):
+        if self._process and not self._stopping:
+            self._stopping = asyncio.ensure_future(self._terminate(self._process))
+
+    async def run(self):
+        start = time.monotonic()
+        success = True
+        # Parsing relies on pacman's untranslated messages
+        env = dict(os.environ, LC_MESSAGES="C")
+        env.pop("LC_ALL", None)
+
+        for name, cmd in build_update_plan():
+            if self.cancelled or self.stalled:
+                break
+            self._timer.start_step(name)
+            self._output(f"\n{'='*50}\n")
+            self._output(f"  Running: {' '.join(cmd)}\n")
+            self._output(f"{'='*50}\n\n")
+
+            try:
+                returncode = await self._run_step(cmd, env)
+                if self.cancelled:
+                    self._output(f"\n✗ {name} cancelled.\n")
+                    success = False
+                elif self.stalled:
+                    self._output(
+                        f"\n✗ {name} made no progress for {self.stall_timeout}s "
+                        f"and was stopped.\n"
+                    )
+                    success = False
+                elif returncode != 0:
+                    self._output(f"\n⚠ {name} exited with code {returncode}\n")
+                    success = False
+                else:
+                    self._output(f"\n✓ {name} completed successfully.\n")
+            except FileNotFoundError:
+                self._output(f"\n⚠ {name} not found, skipping.\n")
+            except Exception as e:
+                self._output(f"\n✗ Error running {name}: {e}\n")
+                success = False
+
+            self._timer.end_step()
+
+        self.wall_time = time.monotonic() - start
+        invalidate_pending_updates()
+        self._output(
+            f"\nTimings:\n{self._timer.summary()}\n"
+            f"  Total: {self.wall_time:.1f}s\n"
+        )
+        try:
+            self._timer.save()
+        except OSError:
+            pass
+
+        self._done(success)
+        return success
+
+    async def _run_step(self, cmd, env):
+        master, slave = _open_pty()
+        try:
+            # A session of its own keeps the child off our process group, so
+            # sudo relays the signals we send it to pacman
+            process = await asyncio.create_subprocess_exec(
+                *cmd, stdin=subprocess.DEVNULL, stdout=slave, stderr=slave,
+                env=env, start_new_session=True,
             )
+        except BaseException:
+            os.close(master)
+            raise
+        finally:
+            os.close(slave)
 
-            for line in iter(process.stdout.readline, ""):
-                output_callback(line)
+        self._process, self._stopping = process, None
+        try:
+            await self._stream(master)
+            return await process.wait()
+        finally:
+            self._process = None
+            if self._stopping:
+                await self._stopping
 
-            process.wait()
+    async def _stream(self, master):
+        """Route the pty output through the parser until the child exits."""
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader),
+            os.fdopen(master, "rb", buffering=0),
+        )
+        parser = OutputParser()
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        last_activity = time.monotonic()
+        last_progress = {}
 
-            if process.returncode != 0:
-                output_callback(f"\n⚠ {name} exited with code {process.returncode}\n")
-                overall_success = False
-            else:
-                output_callback(f"\n✓ {name} completed successfully.\n")
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(reader.read(4096), timeout=1.0)
+                except asyncio.TimeoutError:
+                    data = None
+                except OSError:
+                    # EIO: every process holding the pty's slave side is gone
+                    data = b""
 
-        except FileNotFoundError:
-            output_callback(f"\n⚠ {name} not found, skipping.\n")
-        except Exception as e:
-            output_callback(f"\n✗ Error running {name}: {e}\n")
-            overall_success = False
+                if data is None:
+                    if time.monotonic() - last_activity > self.stall_timeout:
+                        if not self.stalled:
+                            self.stalled = True
+                            self._stop()
+                    continue
+
+                events = parser.feed(decoder.decode(data, final=not data))
+                if not data:
+                    events += parser.close()
+                for event in events:
+                    if isinstance(event, PROGRESS_EVENTS):
+                        key = type(event), event[0]
+                        progress = _progress_key(event)
+                        if last_progress.get(key) != progress:
+                            last_progress[key] = progress
+                            last_activity = time.monotonic()
+                    else:
+                        last_activity = time.monotonic()
+                    self._emit(event)
+                if not data:
+                    break
+        finally:
+            transport.close()
+            if self._throttle:
+                self._throttle.flush()
+
+    def _emit(self, event):
+        if isinstance(event, Line):
+            self._output(event.text + "\n")
+            return
+        if isinstance(event, Phase):
+            self._timer.on_phase(event.title)
+        if self._throttle:
+            self._throttle.push(event)
 
-    done_callback(overall_success)
+    async def _terminate(self, process):
+        for sig, grace in CANCEL_ESCALATION:
+            if process.returncode is not None:
+                return
+            try:
+                process.send_signal(sig)
+            except ProcessLookupError:
+                return
+            try:
+                await asyncio.wait_for(process.wait(), grace)
+                return
+            except asyncio.TimeoutError:
+                continue
+
+
+def run_system_update(output_callback, done_callback, event_callback=None):
+    """Start a full system update following :func:`build_update_plan`.
+
+    *output_callback(line: str)* — called for each output line.
+    *done_callback(success: bool)* — called when all managers finish.
+    *event_callback(event)* — optional; receives the parsed progress events
+    (:class:`Phase`, :class:`Download`, :class:`Step`, …), throttled.
+
+    Callbacks run on the asyncio loop's thread. Returns the running
+    :class:`UpdateRunner`, which can be cancelled.
+    """
+    return UpdateRunner(output_callback, done_callback, event_callback).start()
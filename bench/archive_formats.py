@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""Compare decompress + apply time and peak memory per archive format.
+
+Builds a synthetic ~/.config-like tree, packs it as .tar.gz, .tar.xz and
+(if the zstandard module is installed) .tar.zst, then applies each archive
+with the kutos-settings apply engine in a fresh child process so that the
+peak RSS of every run is measured in isolation.
+
+    python3 bench/archive_formats.py [--files 2000] [--repeat 3]
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SETTINGS_DIR = os.path.join(ROOT, "airootfs/usr/local/lib/kutos-settings")
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+WORDS = (
+    "panel plugin theme icon font size color background window workspace "
+    "keybinding terminal opacity margin padding shadow blur animation true false"
+).split()
+
+
+def make_tree(root, files, seed=0):
+    """Write *files* small config files, with a few larger blobs mixed in."""
+    rng = random.Random(seed)
+    apps = [f"app{i:02d}" for i in range(max(1, files // 50))]
+    for i in range(files):
+        app = rng.choice(apps)
+        path = os.path.join(root, app, f"conf{i:05d}.ini")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if i % 100 == 0:
+            data = rng.randbytes(256 * 1024)  # e.g. a cached image or font
+            with open(path, "wb") as f:
+                f.write(data)
+            continue
+        lines = [
+            f"{rng.choice(WORDS)}_{rng.choice(WORDS)}={rng.choice(WORDS)}"
+            for _ in range(rng.randint(5, 120))
+        ]
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+def pack(tree, out_dir):
+    archives = {}
+    for fmt in ("gz", "xz"):
+        path = os.path.join(out_dir, f"config.tar.{fmt}")
+        with tarfile.open(path, f"w:{fmt}") as tar:
+            tar.add(tree, arcname=".")
+        archives[fmt] = path
+
+    if zstandard is not None:
+        raw = io.BytesIO()
+        with tarfile.open(fileobj=raw, mode="w") as tar:
+            tar.add(tree, arcname=".")
+        path = os.path.join(out_dir, "config.tar.zst")
+        with open(path, "wb") as f:
+            f.write(zstandard.ZstdCompressor(level=19).compress(raw.getvalue()))
+        archives["zst"] = path
+    return archives
+
+
+def peak_rss_kb():
+    # ru_maxrss survives execve on Linux, so it would report the parent's
+    # peak; VmHWM belongs to the new address space
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def child(archive, dest):
+    """Apply *archive* into *dest* and print timing / memory as JSON."""
+    sys.path.insert(0, SETTINGS_DIR)
+    from utils.downloader import ApplyReport, _extract_file
+
+    start = time.perf_counter()
+    report = ApplyReport()
+    _extract_file(archive, dest, report)
+    elapsed = time.perf_counter() - start
+
+    print(json.dumps({
+        "seconds": elapsed,
+        "max_rss_kb": peak_rss_kb(),
+        "files": len(report.written),
+    }))
+
+
+def run(archive, repeat):
+    results = []
+    for _ in range(repeat):
+        dest = tempfile.mkdtemp(prefix="kutos-bench-dest-")
+        try:
+            out = subprocess.run(
+                [sys.executable, __file__, "--child", archive, dest],
+                check=True, capture_output=True, text=True,
+            ).stdout
+            results.append(json.loads(out))
+        finally:
+            shutil.rmtree(dest)
+    return {
+        "seconds": min(r["seconds"] for r in results),
+        "max_rss_kb": max(r["max_rss_kb"] for r in results),
+        "files": results[0]["files"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", action="store_true", help="print JSON only")
+    parser.add_argument("--child", nargs=2, metavar=("ARCHIVE", "DEST"),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(*args.child)
+        return 0
+
+    work = tempfile.mkdtemp(prefix="kutos-bench-")
+    try:
+        tree = os.path.join(work, "tree")
+        make_tree(tree, args.files)
+        archives = pack(tree, work)
+
+        results = {}
+        for fmt, path in archives.items():
+            results[fmt] = run(path, args.repeat)
+            results[fmt]["archive_bytes"] = os.path.getsize(path)
+    finally:
+        shutil.rmtree(work)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return 0
+
+    if zstandard is None:
+        print("zstandard not installed; skipping .tar.zst\n")
+    print(f"{'format':<8}{'archive':>12}{'apply (s)':>12}{'peak RSS':>12}")
+    for fmt, r in results.items():
+        print(
+            f"{fmt:<8}{r['archive_bytes'] / 1024:>10.0f}KB"
+            f"{r['seconds']:>12.3f}{r['max_rss_kb'] / 1024:>10.1f}MB"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
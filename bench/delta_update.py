@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""Check block-level delta updates of a config archive against a local server.
+
+Publishes version 1 of a synthetic config archive on a local HTTP server
+with ``Range`` support and applies it with the kutos-settings apply engine,
+twice: the second time nothing may be downloaded or written. Then it
+publishes version 2 (a few files edited, one added) with its block index
+and applies again. The second apply must rebuild the archive from the
+cached copy plus range requests, match version 2 exactly, and download far
+less than the whole archive. An index with a wrong checksum, or none at
+all, must fall back to a full download; prefetching must patch as well.
+Exits with status 1 on any failure.
+
+Archives are compressed with ``gzip --rsyncable`` where available.
+
+    python3 bench/delta_update.py [--files 2000] [--edits 20]
+"""
+
+import argparse
+import filecmp
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SETTINGS_DIR = os.path.join(ROOT, "airootfs/usr/local/lib/kutos-settings")
+
+from archive_formats import make_tree  # noqa: E402
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serves the files in ``server.root`` with ETag, 304 and single ranges,
+    counting requests and body bytes sent."""
+
+    protocol_version = "HTTP/1.1"  # keep-alive, as real servers do
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = os.path.join(self.server.root, self.path.lstrip("/"))
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            self.send_error(404)
+            return
+
+        st = os.stat(path)
+        etag = '"' + hashlib.sha256(data).hexdigest()[:16] + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        start, end = 0, len(data) - 1
+        status = 200
+        ranged = self.headers.get("Range", "")
+        if ranged.startswith("bytes=") and self.headers.get("If-Range", etag) == etag:
+            first, _, last = ranged[len("bytes="):].partition("-")
+            start, end = int(first), min(int(last or end), end)
+            status = 206
+
+        self.send_response(status)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", formatdate(st.st_mtime, usegmt=True))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        self.end_headers()
+        with self.server.lock:
+            self.server.requests += 1
+        # In chunks, so a body the client drops early counts what got out
+        for pos in range(start, end + 1, 64 * 1024):
+            chunk = data[pos:min(pos + 64 * 1024, end + 1)]
+            try:
+                self.wfile.write(chunk)
+            except OSError:
+                return
+            with self.server.lock:
+                self.server.sent += len(chunk)
+
+
+def start_server(root):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    server.daemon_threads = True
+    server.root = root
+    server.lock = threading.Lock()
+    server.sent = 0
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def edit_tree(tree, edits, seed=1):
+    """Append to *edits* files and add one new file, keeping every other
+    file (and its mtime) as it was."""
+    rng = random.Random(seed)
+    files = sorted(
+        os.path.join(d, name) for d, _, names in os.walk(tree) for name in names
+    )
+    # Edits of successive versions often keep the size; a later mtime (a
+    # whole second apart, as tar stores it) keeps them from being skipped
+    stamp = time.time() + seed
+    for path in rng.sample(files, min(edits, len(files))):
+        with open(path, "a") as f:
+            f.write(f"edited_{rng.randrange(10 ** 6)}=true\n")
+        os.utime(path, (stamp, stamp))
+    with open(os.path.join(tree, "app00", "new.ini"), "w") as f:
+        f.write("added=true\n")
+
+
+def pack(tree, path):
+    """Write *tree* as a reproducible .tar.gz; returns True if rsyncable."""
+    raw = io.BytesIO()
+    with tarfile.open(fileobj=raw, mode="w", format=tarfile.GNU_FORMAT) as tar:
+        for d, dirs, names in os.walk(tree):
+            dirs.sort()
+            for name in sorted(names):
+                full = os.path.join(d, name)
+                tar.add(full, arcname=os.path.relpath(full, tree))
+
+    for cmd in (["gzip", "-n", "--rsyncable"], ["gzip", "-n"]):
+        result = subprocess.run(cmd, input=raw.getvalue(), capture_output=True)
+        if result.returncode == 0:
+            with open(path, "wb") as f:
+                f.write(result.stdout)
+            return "--rsyncable" in cmd
+    raise RuntimeError("gzip failed")
+
+
+def trees_equal(a, b):
+    cmp = filecmp.dircmp(a, b)
+    pending = [cmp]
+    while pending:
+        c = pending.pop()
+        if c.left_only or c.right_only or c.diff_files or c.funny_files:
+            return False
+        pending.extend(c.subdirs.values())
+    return True
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--files", type=int, default=2000)
+    ap.add_argument("--edits", type=int, default=20)
+    args = ap.parse_args()
+
+    work = tempfile.mkdtemp(prefix="kutos-delta-")
+    os.environ["XDG_CACHE_HOME"] = os.path.join(work, "cache")
+    os.environ["KUTOS_LANCACHE"] = "off"
+    sys.path.insert(0, SETTINGS_DIR)
+    from utils import delta, downloader, net
+
+    failures = []
+    try:
+        v1, v2 = os.path.join(work, "v1"), os.path.join(work, "v2")
+        make_tree(v1, args.files)
+        shutil.copytree(v1, v2)
+        edit_tree(v2, args.edits)
+
+        pub = os.path.join(work, "pub")
+        os.makedirs(pub)
+        archive = os.path.join(pub, "config.tar.gz")
+        server = start_server(pub)
+        url = f"http://127.0.0.1:{server.server_port}/config.tar.gz"
+        dest = os.path.join(work, "dest")
+
+        def publish(tree, index=True):
+            rsyncable = pack(tree, archive)
+            if os.path.exists(archive + delta.INDEX_SUFFIX):
+                os.unlink(archive + delta.INDEX_SUFFIX)
+            if index:
+                delta.main(["make", archive])
+            return rsyncable
+
+        def apply(label):
+            server.sent = server.requests = 0
+            success, message, report = downloader.download_and_extract(
+                url, dest, snapshot=False,
+            )
+            print(f"{label}: {message} {report.summary()}")
+            print(f"  server sent {server.sent / 1024:.1f} KB in {server.requests} "
+                  f"request(s); archive is {os.path.getsize(archive) / 1024:.1f} KB\n")
+            if not success:
+                failures.append(f"{label}: {message}")
+            return report
+
+        publish(v1)
+        apply("v1 (full download)")
+        if not trees_equal(v1, dest):
+            failures.append("applied tree differs from v1")
+
+        # Unchanged on the server: revalidated, nothing downloaded or written
+        report = apply("v1 again (unchanged)")
+        if report.written or server.sent > 1024:
+            failures.append("unchanged archive was downloaded or applied again")
+
+        rsyncable = publish(v2)
+        if not rsyncable:
+            print("gzip has no --rsyncable; expect little to be reused\n")
+        report = apply("v2 (delta)")
+        if report.delta is None:
+            failures.append("v2 was not applied as a delta update")
+        elif rsyncable and server.sent > os.path.getsize(archive) / 2:
+            failures.append("delta update downloaded more than half the archive")
+        if not trees_equal(v2, dest):
+            failures.append("applied tree differs from v2")
+        cached = downloader.get_cache().path_for(url)
+        with open(archive, "rb") as a, open(cached, "rb") as c:
+            if a.read() != c.read():
+                failures.append("cached archive differs from the published one")
+
+        # A corrupt index must not get past the checksum
+        edit_tree(v1, args.edits, seed=2)
+        publish(v1)
+        with open(archive + delta.INDEX_SUFFIX) as f:
+            index = json.load(f)
+        index["sha256"] = "0" * 64
+        with open(archive + delta.INDEX_SUFFIX, "w") as f:
+            json.dump(index, f)
+        report = apply("v3 (bad index)")
+        if report.delta is not None:
+            failures.append("v3 used a delta despite the bad checksum")
+        if not trees_equal(v1, dest):
+            failures.append("applied tree differs from v3")
+
+        # Without an index the archive is simply downloaded again
+        publish(v2, index=False)
+        report = apply("v4 (no index)")
+        if report.delta is not None or not trees_equal(v2, dest):
+            failures.append("v4 was not downloaded in full")
+
+        # Background prefetch goes through the same path
+        edit_tree(v2, args.edits, seed=3)
+        publish(v2)
+        downloader._missing_urls.clear()  # v4's missing index is remembered
+        server.sent = 0
+        path = downloader.fetch_to_cache(url)
+        with open(archive, "rb") as a, open(path, "rb") as c:
+            if a.read() != c.read():
+                failures.append("prefetched archive differs from the published one")
+        if rsyncable and server.sent > os.path.getsize(archive) / 2:
+            failures.append("prefetch downloaded more than half the archive")
+        print(f"v5 (prefetch): server sent {server.sent / 1024:.1f} KB\n")
+
+        for host, stats in net.host_stats().items():
+            print(f"{host}: {stats.requests} request(s), "
+                  f"{stats.reused} on kept-alive connections")
+    finally:
+        shutil.rmtree(work)
+
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+"""Stand-in NetworkManager on the session bus, for testing the bootstrapper.
+
+Exposes the parts of the NetworkManager D-Bus API the bootstrapper uses —
+the global State and Connectivity, one Wi-Fi device and its access points,
+all with PropertiesChanged and the Added / Removed signals — and lets you
+drive them from stdin:
+
+    connect                    State=CONNECTED_GLOBAL, Connectivity=FULL
+    local                      State=CONNECTED_LOCAL,  Connectivity=LIMITED
+    disconnect                 State=DISCONNECTED,     Connectivity=NONE
+    state N                    set State to N (an NMState value)
+    ap add SSID STRENGTH [wpa] add an access point, prints its number
+    ap strength N STRENGTH     change the signal of access point N
+    ap remove N                remove access point N
+    hang STAGE                 stall the next activation in STAGE
+                               (prepare, config, need-auth, ip-config)
+
+Secured access points accept the password given with --password. Joining one
+saves a profile, so the next attempt reuses it without a password.
+
+Run the bootstrapper with KUTOS_NM_BUS=session to use it, e.g.:
+
+    python3 bench/fake_nm.py --aps 300 --connect-after 5 &
+    KUTOS_NM_BUS=session python3 airootfs/usr/local/lib/kutos-bootstrapper/main.py
+"""
+
+import argparse
+import random
+import sys
+import time
+
+from gi.repository import Gio, GLib
+
+NM_BUS = "org.freedesktop.NetworkManager"
+NM_PATH = "/org/freedesktop/NetworkManager"
+NM_IFACE = "org.freedesktop.NetworkManager"
+DEVICE_PATH = NM_PATH + "/Devices/1"
+DEVICE_IFACE = NM_IFACE + ".Device"
+WIRELESS_IFACE = NM_IFACE + ".Device.Wireless"
+AP_IFACE = NM_IFACE + ".AccessPoint"
+SETTINGS_PATH = NM_PATH + "/Settings"
+SETTINGS_IFACE = NM_IFACE + ".Settings"
+CONNECTION_IFACE = NM_IFACE + ".Settings.Connection"
+
+INTROSPECTION = f"""
+<node>
+  <interface name="{NM_IFACE}">
+    <property name="State" type="u" access="read"/>
+    <property name="Connectivity" type="u" access="read"/>
+    <method name="GetDevices"><arg name="devices" type="ao" direction="out"/></method>
+    <method name="ActivateConnection">
+      <arg name="connection" type="o" direction="in"/>
+      <arg name="device" type="o" direction="in"/>
+      <arg name="specific_object" type="o" direction="in"/>
+      <arg name="active_connection" type="o" direction="out"/>
+    </method>
+    <method name="AddAndActivateConnection">
+      <arg name="connection" type="a{{sa{{sv}}}}" direction="in"/>
+      <arg name="device" type="o" direction="in"/>
+      <arg name="specific_object" type="o" direction="in"/>
+      <arg name="path" type="o" direction="out"/>
+      <arg name="active_connection" type="o" direction="out"/>
+    </method>
+    <method name="DeactivateConnection"><arg name="active_connection" type="o" direction="in"/></method>
+    <signal name="StateChanged"><arg name="state" type="u"/></signal>
+    <signal name="DeviceAdded"><arg name="device" type="o"/></signal>
+  </interface>
+  <interface name="{DEVICE_IFACE}">
+    <property name="DeviceType" type="u" access="read"/>
+    <property name="Interface" type="s" access="read"/>
+    <property name="State" type="u" access="read"/>
+    <signal name="StateChanged">
+      <arg name="new_state" type="u"/><arg name="old_state" type="u"/><arg name="reason" type="u"/>
+    </signal>
+  </interface>
+  <interface name="{WIRELESS_IFACE}">
+    <method name="GetAllAccessPoints"><arg name="aps" type="ao" direction="out"/></method>
+    <method name="RequestScan"><arg name="options" type="a{{sv}}" direction="in"/></method>
+    <signal name="AccessPointAdded"><arg name="ap" type="o"/></signal>
+    <signal name="AccessPointRemoved"><arg name="ap" type="o"/></signal>
+  </interface>
+  <interface name="{AP_IFACE}">
+    <property name="Ssid" type="ay" access="read"/>
+    <property name="Strength" type="y" access="read"/>
+    <property name="HwAddress" type="s" access="read"/>
+    <property name="Flags" type="u" access="read"/>
+    <property name="WpaFlags" type="u" access="read"/>
+    <property name="RsnFlags" type="u" access="read"/>
+  </interface>
+  <interface name="{SETTINGS_IFACE}">
+    <method name="ListConnections"><arg name="connections" type="ao" direction="out"/></method>
+  </interface>
+  <interface name="{CONNECTION_IFACE}">
+    <method name="GetSettings"><arg name="settings" type="a{{sa{{sv}}}}" direction="out"/></method>
+    <method name="Update"><arg name="properties" type="a{{sa{{sv}}}}" direction="in"/></method>
+  </interface>
+</node>
+"""
+
+PRESETS = {
+    "connect": (70, 4),
+    "local": (50, 3),
+    "disconnect": (20, 1),
+}
+
+# NMDeviceState / NMDeviceStateReason
+DISCONNECTED, PREPARE, CONFIG, NEED_AUTH, IP_CONFIG, ACTIVATED, DEACTIVATING, FAILED = (
+    30, 40, 50, 60, 70, 100, 110, 120
+)
+STAGE_NAMES = {"prepare": PREPARE, "config": CONFIG, "need-auth": NEED_AUTH, "ip-config": IP_CONFIG}
+REASON_NO_SECRETS = 7
+REASON_USER_REQUESTED = 39
+STEP_DELAY = 400  # ms per activation stage
+
+
+def typed_settings(value):
+    """a{sa{sv}} as {group: {key: GLib.Variant}}."""
+    settings = {}
+    for i in range(value.n_children()):
+        entry = value.get_child_value(i)
+        props = entry.get_child_value(1)
+        settings[entry.get_child_value(0).get_string()] = {
+            prop.get_child_value(0).get_string(): prop.get_child_value(1).get_variant()
+            for prop in (props.get_child_value(j) for j in range(props.n_children()))
+        }
+    return settings
+
+
+class FakeNetworkManager:
+    def __init__(self, password="password"):
+        self.password = password
+        self._connection = None
+        self._node = Gio.DBusNodeInfo.new_for_xml(INTROSPECTION)
+        self._registrations = {}  # path -> [registration id]
+        # path -> {interface: {property: GLib.Variant}}
+        self.objects = {
+            NM_PATH: {NM_IFACE: {
+                "State": GLib.Variant("u", 20),
+                "Connectivity": GLib.Variant("u", 1),
+            }},
+            DEVICE_PATH: {
+                DEVICE_IFACE: {
+                    "DeviceType": GLib.Variant("u", 2),
+                    "Interface": GLib.Variant("s", "wlan0"),
+                    "State": GLib.Variant("u", DISCONNECTED),
+                },
+                WIRELESS_IFACE: {},
+            },
+            SETTINGS_PATH: {SETTINGS_IFACE: {}},
+        }
+        self.aps = []
+        self._next_ap = 1
+        self.profiles = {}  # path -> {group: {key: GLib.Variant}}, secrets included
+        self._next_profile = 1
+        self._next_active = 1
+        self._steps = None  # GLib source of the running activation
+        self._active = None
+        self._hang = None
+
+    # ── D-Bus plumbing ──
+
+    def export(self, connection):
+        self._connection = connection
+        for path in self.objects:
+            self._register(path)
+
+    def _register(self, path):
+        if not self._connection:
+            return
+        self._registrations[path] = [
+            self._connection.register_object(
+                path, self._node.lookup_interface(iface),
+                self._method_call, self._get_property, None,
+            )
+            for iface in self.objects[path]
+        ]
+
+    def _unregister(self, path):
+        for registration in self._registrations.pop(path, []):
+            self._connection.unregister_object(registration)
+
+    def _get_property(self, _conn, _sender, path, iface, name):
+        return self.objects[path][iface][name]
+
+    def _method_call(self, _conn, _sender, path, iface, method, params, invocation):
+        if method == "GetDevices":
+            invocation.return_value(GLib.Variant("(ao)", ([DEVICE_PATH],)))
+        elif method == "GetAllAccessPoints":
+            invocation.return_value(GLib.Variant("(ao)", (list(self.aps),)))
+        elif method == "RequestScan":
+            invocation.return_value(None)
+        elif method == "ListConnections":
+            invocation.return_value(GLib.Variant("(ao)", (list(self.profiles),)))
+        elif method == "GetSettings":
+            settings = {
+                group: {k: v for k, v in props.items() if k not in ("psk", "wep-key0")}
+                for group, props in self.profiles[path].items()
+            }
+            invocation.return_value(GLib.Variant("(a{sa{sv}})", (settings,)))
+        elif method == "Update":
+            self.profiles[path] = typed_settings(params.get_child_value(0))
+            invocation.return_value(None)
+        elif method == "ActivateConnection":
+            profile, _device, ap = params.unpack()
+            invocation.return_value(GLib.Variant("(o)", (self.activate(profile, ap),)))
+        elif method == "AddAndActivateConnection":
+            settings = typed_settings(params.get_child_value(0))
+            _device, ap = params.get_child_value(1).unpack(), params.get_child_value(2).unpack()
+            profile = self.add_profile(settings, ap)
+            invocation.return_value(GLib.Variant("(oo)", (profile, self.activate(profile, ap))))
+        elif method == "DeactivateConnection":
+            if params.unpack()[0] == self._active:
+                self.deactivate(REASON_USER_REQUESTED)
+            invocation.return_value(None)
+        else:
+            invocation.return_dbus_error(
+                "org.freedesktop.DBus.Error.UnknownMethod", f"{iface}.{method}"
+            )
+
+    def _signal(self, path, iface, name, value):
+        if self._connection:
+            self._connection.emit_signal(None, path, iface, name, value)
+
+    def set_props(self, path, iface, **values):
+        props = self.objects[path][iface]
+        changed = {k: v for k, v in values.items() if props.get(k) != v}
+        props.update(changed)
+        if changed:
+            self._signal(
+                path, "org.freedesktop.DBus.Properties", "PropertiesChanged",
+                GLib.Variant("(sa{sv}as)", (iface, changed, [])),
+            )
+        return changed
+
+    # ── Commands ──
+
+    def set_state(self, state=None, connectivity=None):
+        values = {}
+        if state is not None:
+            values["State"] = GLib.Variant("u", state)
+        if connectivity is not None:
+            values["Connectivity"] = GLib.Variant("u", connectivity)
+        changed = self.set_props(NM_PATH, NM_IFACE, **values)
+        if "State" in changed:
+            self._signal(NM_PATH, NM_IFACE, "StateChanged", GLib.Variant("(u)", (state,)))
+        print(f"fake-nm: state {self.objects[NM_PATH][NM_IFACE]['State'].unpack()}", flush=True)
+
+    def add_ap(self, ssid, strength, secure=False):
+        number = self._next_ap
+        self._next_ap += 1
+        path = f"{NM_PATH}/AccessPoint/{number}"
+        self.objects[path] = {AP_IFACE: {
+            "Ssid": GLib.Variant("ay", ssid.encode()),
+            "Strength": GLib.Variant("y", strength),
+            "HwAddress": GLib.Variant("s", ":".join(f"{random.randrange(256):02X}" for _ in range(6))),
+            "Flags": GLib.Variant("u", 1 if secure else 0),
+            "WpaFlags": GLib.Variant("u", 0),
+            "RsnFlags": GLib.Variant("u", 0x188 if secure else 0),
+        }}
+        self._register(path)
+        self.aps.append(path)
+        self._signal(DEVICE_PATH, WIRELESS_IFACE, "AccessPointAdded", GLib.Variant("(o)", (path,)))
+        return number
+
+    def set_strength(self, number, strength):
+        path = f"{NM_PATH}/AccessPoint/{number}"
+        self.set_props(path, AP_IFACE, Strength=GLib.Variant("y", strength))
+
+    def remove_ap(self, number):
+        path = f"{NM_PATH}/AccessPoint/{number}"
+        if path not in self.aps:
+            return
+        self.aps.remove(path)
+        self._signal(DEVICE_PATH, WIRELESS_IFACE, "AccessPointRemoved", GLib.Variant("(o)", (path,)))
+        self._unregister(path)
+        del self.objects[path]
+
+    def add_profile(self, settings, ap):
+        path = f"{SETTINGS_PATH}/{self._next_profile}"
+        self._next_profile += 1
+        ssid = self.objects[ap][AP_IFACE]["Ssid"]
+        settings.setdefault("connection", {}).update({
+            "id": GLib.Variant("s", bytes(ssid.unpack()).decode()),
+            "type": GLib.Variant("s", "802-11-wireless"),
+            "timestamp": GLib.Variant("t", 0),
+        })
+        settings.setdefault("802-11-wireless", {})["ssid"] = ssid
+        self.profiles[path] = settings
+        self._register(path)
+        return path
+
+    def _device_state(self, state, reason=0):
+        props = self.objects[DEVICE_PATH][DEVICE_IFACE]
+        old = props["State"].unpack()
+        self.set_props(DEVICE_PATH, DEVICE_IFACE, State=GLib.Variant("u", state))
+        self._signal(DEVICE_PATH, DEVICE_IFACE, "StateChanged", GLib.Variant("(uuu)", (state, old, reason)))
+        print(f"fake-nm: device {old} -> {state} (reason {reason})", flush=True)
+
+    def activate(self, profile, ap):
+        """Walk the device through the activation stages, one per STEP_DELAY."""
+        if self._active:
+            self.deactivate(REASON_USER_REQUESTED)
+        active = f"{NM_PATH}/ActiveConnection/{self._next_active}"
+        self._next_active += 1
+        self._active = active
+
+        settings = self.profiles.get(profile, {})
+        secrets = settings.get("802-11-wireless-security", {})
+        secret = secrets.get("psk") or secrets.get("wep-key0")
+        secured = self.objects.get(ap, {}).get(AP_IFACE, {}).get("Flags", GLib.Variant("u", 0)).unpack()
+        right_password = not secured or (secret is not None and secret.unpack() == self.password)
+
+        steps = [(PREPARE, 0), (CONFIG, 0)]
+        if right_password:
+            steps += [(IP_CONFIG, 0), (ACTIVATED, 0)]
+        else:
+            steps += [(NEED_AUTH, 0), (FAILED, REASON_NO_SECRETS), (DISCONNECTED, REASON_NO_SECRETS)]
+        hang, self._hang = self._hang, None
+
+        def step():
+            state, reason = steps.pop(0)
+            self._device_state(state, reason)
+            if state == ACTIVATED:
+                settings["connection"]["timestamp"] = GLib.Variant("t", int(time.time()))
+                self.set_state(*PRESETS["connect"])
+            if state in (ACTIVATED, DISCONNECTED) or state == hang:
+                self._steps = None
+                if state == DISCONNECTED:
+                    self._active = None
+                return GLib.SOURCE_REMOVE
+            return GLib.SOURCE_CONTINUE
+
+        self._steps = GLib.timeout_add(STEP_DELAY, step)
+        return active
+
+    def deactivate(self, reason):
+        if self._steps:
+            GLib.source_remove(self._steps)
+            self._steps = None
+        self._active = None
+        self._device_state(DEACTIVATING, reason)
+        self._device_state(DISCONNECTED, reason)
+        self.set_state(*PRESETS["disconnect"])
+
+    def command(self, line):
+        words = line.split()
+        try:
+            if not words:
+                return
+            if words[0] in PRESETS:
+                self.set_state(*PRESETS[words[0]])
+            elif words[0] == "state":
+                self.set_state(state=int(words[1]))
+            elif words[:2] == ["ap", "add"]:
+                number = self.add_ap(words[2], int(words[3]), words[4:5] == ["wpa"])
+                print(f"fake-nm: ap {number}", flush=True)
+            elif words[:2] == ["ap", "strength"]:
+                self.set_strength(int(words[2]), int(words[3]))
+            elif words[:2] == ["ap", "remove"]:
+                self.remove_ap(int(words[2]))
+            elif words[0] == "hang":
+                self._hang = STAGE_NAMES[words[1]]
+            else:
+                raise ValueError
+        except (IndexError, KeyError, ValueError):
+            print(f"fake-nm: bad command {line!r}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--connect-after", type=float, metavar="SECONDS",
+                        help="switch to 'connect' after this many seconds")
+    parser.add_argument("--aps", type=int, default=0,
+                        help="start with this many random access points")
+    parser.add_argument("--password", default="password",
+                        help="password of the secured access points")
+    args = parser.parse_args()
+
+    loop = GLib.MainLoop()
+    fake = FakeNetworkManager(args.password)
+    rng = random.Random(0)
+    for i in range(args.aps):
+        # Several BSSIDs per SSID, like a campus network
+        fake.add_ap(f"net-{rng.randrange(max(1, args.aps // 3)):03d}",
+                    rng.randrange(5, 100), rng.random() < 0.8)
+
+    Gio.bus_own_name(
+        Gio.BusType.SESSION, NM_BUS, Gio.BusNameOwnerFlags.NONE,
+        lambda connection, _name: fake.export(connection),
+        lambda _connection, _name: print("fake-nm: ready", flush=True),
+        lambda _connection, _name: loop.quit(),
+    )
+
+    if args.connect_after is not None:
+        GLib.timeout_add(int(args.connect_after * 1000), lambda: fake.set_state(*PRESETS["connect"]))
+
+    def on_stdin(channel, condition):
+        line = channel.readline()
+        if not line:
+            return GLib.SOURCE_REMOVE
+        fake.command(line)
+        return GLib.SOURCE_CONTINUE
+
+    stdin = GLib.IOChannel.unix_new(sys.stdin.fileno())
+    GLib.io_add_watch(stdin, GLib.PRIORITY_DEFAULT, GLib.IOCondition.IN | GLib.IOCondition.HUP, on_stdin)
+    loop.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""Check the LAN cache server's conditional and Range handling.
+
+Starts a lancache server on a temporary package directory and archive cache
+and sends it the requests pacman, the fetcher and delta updates make:
+If-None-Match with single, listed, weak and wildcard entity tags, byte
+ranges (open, suffix, unsatisfiable) and If-Range with a current or stale
+validator. An entity tag that merely contains the file's one must not count
+as a match. Exits with status 1 on any failure.
+
+    python3 bench/lancache_http.py
+"""
+
+import http.client
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "airootfs/usr/local/lib/kutos-settings"))
+
+from utils import lancache  # noqa: E402
+from utils.cache import ArchiveCache  # noqa: E402
+
+PACKAGE = "demo-1.0-1-x86_64.pkg.tar.zst"
+ARCHIVE_URL = "https://example.invalid/xfce.tar.gz"
+# Unquoted, as some origin servers send it; kept as is by the archive cache
+ARCHIVE_ETAG = "5f3a"
+
+
+def main():
+    work = tempfile.mkdtemp(prefix="kutos-lancache-")
+    failures = []
+
+    def check(ok, what):
+        print(f"{'ok  ' if ok else 'FAIL'} {what}")
+        if not ok:
+            failures.append(what)
+
+    server = None
+    try:
+        pkg_dir = os.path.join(work, "pkg")
+        os.makedirs(pkg_dir)
+        data = os.urandom(1000)
+        with open(os.path.join(pkg_dir, PACKAGE), "wb") as f:
+            f.write(data)
+
+        archives = ArchiveCache(os.path.join(work, "archives"))
+        download = os.path.join(work, "download")
+        with open(download, "wb") as f:
+            f.write(data)
+        archives.store(ARCHIVE_URL, download, etag=ARCHIVE_ETAG)
+
+        server = lancache.CacheServer(
+            ("127.0.0.1", 0), pkg_dir=pkg_dir, installer_cache=None,
+            archive_cache=archives,
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=10)
+
+        def get(path, method="GET", **headers):
+            conn.request(method, path, headers=headers)
+            response = conn.getresponse()
+            return response, response.read()
+
+        path = f"/pacman/core/os/x86_64/{PACKAGE}"
+        response, body = get(path)
+        etag = response.getheader("ETag")
+        last_modified = response.getheader("Last-Modified")
+        check(response.status == 200 and body == data, "full download")
+        check(bool(etag) and response.getheader("Accept-Ranges") == "bytes", "validators sent")
+
+        response, body = get(path, "HEAD")
+        check(
+            response.status == 200 and not body
+            and response.getheader("Content-Length") == str(len(data)),
+            "HEAD has the size but no body",
+        )
+
+        for value, expected, what in (
+            (etag, 304, "If-None-Match with the current tag"),
+            (f'"other", {etag}', 304, "If-None-Match with a list"),
+            (f"W/{etag}", 304, "If-None-Match with a weak tag"),
+            ("*", 304, "If-None-Match: *"),
+            ('"other"', 200, "If-None-Match with another tag"),
+        ):
+            response, _ = get(path, **{"If-None-Match": value})
+            check(response.status == expected, f"{what}: {response.status}")
+
+        response, body = get(path, Range="bytes=10-19")
+        check(
+            response.status == 206 and body == data[10:20]
+            and response.getheader("Content-Range") == f"bytes 10-19/{len(data)}",
+            "closed range",
+        )
+        response, body = get(path, Range="bytes=990-")
+        check(response.status == 206 and body == data[990:], "open range")
+        response, body = get(path, Range="bytes=-5")
+        check(response.status == 206 and body == data[-5:], "suffix range")
+        response, body = get(path, Range=f"bytes={len(data)}-")
+        check(
+            response.status == 416
+            and response.getheader("Content-Range") == f"bytes */{len(data)}",
+            "unsatisfiable range",
+        )
+
+        for value, expected, what in (
+            (etag, 206, "If-Range with the current tag"),
+            ('"stale"', 200, "If-Range with a stale tag"),
+            (f"W/{etag}", 200, "If-Range with a weak tag"),
+            (last_modified, 206, "If-Range with the current date"),
+            ("Thu, 01 Jan 1970 00:00:00 GMT", 200, "If-Range with an old date"),
+        ):
+            response, body = get(path, Range="bytes=0-0", **{"If-Range": value})
+            full = body == data if expected == 200 else body == data[:1]
+            check(response.status == expected and full, f"{what}: {response.status}")
+
+        archive = f"/archives?url={ARCHIVE_URL}"
+        response, body = get(archive)
+        check(
+            response.status == 200 and body == data
+            and response.getheader("ETag") == ARCHIVE_ETAG,
+            "archive served with the upstream tag",
+        )
+        response, _ = get(archive, **{"If-None-Match": ARCHIVE_ETAG})
+        check(response.status == 304, f"archive revalidated: {response.status}")
+        response, _ = get(archive, **{"If-None-Match": f'"x{ARCHIVE_ETAG}x"'})
+        check(response.status == 200, f"a tag containing the archive's doesn't match: {response.status}")
+        conn.close()
+    finally:
+        if server:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(work)
+
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""Run the mirror ranking against local HTTP servers with injected faults.
+
+Each fake mirror serves ``lastsync`` and a sample ``core.db`` with its own
+added latency, throughput cap and sync lag; some are broken or hang. The
+ranking runs under its normal time budget and the resulting table and
+mirrorlist are printed. Exits with status 1 if the expected mirror does
+not come out on top, a failed or stale mirror is ranked above a working
+one, or the mirrorlist doesn't keep every server.
+
+    python3 bench/mirror_rank.py [--budget 5] [--mirrors 40]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "airootfs/usr/local/lib/kutos-settings"))
+
+from utils import mirrors  # noqa: E402
+
+SAMPLE = os.urandom(mirrors.SAMPLE_BYTES * 2)
+
+# name: (latency s, bytes/s or None for unlimited, lag s, fault)
+PROFILES = {
+    "best": (0.02, 8 * 1024 ** 2, 1800, None),
+    "near-slow": (0.005, 256 * 1024, 600, None),
+    "far-fast": (0.3, 16 * 1024 ** 2, 3600, None),
+    "stale": (0.005, 32 * 1024 ** 2, 3 * 86400, None),
+    "broken": (0.01, None, 0, "404"),
+    "hangs": (0.01, None, 0, "hang"),
+}
+
+
+class FakeMirror(BaseHTTPRequestHandler):
+    profile = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        latency, rate, lag, fault = self.server.profile
+        time.sleep(latency)
+        if fault == "hang":
+            time.sleep(3600)
+        if fault == "404" or not self.path.startswith("/archlinux/"):
+            self.send_error(404)
+            return
+
+        if self.path.endswith("/lastsync"):
+            body = f"{int(time.time() - lag)}\n".encode()
+        elif self.path.endswith("/core.db"):
+            body = SAMPLE
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        chunk = 16 * 1024
+        for i in range(0, len(body), chunk):
+            try:
+                self.wfile.write(body[i:i + chunk])
+            except OSError:
+                return
+            if rate:
+                time.sleep(chunk / rate)
+
+
+def start_mirror(profile):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeMirror)
+    server.daemon_threads = True
+    server.profile = profile
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}/archlinux/$repo/os/$arch"
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--budget", type=float, default=5)
+    ap.add_argument("--mirrors", type=int, default=len(PROFILES),
+                    help="add random mediocre mirrors up to this many")
+    args = ap.parse_args()
+
+    names = {}
+    for name, profile in PROFILES.items():
+        names[start_mirror(profile)] = name
+    rng = random.Random(0)
+    for i in range(args.mirrors - len(PROFILES)):
+        profile = (rng.uniform(0.05, 0.5), rng.randint(64, 2048) * 1024, rng.randint(0, 20) * 3600, None)
+        names[start_mirror(profile)] = f"random-{i}"
+
+    servers = list(names)
+    rng.shuffle(servers)
+    start = time.monotonic()
+    results = asyncio.run(mirrors.rank(servers, args.budget))
+    elapsed = time.monotonic() - start
+
+    print(f"{'mirror':<12} {'latency':>9} {'lag':>8} {'rate':>12}  error")
+    for r in results:
+        latency = f"{r.latency * 1000:.0f} ms" if r.latency is not None else "-"
+        lag = f"{r.lag / 3600:.1f} h" if r.lag is not None else "-"
+        rate = f"{r.rate / 1024:.0f} KiB/s" if r.rate else "-"
+        print(f"{names[r.server]:<12} {latency:>9} {lag:>8} {rate:>12}  {r.error or ''}")
+    print(f"\nranked {len(results)} mirrors in {elapsed:.2f}s (budget {args.budget}s)\n")
+    mirrorlist = mirrors.format_mirrorlist(results, keep=3)
+    print(mirrorlist)
+
+    failures = []
+    ranked = [names[r.server] for r in results]
+    if ranked[0] != "best":
+        failures.append(f"{ranked[0]} ranked first")
+    if elapsed >= args.budget + 1:
+        failures.append(f"ranking took {elapsed:.2f}s")
+    if set(ranked[-2:]) != {"broken", "hangs"} or not all(r.error for r in results[-2:]):
+        failures.append("failed mirrors not ranked last with an error")
+    if ranked.index("stale") < max(ranked.index(n) for n in ("best", "near-slow", "far-fast")):
+        failures.append("stale mirror ranked above a fresh one")
+
+    # pacman gets the best 3; the rest stay, commented, for the next ranking
+    enabled = [line[len("Server = "):] for line in mirrorlist.splitlines()
+               if line.startswith("Server = ")]
+    if enabled != [r.server for r in results[:3]]:
+        failures.append("mirrorlist doesn't enable the top 3")
+    with tempfile.NamedTemporaryFile("w", suffix=".mirrorlist") as f:
+        f.write(mirrorlist)
+        f.flush()
+        if mirrors.candidate_servers(f.name) != [r.server for r in results]:
+            failures.append("next ranking wouldn't see every server")
+
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Replay a captured pacman / yay / paru log through the update parser.
+
+Prints the typed events the System Update page would receive and how many
+raw redraws were collapsed, without running a package manager. The log is
+fed in small random-sized pieces, like pipe reads, so split lines and
+carriage returns are exercised too.
+
+    python3 bench/replay_update_log.py bench/fixtures/pacman-syu-tty.log
+    python3 bench/replay_update_log.py --throttle 0.1 --repeat 2000 LOG
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "airootfs/usr/local/lib/kutos-settings"))
+
+from utils.updater import EventThrottle, Line, OutputParser  # noqa: E402
+
+
+def replay(text, on_event, seed=0):
+    rng = random.Random(seed)
+    parser = OutputParser()
+    pos = 0
+    while pos < len(text):
+        size = rng.randint(1, 512)
+        for event in parser.feed(text[pos:pos + size]):
+            on_event(event)
+        pos += size
+    for event in parser.close():
+        on_event(event)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("log")
+    ap.add_argument("--throttle", type=float, default=None,
+                    help="pass events through an EventThrottle with this interval")
+    ap.add_argument("--repeat", type=int, default=1,
+                    help="replay N times and report parser throughput")
+    args = ap.parse_args()
+
+    with open(args.log, encoding="utf-8", newline="") as f:
+        text = f.read()
+
+    if args.repeat > 1:
+        start = time.perf_counter()
+        for i in range(args.repeat):
+            replay(text, lambda _event: None, seed=i)
+        elapsed = time.perf_counter() - start
+        mib = len(text) * args.repeat / 1024 / 1024
+        print(f"{mib:.1f} MiB parsed in {elapsed:.2f}s ({mib / elapsed:.1f} MiB/s)")
+        return 0
+
+    counts = {}
+    raw_lines = text.count("\n") + text.count("\r")
+
+    def show(event):
+        counts[type(event).__name__] = counts.get(type(event).__name__, 0) + 1
+        if not isinstance(event, Line):
+            print(event)
+
+    if args.throttle is not None:
+        throttle = EventThrottle(show, interval=args.throttle)
+        replay(text, throttle.push)
+        throttle.flush()
+    else:
+        replay(text, show)
+
+    print(f"\n{raw_lines} raw lines/redraws -> {counts.get('Line', 0)} output lines")
+    print(", ".join(f"{k}: {v}" for k, v in sorted(counts.items())))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""Check that reverting an applied config survives a path that can't be
+restored.
+
+Applies a synthetic config archive over an existing ~/.config-like tree with
+a snapshot, then blocks one captured path (its directory is replaced by a
+file, which stops root as well as a read-only directory stops users) and
+reverts. The revert must report the failure, restore everything else and
+keep the snapshot with just the failed path and its blob. Once the path is
+unblocked, a second revert must restore it and drop the snapshot. Finally,
+an apply that asks for a snapshot must refuse to start when the snapshot
+store can't be used.
+Exits with status 1 on any failure.
+
+    python3 bench/snapshot_restore.py
+"""
+
+import io
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SETTINGS_DIR = os.path.join(ROOT, "airootfs/usr/local/lib/kutos-settings")
+
+OLD = {
+    "app/settings.ini": b"theme=light\n",
+    "blocked/panel.xml": b"<panel size='24'/>\n",
+    "other/keys.conf": b"ctrl+t=terminal\n",
+}
+NEW = {
+    "app/settings.ini": b"theme=dark\n",
+    "blocked/panel.xml": b"<panel size='32'/>\n",
+    "other/keys.conf": b"ctrl+t=kitty\n",
+    "added/new.conf": b"added=true\n",
+}
+
+
+def write_tree(root, files):
+    for rel, data in files.items():
+        path = os.path.join(root, rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+
+def pack(files, path):
+    with tarfile.open(path, "w:gz") as tar:
+        for rel, data in files.items():
+            info = tarfile.TarInfo(rel)
+            info.size = len(data)
+            info.mtime = 1
+            tar.addfile(info, io.BytesIO(data))
+
+
+def read(root, rel):
+    try:
+        with open(os.path.join(root, rel), "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def main():
+    work = tempfile.mkdtemp(prefix="kutos-snapshot-")
+    sys.path.insert(0, SETTINGS_DIR)
+    from utils import downloader, snapshots
+
+    failures = []
+
+    def check(ok, what):
+        print(f"{'ok  ' if ok else 'FAIL'} {what}")
+        if not ok:
+            failures.append(what)
+
+    try:
+        dest = os.path.join(work, "config")
+        write_tree(dest, OLD)
+        archive = os.path.join(work, "config.tar.gz")
+        pack(NEW, archive)
+
+        store = snapshots.SnapshotStore(os.path.join(work, "snapshots"))
+        snap = store.begin(dest, label="bench")
+        report = downloader.ApplyReport(snap)
+        downloader._extract_file(archive, dest, report)
+        snap.close()
+        check(all(read(dest, rel) == data for rel, data in NEW.items()), "archive applied")
+
+        # Block one path: its directory becomes a file
+        blocked = os.path.join(dest, "blocked")
+        shutil.rmtree(blocked)
+        with open(blocked, "w") as f:
+            f.write("in the way\n")
+
+        success, message = store.restore(snap.id)
+        print(f"  first revert: {message}")
+        check(not success, "failed revert is reported")
+        for rel in ("app/settings.ini", "other/keys.conf"):
+            check(read(dest, rel) == OLD[rel], f"{rel} restored")
+        check(not os.path.exists(os.path.join(dest, "added/new.conf")), "added file removed")
+        latest = store.latest()
+        check(latest is not None and latest.id == snap.id, "snapshot kept")
+        check(latest is not None and latest.paths == 1, "only the failed path is left")
+        check(len(os.listdir(store.blob_dir)) == 1, "its blob is kept, the others are collected")
+
+        os.unlink(blocked)
+        success, message = store.restore(snap.id)
+        print(f"  second revert: {message}")
+        check(success, "second revert succeeds")
+        check(read(dest, "blocked/panel.xml") == OLD["blocked/panel.xml"], "blocked path restored")
+        check(store.latest() is None, "snapshot dropped")
+        check(not os.listdir(store.blob_dir), "blobs collected")
+
+        # No snapshot store (its directory is in the way of a file): refuse
+        in_the_way = os.path.join(work, "data")
+        with open(in_the_way, "w") as f:
+            f.write("in the way\n")
+        snapshots.SNAPSHOT_DIR = os.path.join(in_the_way, "snapshots")
+        snapshots._default_store = None
+        before = {rel: read(dest, rel) for rel in NEW}
+        success, message, report = downloader.download_and_extract(
+            "http://127.0.0.1:9/config.tar.gz", dest, use_cache=False,
+        )
+        print(f"  apply without a snapshot store: {message}")
+        check(not success and "snapshot" in message, "apply refused without a snapshot")
+        check({rel: read(dest, rel) for rel in NEW} == before, "nothing applied")
+    finally:
+        shutil.rmtree(work)
+
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""Measure startup time and memory of kutos-settings and kutos-bootstrapper.
+
+Each app is started headless, several times, in a fresh process under
+``python -X importtime``. A small in-process probe records:
+
+* when the first toplevel window is mapped and when its first frame is painted
+  (milliseconds since the process was spawned)
+* peak RSS (VmHWM) and RSS after the app has settled (VmRSS)
+* the slowest imports, from the ``-X importtime`` report
+
+The results can be saved as a baseline. A later run compared against that
+baseline exits with status 1 if a metric got worse by more than the threshold.
+
+    python3 bench/startup.py [--runs 5] [--app settings] [--json]
+    python3 bench/startup.py --save-baseline bench/startup-baseline.json
+    python3 bench/startup.py --baseline bench/startup-baseline.json --threshold 0.15
+
+The display is taken from the environment if there is one. Otherwise the
+script starts a Broadway server (gtk4-broadwayd / broadwayd) or Xvfb.
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LIB = os.path.join(ROOT, "airootfs/usr/local/lib")
+
+# name: (entry point, GTK version, seconds to wait after the first frame)
+APPS = {
+    "settings": (os.path.join(LIB, "kutos-settings/main.py"), "4.0", 2.0),
+    # The bootstrapper goes on to check connectivity and fetch the installer
+    # right away; keep the settle time short
+    "bootstrapper": (os.path.join(LIB, "kutos-bootstrapper/main.py"), "3.0", 0.5),
+}
+
+# Compared against the baseline; all of them are "lower is better"
+METRICS = ("window_ms", "first_frame_ms", "imports_ms", "peak_rss_kb", "steady_rss_kb")
+DEFAULT_BASELINE = os.path.join(ROOT, "bench/startup-baseline.json")
+CHILD_TIMEOUT = 60
+
+_IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+# ── Child: runs inside the measured process ────────────────────────────────
+
+def _memory_kb():
+    values = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(("VmHWM:", "VmRSS:")):
+                key, value = line.split(":", 1)
+                values[key] = int(value.split()[0])
+    return values
+
+
+def child(main_py, gtk_version, settle, spawned, fd):
+    """Run *main_py* as ``__main__`` and report on *fd* once it has settled."""
+    out = os.fdopen(fd, "w")
+
+    def ms():
+        return round((time.monotonic() - spawned) * 1000, 1)
+
+    import gi
+    gi.require_version("Gtk", gtk_version)
+    from gi.repository import GLib, GObject, Gtk
+
+    result = {"started_ms": ms()}
+
+    def finish():
+        memory = _memory_kb()
+        result["peak_rss_kb"] = memory["VmHWM"]
+        result["steady_rss_kb"] = memory["VmRSS"]
+        out.write(json.dumps(result) + "\n")
+        out.flush()
+        os._exit(0)
+
+    def on_after_paint(clock, handler):
+        clock.disconnect(handler[0])
+        result["first_frame_ms"] = ms()
+        GLib.timeout_add(int(settle * 1000), finish)
+
+    def on_map(widget):
+        if "window_ms" in result or not isinstance(widget, Gtk.Window):
+            return True
+        result["window_ms"] = ms()
+        clock = widget.get_frame_clock()
+        handler = []
+        handler.append(clock.connect("after-paint", on_after_paint, handler))
+        return True
+
+    GObject.add_emission_hook(Gtk.Widget, "map", on_map)
+
+    import runpy
+    sys.argv = [main_py]
+    sys.path.insert(0, os.path.dirname(main_py))
+    runpy.run_path(main_py, run_name="__main__")
+    # The app quit on its own before painting anything
+    out.write(json.dumps(result) + "\n")
+    out.flush()
+
+
+# ── Parent ─────────────────────────────────────────────────────────────────
+
+def digest_importtime(stderr, top=15):
+    """Return (total ms, [(module, self ms, cumulative ms)] slowest first)."""
+    modules = []
+    total_us = 0
+    for line in stderr.splitlines():
+        m = _IMPORTTIME_RE.match(line)
+        if not m:
+            continue
+        self_us, cumulative_us = int(m.group(1)), int(m.group(2))
+        total_us += self_us
+        modules.append((m.group(4), self_us / 1000, cumulative_us / 1000))
+    modules.sort(key=lambda module: module[1], reverse=True)
+    return round(total_us / 1000, 1), modules[:top]
+
+
+class Display:
+    """Provides a display for GTK *version*, starting a headless one if needed."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._servers = []
+
+    def env(self, gtk_version):
+        env = dict(os.environ)
+        backend = self.backend
+        if backend == "auto":
+            if env.get("WAYLAND_DISPLAY") or env.get("DISPLAY"):
+                return env
+            broadwayd = "gtk4-broadwayd" if gtk_version == "4.0" else "broadwayd"
+            backend = "broadway" if shutil.which(broadwayd) else "x11"
+
+        if backend == "broadway":
+            broadwayd = "gtk4-broadwayd" if gtk_version == "4.0" else "broadwayd"
+            display = ":5" if gtk_version == "4.0" else ":6"
+            self._start([broadwayd, display], broadwayd)
+            env.update(GDK_BACKEND="broadway", BROADWAY_DISPLAY=display)
+        elif backend == "x11":
+            self._start(["Xvfb", ":97", "-screen", "0", "1280x800x24", "-nolisten", "tcp"], "Xvfb")
+            env.update(GDK_BACKEND="x11", DISPLAY=":97")
+            env.pop("WAYLAND_DISPLAY", None)
+        return env
+
+    def _start(self, cmd, name):
+        if any(server.args == cmd for server in self._servers):
+            return
+        if not shutil.which(cmd[0]):
+            raise SystemExit(f"{name} not found; install it or run inside a session")
+        self._servers.append(subprocess.Popen(
+            cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        ))
+        time.sleep(0.5)
+
+    def close(self):
+        for server in self._servers:
+            server.terminate()
+            server.wait()
+
+
+def run_once(app, env):
+    main_py, gtk_version, settle = APPS[app]
+    read_fd, write_fd = os.pipe()
+    cmd = [sys.executable, "-X", "importtime", os.path.abspath(__file__),
+           "--child", main_py, gtk_version, str(settle), str(time.monotonic()),
+           str(write_fd)]
+    # A private session bus, so a running instance can't take the activation
+    if shutil.which("dbus-run-session"):
+        cmd = ["dbus-run-session", "--", *cmd]
+
+    with tempfile.TemporaryFile() as err:
+        process = subprocess.Popen(
+            cmd, env=env, stdout=subprocess.DEVNULL, stderr=err,
+            pass_fds=(write_fd,), start_new_session=True,
+        )
+        os.close(write_fd)
+        with os.fdopen(read_fd) as report:
+            try:
+                process.wait(CHILD_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+                raise SystemExit(f"{app}: no report after {CHILD_TIMEOUT}s")
+            line = report.readline()
+        err.seek(0)
+        stderr = err.read().decode(errors="replace")
+
+    if not line:
+        raise SystemExit(f"{app} exited with code {process.returncode}:\n{stderr[-2000:]}")
+    result = json.loads(line)
+    if "first_frame_ms" not in result:
+        raise SystemExit(f"{app} quit before drawing its first frame")
+    result["imports_ms"], result["slowest_imports"] = digest_importtime(stderr)
+    return result
+
+
+def summarize(runs):
+    """Median of the timings and steady RSS, worst peak RSS."""
+    summary = {
+        metric: statistics.median(run[metric] for run in runs)
+        for metric in METRICS if metric != "peak_rss_kb"
+    }
+    summary["peak_rss_kb"] = max(run["peak_rss_kb"] for run in runs)
+    summary["runs"] = len(runs)
+    summary["slowest_imports"] = runs[-1]["slowest_imports"]
+    return summary
+
+
+def compare(results, baseline, threshold):
+    """Return a list of regression descriptions (empty if none)."""
+    regressions = []
+    for app, summary in results.items():
+        for metric in METRICS:
+            before = baseline.get(app, {}).get(metric)
+            if not before:
+                continue
+            after = summary[metric]
+            change = (after - before) / before
+            if change > threshold:
+                regressions.append(
+                    f"{app} {metric}: {before:g} -> {after:g} (+{change:.0%})"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--app", choices=sorted(APPS), action="append",
+                        help="app to measure (default: all)")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--backend", choices=("auto", "broadway", "x11"), default="auto")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE,
+                        help="compare against this file if it exists")
+    parser.add_argument("--save-baseline", metavar="FILE",
+                        help="write the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="allowed relative regression (default: 0.10)")
+    parser.add_argument("--json", action="store_true", help="print JSON only")
+    parser.add_argument("--child", nargs=5, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        main_py, gtk_version, settle, spawned, fd = args.child
+        child(main_py, gtk_version, float(settle), float(spawned), int(fd))
+        return 0
+
+    display = Display(args.backend)
+    results = {}
+    try:
+        for app in args.app or sorted(APPS):
+            env = display.env(APPS[app][1])
+            results[app] = summarize([run_once(app, env) for _ in range(args.runs)])
+    finally:
+        display.close()
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(
+                {app: {m: r[m] for m in METRICS} for app, r in results.items()},
+                f, indent=2,
+            )
+            f.write("\n")
+
+    regressions = []
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+
+    if args.json:
+        print(json.dumps({"results": results, "regressions": regressions}, indent=2))
+    else:
+        print(f"{'app':<14}{'window':>10}{'frame':>10}{'imports':>10}{'peak RSS':>11}{'steady':>10}")
+        for app, r in results.items():
+            print(
+                f"{app:<14}{r['window_ms']:>8.0f}ms{r['first_frame_ms']:>8.0f}ms"
+                f"{r['imports_ms']:>8.0f}ms{r['peak_rss_kb'] / 1024:>9.1f}MB"
+                f"{r['steady_rss_kb'] / 1024:>8.1f}MB"
+            )
+            for module, self_ms, cumulative_ms in r["slowest_imports"][:5]:
+                print(f"    {module:<40}{self_ms:>8.1f}ms self{cumulative_ms:>9.1f}ms total")
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -52,6 +52,18 @@ fi
 # Create output directory
 mkdir -p "$OUT_DIR"
 
+# Seed the installer git cache so the bootstrapper only fetches a delta
+# at boot, and still works offline
+INSTALLER_REPO="https://github.com/kutsos/kutos-installer"
+INSTALLER_CACHE="${SCRIPT_DIR}/airootfs/var/cache/kutos/installer.git"
+log "Kurulum programı önbelleği hazırlanıyor..."
+if python3 "${SCRIPT_DIR}/airootfs/usr/local/lib/kutos-bootstrapper/installer_cache.py" \
+        seed "$INSTALLER_REPO" "$INSTALLER_CACHE"; then
+    success "Kurulum programı önbelleğe alındı"
+else
+    error "Kurulum programı önbelleğe alınamadı; ISO önbelleksiz oluşturulacak"
+fi
+
 # Build ISO
 log "KutOS ISO oluşturuluyor..."
 log "  Profil: ${SCRIPT_DIR}"
@@ -0,0 +1,11 @@
+#!/bin/bash
+# KutOS Settings — config archive download check
+# Publishes a synthetic config archive on a local server and applies it:
+# a full download, an unchanged revalidation, block-level delta updates,
+# the fallbacks to a full download and a background prefetch.
+# Exits non-zero on a wrong result.
+
+ROOT="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+
+echo "Checking config archive downloads and delta updates..."
+python3 "${ROOT}/bench/delta_update.py" "$@"
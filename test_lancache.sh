@@ -0,0 +1,10 @@
+#!/bin/bash
+# KutOS Settings — LAN cache server check
+# Serves a package and a config archive from a local lancache server and
+# checks its answers to If-None-Match, Range and If-Range requests.
+# Exits non-zero if any answer is wrong.
+
+ROOT="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+
+echo "Checking the LAN cache server..."
+python3 "${ROOT}/bench/lancache_http.py"
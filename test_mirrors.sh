@@ -0,0 +1,10 @@
+#!/bin/bash
+# KutOS Settings — mirror ranking check
+# Ranks local fake mirrors (fast, slow, stale, broken, hanging) within the
+# normal time budget and checks the order and the mirrorlist written for
+# pacman. Exits non-zero on a wrong ranking.
+
+ROOT="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+
+echo "Checking the mirror ranking..."
+python3 "${ROOT}/bench/mirror_rank.py"
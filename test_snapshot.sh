@@ -0,0 +1,11 @@
+#!/bin/bash
+# KutOS Settings — config snapshot check
+# Applies a synthetic config archive over an existing tree with a snapshot,
+# reverts it with one path blocked and then unblocked, and checks that an
+# apply refuses to start without a usable snapshot store.
+# Exits non-zero on a wrong result.
+
+ROOT="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+
+echo "Checking config snapshots and rollback..."
+python3 "${ROOT}/bench/snapshot_restore.py"